@@ -0,0 +1,160 @@
+"""Budgets of cores and memory ffmpeg processes are admitted against, and the
+measurements estimates of what a process will need are based on.
+"""
+from pathlib import Path
+from probostitcher.cache import atomic_path
+from probostitcher.cache import CACHE_DIR
+from typing import Dict
+from typing import NamedTuple
+from typing import Optional
+
+import json
+import os
+import threading
+
+
+#: Cores the ffmpeg processes running at the same time may keep busy
+CPU_BUDGET = float(
+    os.environ.get("PROBOSTITCHER_CPU_BUDGET", len(os.sched_getaffinity(0)))
+)
+#: Bytes of memory the ffmpeg processes running at the same time may use.
+#: By default 80% of the memory available when the process starts.
+MEMORY_BUDGET = os.environ.get("PROBOSTITCHER_MEMORY_BUDGET")
+#: Where measurements are kept, so that they survive restarts
+MEASUREMENTS_PATH = CACHE_DIR / "measurements.json"
+#: Weight of a new measurement in the running average of its kind
+MEASUREMENT_WEIGHT = 0.3
+#: Measured memory use is multiplied by this, to leave room for variations
+MEMORY_HEADROOM = 1.25
+#: Memory used by ffmpeg before it holds any frame
+BASE_MEMORY = 64 * 1024 ** 2
+#: Memory used per pixel of the frames an ffmpeg process decodes and encodes,
+#: guessed from the number of frames decoders and libvpx keep around
+BYTES_PER_PIXEL = 48
+
+
+class Cost(NamedTuple):
+    """What a running ffmpeg process needs"""
+
+    #: Cores it keeps busy on average
+    cores: float
+    #: Peak resident memory in bytes
+    memory: int
+
+
+def default_cost(cores: float, pixels: int) -> Cost:
+    """A guess of the cost of an ffmpeg process keeping `cores` cores busy with
+    frames of `pixels` pixels altogether (inputs and output), before anything
+    like it was measured
+    """
+    return Cost(cores, BASE_MEMORY + pixels * BYTES_PER_PIXEL)
+
+
+def memory_budget() -> int:
+    """Return MEMORY_BUDGET, or 80% of the available memory if it's not set"""
+    if MEMORY_BUDGET:
+        return int(MEMORY_BUDGET)
+    with open("/proc/meminfo") as fh:
+        for line in fh:
+            name, value = line.split(":", 1)
+            if name == "MemAvailable":
+                return int(value.split()[0]) * 1024 * 8 // 10
+    raise ValueError("MemAvailable not found in /proc/meminfo")
+
+
+class Budget:
+    """Cores and memory the running ffmpeg processes of one or more pools may
+    need altogether. Pools sharing a budget also share its condition, so that
+    a task ending in one of them lets the tasks waiting in the others start.
+    """
+
+    #: Cores and memory the running tasks may need altogether
+    limit: Cost
+    #: Cores and memory the running tasks are expected to need
+    used: Cost
+    #: Number of running tasks
+    running: int
+
+    def __init__(self, limit: Cost):
+        self.limit = limit
+        self.used = Cost(0.0, 0)
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def fits(self, cost: Cost) -> bool:
+        """True if a task with the given cost can start now. A task is always
+        started when nothing else is running, even if it exceeds the budget.
+        Must be called holding `condition`.
+        """
+        if not self.running:
+            return True
+        return (
+            self.used.cores + cost.cores <= self.limit.cores
+            and self.used.memory + cost.memory <= self.limit.memory
+        )
+
+    def reserve(self, cost: Cost, sign: int):
+        """Add (sign 1) or remove (sign -1) a running task.
+        Must be called holding `condition`.
+        """
+        self.running += sign
+        self.used = Cost(
+            self.used.cores + sign * cost.cores, self.used.memory + sign * cost.memory
+        )
+
+
+class Measurements:
+    """Running averages of the cost of past ffmpeg processes, by kind.
+    The kind describes what determines the cost, like the encoder profile,
+    the output size and the inputs of a chunk (see `Specs.chunk_cost`).
+    Stored as JSON at `path`, rewritten after every new measurement.
+    """
+
+    #: The JSON file measurements are stored in
+    path: Path
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._values: Optional[Dict[str, Dict]] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict]:
+        if self._values is None:
+            try:
+                self._values = json.loads(self.path.read_text())
+            except (FileNotFoundError, ValueError):
+                self._values = {}
+        return self._values
+
+    def estimate(self, kind: str, default: Cost) -> Cost:
+        """The expected cost of a process of the given kind, or `default` if
+        none was measured yet
+        """
+        with self._lock:
+            value = self._load().get(kind)
+        if value is None:
+            return default
+        return Cost(value["cores"], int(value["memory"] * MEMORY_HEADROOM))
+
+    def record(self, kind: str, cost: Cost):
+        """Add the measured cost of a process to the average of its kind"""
+        with self._lock:
+            # Other processes may have recorded measurements in the meantime
+            self._values = None
+            values = self._load()
+            value = values.get(kind)
+            if value is None:
+                value = {"cores": cost.cores, "memory": cost.memory, "samples": 0}
+            for name in ("cores", "memory"):
+                value[name] += MEASUREMENT_WEIGHT * (getattr(cost, name) - value[name])
+            value["samples"] += 1
+            values[kind] = value
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with atomic_path(self.path) as tmp:
+                    Path(tmp).write_text(json.dumps(values))
+            except OSError as e:
+                print(f"Could not store measurements: {e}")
+
+
+MEASUREMENTS = Measurements(MEASUREMENTS_PATH)
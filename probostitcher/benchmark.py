@@ -0,0 +1,270 @@
+"""Measure rendering performance on synthetic recordings, generated offline.
+Inputs look like the ones Janus produces: a video and an audio file per
+participant, carrying their start time in a `COMMENT` tag.
+"""
+from pathlib import Path
+from probostitcher import Specs
+from probostitcher.profiles import PROFILES
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+#: Increase when the results format changes
+RESULTS_VERSION = 1
+#: Start time of the first synthetic participant, in microseconds since Epoch
+START_TIMESTAMP = 1600000000000000
+#: Phases timed by `Specs.timings`, in the order they happen
+PHASES = ("probe", "graph", "chunks", "concat", "mux", "stream")
+
+
+def generate_inputs(
+    directory: Path,
+    count: int,
+    duration: int,
+    width: int,
+    height: int,
+    fps: int,
+    stagger: int = 2,
+) -> List[Dict]:
+    """Generate a video and an audio recording for `count` participants in `directory`,
+    unless they're already there. Participant `i` joins `i * stagger` seconds after the first.
+    Returns the `inputs` section of a specs file using them.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    inputs = []
+    for i in range(count):
+        start = START_TIMESTAMP + i * stagger * 1000 ** 2
+        comment = json.dumps({"u": start})
+        name = f"participant-{i}-{width}x{height}-{fps}fps-{duration}s-{start}"
+        video = directory / f"{name}-video.webm"
+        audio = directory / f"{name}-audio.opus"
+        if not video.exists():
+            source = f"testsrc2=size={width}x{height}:rate={fps}:duration={duration}"
+            run_quietly(
+                ["ffmpeg", "-f", "lavfi", "-i", source, "-c:v", "libvpx"]
+                + ["-deadline", "realtime", "-cpu-used", "8", "-b:v", "500k"]
+                + ["-metadata:s:v:0", f"COMMENT={comment}", "-y", str(video)]
+            )
+        if not audio.exists():
+            source = f"sine=frequency={220 * (i + 1)}:duration={duration}"
+            run_quietly(
+                ["ffmpeg", "-f", "lavfi", "-i", source, "-c:a", "libopus"]
+                + ["-metadata:s:a:0", f"COMMENT={comment}", "-y", str(audio)]
+            )
+        inputs.append({"filename": str(video), "streamname": f"participant-{i}"})
+        inputs.append({"filename": str(audio), "streamname": f"participant-{i}-audio"})
+    return inputs
+
+
+def build_specs(
+    inputs: List[Dict],
+    duration: int,
+    milestones: int,
+    overlays: int,
+    width: int,
+    height: int,
+    fps: int,
+) -> Dict:
+    """Return specs switching between participants at `milestones` evenly spaced times.
+    Each milestone shows one participant full size and up to `overlays` others
+    as thumbnails along the bottom edge.
+    """
+    videos = [
+        el["streamname"] for el in inputs if not el["streamname"].endswith("audio")
+    ]
+    thumb_width, thumb_height = width // 4, height // 4
+    result = []
+    for i in range(milestones):
+        main = videos[i % len(videos)]
+        others = [name for name in videos if name != main][:overlays]
+        layout = [{"streamname": main}] + [
+            {
+                "streamname": name,
+                "x": j * thumb_width,
+                "y": height - thumb_height,
+                "width": thumb_width,
+                "height": thumb_height,
+            }
+            for j, name in enumerate(others)
+        ]
+        result.append({"timestamp": i * duration // milestones, "videos": layout})
+    return {
+        "inputs": inputs,
+        "output_start": START_TIMESTAMP,
+        "output_duration": duration,
+        "output_framerate": fps,
+        "output_size": {"width": width, "height": height},
+        "milestones": result,
+    }
+
+
+def run_benchmark(
+    specs_json: str,
+    repeat: int,
+    workdir: Path,
+    use_caches: bool = False,
+    **specs_options,
+) -> List[Dict[str, float]]:
+    """Render the given specs `repeat` times and return the timings of every run.
+    Unless `use_caches` is True every run probes all inputs and renders all chunks.
+    """
+    runs = []
+    for i in range(repeat):
+        start = time.monotonic()
+        specs = Specs(
+            filecontents=specs_json,
+            use_chunk_cache=use_caches,
+            use_probe_cache=use_caches,
+            **specs_options,
+        )
+        destination = workdir / f"output-{i}.webm"
+        if destination.exists():
+            destination.unlink()
+        specs.render(str(destination))
+        timings = dict(specs.timings)
+        timings["total"] = time.monotonic() - start
+        runs.append(timings)
+    return runs
+
+
+def summarize(runs: List[Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """Return minimum, median and maximum of every timed phase"""
+    phases = [phase for phase in PHASES + ("total",) if phase in runs[0]]
+    return {
+        phase: {
+            "min": min(run[phase] for run in runs),
+            "median": statistics.median(run[phase] for run in runs),
+            "max": max(run[phase] for run in runs),
+        }
+        for phase in phases
+    }
+
+
+def compare(results: Dict, baseline: Dict, file=sys.stdout):
+    """Print how the median of every phase changed since the baseline results"""
+    if (results["parameters"], results["version"]) != (
+        baseline["parameters"],
+        baseline["version"],
+    ):
+        print("Warning: the baseline was run with different parameters", file=file)
+    for phase, stats in results["summary"].items():
+        if phase not in baseline["summary"]:
+            continue
+        before, after = baseline["summary"][phase]["median"], stats["median"]
+        change = (after - before) / before * 100 if before else 0
+        print(
+            f"{phase:>8}: {before:8.2f}s -> {after:8.2f}s ({change:+.1f}%)", file=file
+        )
+
+
+def environment() -> Dict:
+    """Describe the machine running the benchmark"""
+    ffmpeg_version = subprocess.check_output(["ffmpeg", "-version"]).decode("utf-8")
+    return {
+        "cpus": len(os.sched_getaffinity(0)),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "ffmpeg": ffmpeg_version.splitlines()[0],
+    }
+
+
+def run_quietly(args: List[str]):
+    subprocess.run(args, check=True, capture_output=True)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--participants", type=int, default=4)
+    parser.add_argument("--duration", type=int, default=60, help="seconds")
+    parser.add_argument("--input-width", type=int, default=640)
+    parser.add_argument("--input-height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=640, help="output width")
+    parser.add_argument("--height", type=int, default=480, help="output height")
+    parser.add_argument("--fps", type=int, default=15)
+    parser.add_argument("--milestones", type=int, default=4)
+    parser.add_argument("--overlays", type=int, default=2)
+    parser.add_argument("--segment-duration", type=int, default=None)
+    parser.add_argument("--parallelism", type=int, default=None)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--profile", choices=sorted(PROFILES), help="encoder profile")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--use-caches",
+        action="store_true",
+        help="reuse cached ffprobe results and chunks",
+    )
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "probostitcher-benchmark",
+        help="where inputs are generated (and reused) and outputs written",
+    )
+    parser.add_argument("--output", type=Path, help="write results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="results to compare with")
+    args = parser.parse_args(argv)
+
+    inputs = generate_inputs(
+        args.workdir / "inputs",
+        args.participants,
+        args.duration,
+        args.input_width,
+        args.input_height,
+        args.fps,
+    )
+    specs = build_specs(
+        inputs,
+        args.duration,
+        args.milestones,
+        args.overlays,
+        args.width,
+        args.height,
+        args.fps,
+    )
+    if args.profile:
+        specs["encoder_profile"] = args.profile
+    specs_options = dict(parallelism=args.parallelism, streaming=args.streaming)
+    if args.segment_duration is not None:
+        specs_options["segment_duration"] = args.segment_duration
+    runs = run_benchmark(
+        json.dumps(specs),
+        args.repeat,
+        args.workdir,
+        use_caches=args.use_caches,
+        **specs_options,
+    )
+    parameters = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("workdir", "output", "compare", "repeat")
+    }
+    results = {
+        "version": RESULTS_VERSION,
+        "parameters": parameters,
+        "environment": environment(),
+        "runs": runs,
+        "summary": summarize(runs),
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    else:
+        print(text)
+    if args.compare:
+        # Keep standard output valid JSON when the results are written there
+        file = sys.stdout if args.output else sys.stderr
+        compare(results, json.loads(args.compare.read_text()), file=file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Size bounded on-disk caches, shared by all jobs running on the same machine
+"""
+from contextlib import contextmanager
+from hashlib import sha256
+from pathlib import Path
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+CACHE_DIR = Path(
+    os.environ.get("PROBOSTITCHER_CACHE_DIR", Path.home() / ".cache" / "probostitcher")
+)
+PROBE_CACHE_SIZE = int(os.environ.get("PROBOSTITCHER_PROBE_CACHE_SIZE", 64 * 1024 ** 2))
+CHUNK_CACHE_SIZE = int(os.environ.get("PROBOSTITCHER_CHUNK_CACHE_SIZE", 5 * 1024 ** 3))
+INPUT_CACHE_SIZE = int(os.environ.get("PROBOSTITCHER_INPUT_CACHE_SIZE", 20 * 1024 ** 3))
+
+
+class DiskCache:
+    """A directory of files addressed by arbitrary string keys.
+    When the total size of the files exceeds `max_size` bytes the least recently
+    used ones are removed. Writes are atomic, so several processes can share
+    the same directory.
+    """
+
+    #: Directory where the cached files are stored
+    directory: Path
+    #: Disk budget in bytes
+    max_size: int
+
+    def __init__(self, directory: Path, max_size: int, suffix: str = ""):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.suffix = suffix
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def path(self, key: str) -> Path:
+        """Return the path where the entry for `key` is (or would be) stored"""
+        digest = sha256(key.encode("utf-8")).hexdigest()
+        return self.directory / digest[:2] / f"{digest}{self.suffix}"
+
+    def get(self, key: str) -> Optional[Path]:
+        """Return the path of the cached file for `key`, or None if not present.
+        A hit marks the entry as recently used.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put_file(self, key: str, source: str, move: bool = False) -> Path:
+        """Store a copy of the file at `source` under `key`.
+        If `move` is True the file is moved into the cache instead.
+        """
+        destination = self.path(key)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        if move:
+            try:
+                os.replace(source, destination)
+            except OSError:  # Different filesystem: fall back to copying
+                move = False
+        if not move:
+            with atomic_path(destination) as tmp_name:
+                link_or_copy(source, tmp_name)
+        self.evict()
+        return destination
+
+    def fetch(self, key: str, download: Callable[[str], None]) -> Path:
+        """Return the path of the cached file for `key`. On a miss `download(filename)`
+        is called to create it. Threads asking for the same key wait for a single
+        download instead of starting their own.
+        """
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            path = self.get(key)
+            if path is None:
+                path = self.path(key)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with atomic_path(path) as tmp_name:
+                    download(tmp_name)
+                self.evict()
+        with self._locks_lock:
+            self._locks.pop(key, None)
+        return path
+
+    def get_json(self, key: str) -> Optional[Dict]:
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            return json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put_json(self, key: str, value: Dict):
+        destination = self.path(key)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_path(destination) as tmp_name:
+            Path(tmp_name).write_text(json.dumps(value))
+        self.evict()
+
+    def size(self) -> int:
+        """Total size in bytes of the cached files"""
+        return sum(path.stat().st_size for path in self._entries())
+
+    def evict(self):
+        """Remove least recently used entries until we're within budget"""
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # Removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda el: el[0]):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _entries(self):
+        if not self.directory.is_dir():
+            return []
+        return [
+            path for path in self.directory.glob("*/*") if not path.name.startswith(".")
+        ]
+
+
+@contextmanager
+def atomic_path(destination: Path) -> Iterator[str]:
+    """Yield a temporary file name in the same directory as `destination`.
+    When the block exits successfully the file is moved in place.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=destination.parent, prefix=".tmp-")
+    os.close(fd)
+    try:
+        yield tmp_name
+        os.replace(tmp_name, destination)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def link_or_copy(source: str, destination: str):
+    """Hard link `source` to `destination`, or copy it if linking is not possible.
+    `destination` is overwritten if it exists.
+    """
+    if os.path.lexists(destination):
+        os.unlink(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+#: ffprobe results, keyed by input identity (see `specs.input_identity`)
+PROBE_CACHE = DiskCache(CACHE_DIR / "probe", PROBE_CACHE_SIZE, suffix=".json")
+#: Rendered video chunks, keyed by `Specs.chunk_key`
+CHUNK_CACHE = DiskCache(CACHE_DIR / "chunks", CHUNK_CACHE_SIZE, suffix=".webm")
+#: Local copies of remote inputs, keyed by input identity
+INPUT_CACHE = DiskCache(CACHE_DIR / "inputs", INPUT_CACHE_SIZE)
@@ -0,0 +1,39 @@
+"""An index of the time spans covered by inputs, to find the ones overlapping
+a chunk without looking at all of them.
+"""
+from bisect import bisect_left
+from bisect import bisect_right
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+
+Span = Tuple[float, float]
+
+
+class Coverage:
+    """Spans of time, in seconds since Epoch, covered by named inputs"""
+
+    #: Start and end of every input, by name
+    spans: Dict[str, Span]
+
+    def __init__(self, spans: Dict[str, Span]):
+        self.spans = dict(spans)
+        self._entries = sorted(
+            (start, end, name) for name, (start, end) in spans.items()
+        )
+        self._starts = [start for start, _, _ in self._entries]
+        self._longest = max((end - start for start, end, _ in self._entries), default=0)
+
+    def overlapping(self, start: float, end: float) -> List[str]:
+        """Names of the inputs covering part of the given span, by start time.
+        Inputs that end when the span starts, or start when it ends, don't overlap it.
+        """
+        # Inputs starting earlier than this end before `start`, even the longest one
+        first = bisect_right(self._starts, start - self._longest)
+        last = bisect_left(self._starts, end)
+        return [
+            name
+            for input_start, input_end, name in self._entries[first:last]
+            if input_end > start
+        ]
@@ -0,0 +1,314 @@
+"""Long-lived pools of slots to run ffmpeg processes in, shared by all jobs of a process
+"""
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import wait
+from probostitcher.admission import Budget
+from probostitcher.admission import Cost
+from probostitcher.admission import CPU_BUDGET
+from probostitcher.admission import memory_budget
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Union
+
+import os
+import signal
+import subprocess
+import threading
+
+
+#: Maximum number of ffmpeg processes running at the same time in this process
+FFMPEG_SLOTS = int(
+    os.environ.get("PROBOSTITCHER_FFMPEG_SLOTS", len(os.sched_getaffinity(0)))
+)
+
+
+class FfmpegPool:
+    """A fixed number of threads running tasks, typically waiting for an ffmpeg process.
+    Tasks are submitted in groups (one per job): pending tasks are taken from
+    each group in turn, so that tasks of concurrent jobs interleave.
+    Tasks of the same group are started in the order they were submitted.
+    If the pool has a budget, tasks are also submitted with their expected cost,
+    and the next task only starts once the running ones leave room for it.
+    The budget may be shared with other pools (see `admission.Budget`).
+    """
+
+    #: Number of tasks that can run at the same time
+    slots: int
+    #: Cores and memory the running tasks may need altogether, if limited
+    budget: Optional[Budget]
+    #: Cores and memory the running tasks of this pool are expected to need
+    used: Cost
+
+    def __init__(self, slots: int, budget: Union[Budget, Cost, None] = None):
+        self.slots = slots
+        self.budget = Budget(budget) if isinstance(budget, Cost) else budget
+        self.used = Cost(0.0, 0)
+        self._groups: "OrderedDict[Hashable, Deque]" = OrderedDict()
+        self._condition = (
+            self.budget.condition if self.budget is not None else threading.Condition()
+        )
+        self._threads = [
+            threading.Thread(target=self._work, name=f"ffmpeg-slot-{i}", daemon=True)
+            for i in range(slots)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+        self,
+        group: Hashable,
+        function: Callable,
+        *args,
+        cost: Optional[Cost] = None,
+    ) -> Future:
+        """Schedule `function(*args)` to be run as part of `group`.
+        `cost` is what it's expected to need while it runs (nothing by default).
+        """
+        future: Future = Future()
+        task = (future, function, args, cost or Cost(0.0, 0))
+        with self._condition:
+            self._groups.setdefault(group, deque()).append(task)
+            self._condition.notify_all()
+        return future
+
+    def map(self, group: Hashable, function: Callable, iterable: Iterable) -> List:
+        """Run `function` on every element of `iterable` and return the results"""
+        futures = [self.submit(group, function, el) for el in iterable]
+        return [future.result() for future in futures]
+
+    def pending(self) -> int:
+        """Number of tasks waiting for a free slot"""
+        with self._condition:
+            return sum(len(tasks) for tasks in self._groups.values())
+
+    def fits(self, cost: Cost) -> bool:
+        """True if a task with the given cost can start now. A task is always
+        started when nothing else is running, even if it exceeds the budget.
+        """
+        return self.budget is None or self.budget.fits(cost)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                # Wait for the next task, and for room for it
+                while not self._groups or not self.fits(self._next_cost()):
+                    self._condition.wait()
+                # Take the first task of the first group, then move the group last
+                group, tasks = self._groups.popitem(last=False)
+                future, function, args, cost = tasks.popleft()
+                if tasks:
+                    self._groups[group] = tasks
+                if not future.set_running_or_notify_cancel():
+                    self._condition.notify_all()
+                    continue
+                self._reserve(cost, 1)
+            try:
+                result = function(*args)
+            except BaseException as e:
+                self._release(cost)
+                future.set_exception(e)
+            else:
+                self._release(cost)
+                future.set_result(result)
+
+    def _next_cost(self) -> Cost:
+        _, tasks = next(iter(self._groups.items()))
+        future, _, _, cost = tasks[0]
+        # Cancelled tasks are only discarded: don't wait for room for them
+        return Cost(0.0, 0) if future.cancelled() else cost
+
+    def _release(self, cost: Cost):
+        """Make room for other tasks once a task is done"""
+        with self._condition:
+            self._reserve(cost, -1)
+            self._condition.notify_all()
+
+    def _reserve(self, cost: Cost, sign: int):
+        self.used = Cost(
+            self.used.cores + sign * cost.cores, self.used.memory + sign * cost.memory
+        )
+        if self.budget is not None:
+            self.budget.reserve(cost, sign)
+
+
+class TaskTimeout(Exception):
+    """A task of a batch ran out of time, and its processes were killed"""
+
+
+class _RunningTask:
+    """The processes started by a running task of a batch"""
+
+    def __init__(self):
+        self.processes: Set[subprocess.Popen] = set()
+        self.killed = False
+        self.expired = False
+        self._lock = threading.Lock()
+
+    def watch(self, process: subprocess.Popen):
+        with self._lock:
+            if not self.killed:
+                self.processes.add(process)
+                return
+        kill(process)
+
+    def unwatch(self, process: subprocess.Popen):
+        with self._lock:
+            self.processes.discard(process)
+
+    def kill(self):
+        with self._lock:
+            self.killed = True
+            processes = list(self.processes)
+        for process in processes:
+            kill(process)
+
+    def expire(self):
+        self.expired = True
+        self.kill()
+
+
+class Batch:
+    """Tasks of a group which fail together: as soon as one of them fails
+    the pending ones are cancelled, and the ffmpeg processes of the running ones
+    are killed (see `watch`). Tasks can be given a timeout, after which their
+    processes are killed and they fail with TaskTimeout.
+    """
+
+    #: The pool tasks are run in
+    pool: FfmpegPool
+    #: The group of the pool tasks are submitted as part of
+    group: Hashable
+    #: The first error raised by a task, if any
+    error: Optional[BaseException] = None
+
+    def __init__(self, pool: FfmpegPool, group: Hashable):
+        self.pool = pool
+        self.group = group
+        self._futures: List[Future] = []
+        self._running: Set[_RunningTask] = set()
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        function: Callable,
+        *args,
+        timeout: Optional[float] = None,
+        cost: Optional[Cost] = None,
+    ) -> Future:
+        """Schedule `function(*args)`, giving up after `timeout` seconds if given.
+        `cost` is passed on to the pool (see `FfmpegPool.submit`).
+        """
+        future = self.pool.submit(
+            self.group, self._run, function, args, timeout, cost=cost
+        )
+        self._futures.append(future)
+        return future
+
+    def wait(self) -> List:
+        """Wait for all tasks to end and return their results.
+        If any failed, raise the first error once the others are cancelled or killed.
+        """
+        wait(self._futures)
+        if self.error is not None:
+            raise self.error
+        return [future.result() for future in self._futures]
+
+    def fail(self, error: BaseException):
+        """Cancel the pending tasks and kill the processes of the running ones"""
+        with self._lock:
+            if self.error is not None:
+                return
+            self.error = error
+            running = list(self._running)
+        for future in self._futures:
+            future.cancel()
+        for task in running:
+            task.kill()
+
+    def _run(self, function: Callable, args: tuple, timeout: Optional[float]):
+        task = _RunningTask()
+        with self._lock:
+            if self.error is not None:
+                # Failed while this task was being started
+                raise self.error
+            self._running.add(task)
+        timer = threading.Timer(timeout, task.expire) if timeout else None
+        if timer is not None:
+            timer.daemon = True
+            timer.start()
+        _current.task = task
+        try:
+            return function(*args)
+        except BaseException as e:
+            if task.expired:
+                error: BaseException = TaskTimeout(
+                    f"Killed after {timeout:.0f} seconds\n{e}"
+                )
+                self.fail(error)
+                raise error from e
+            self.fail(e)
+            raise
+        finally:
+            _current.task = None
+            if timer is not None:
+                timer.cancel()
+            with self._lock:
+                self._running.discard(task)
+
+
+_current = threading.local()
+
+
+def watch(process: subprocess.Popen):
+    """Kill `process` if the batch task running in this thread fails or times out.
+    Processes started outside of batch tasks are ignored.
+    """
+    task = getattr(_current, "task", None)
+    if task is not None:
+        task.watch(process)
+
+
+def unwatch(process: subprocess.Popen):
+    """Forget about a process passed to `watch`, once it's been waited for"""
+    task = getattr(_current, "task", None)
+    if task is not None:
+        task.unwatch(process)
+
+
+def kill(process: subprocess.Popen):
+    """Kill a process, unless it's already been waited for"""
+    if process.returncode is None:
+        try:
+            os.kill(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+_POOLS: Dict[int, FfmpegPool] = {}
+_POOLS_LOCK = threading.Lock()
+_BUDGET: Optional[Budget] = None
+
+
+def get_pool(slots: Optional[int] = None) -> FfmpegPool:
+    """Return the process-wide pool with the given number of slots
+    (FFMPEG_SLOTS by default), creating it the first time it's requested.
+    All pools share a single budget of CPU_BUDGET cores and of the memory
+    budget (see `admission.memory_budget`), so that the processes of jobs
+    with different parallelisms are admitted against the same machine.
+    """
+    global _BUDGET
+    slots = slots or FFMPEG_SLOTS
+    with _POOLS_LOCK:
+        if _BUDGET is None:
+            _BUDGET = Budget(Cost(CPU_BUDGET, memory_budget()))
+        if slots not in _POOLS:
+            _POOLS[slots] = FfmpegPool(slots, _BUDGET)
+        return _POOLS[slots]
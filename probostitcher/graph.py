@@ -0,0 +1,130 @@
+"""A thin layer over ffmpeg-python to build the filter chain of a single video track.
+Steps are recorded first, and simplified when the chain is built.
+"""
+from ffmpeg.nodes import FilterableStream
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Tuple
+
+import ffmpeg
+
+
+class Step(NamedTuple):
+    name: str
+    args: Tuple
+    kwargs: Dict
+
+
+#: Steps changing the frame size
+GEOMETRY_STEPS = ("scale", "pad")
+
+
+class Track:
+    """The chain of filters applied to a video input.
+    Scale and pad steps fit frames into a box (like CSS `object-fit: contain`),
+    so only the last ones matter. Since no other step depends on the frame size
+    they're applied first. They're applied even if the size of the input
+    already fits the box: frames may change size midway, and the size we're
+    given is the one of the first frame. Padding is generated with `color`
+    sources of the right size.
+    """
+
+    #: The stream the filters are applied to
+    stream: FilterableStream
+    #: Width of the frames in `stream`
+    width: int
+    #: Height of the frames in `stream`
+    height: int
+    #: The steps recorded so far
+    steps: List[Step]
+
+    def __init__(self, stream: FilterableStream, width: int, height: int):
+        self.stream = stream
+        self.width = width
+        self.height = height
+        self.steps = []
+
+    def filter(self, name: str, *args, **kwargs) -> "Track":
+        """Append an ffmpeg filter to the chain"""
+        self.steps.append(Step(name, args, kwargs))
+        return self
+
+    def scale(self, width: int, height: int) -> "Track":
+        """Scale frames to fit in the given size, keeping their aspect ratio"""
+        return self.filter("scale", width, height)
+
+    def pad(self, width: int, height: int) -> "Track":
+        """Add black bands to center frames in the given size"""
+        return self.filter("pad", width, height)
+
+    def trim(self, **kwargs) -> "Track":
+        return self.filter("trim", **kwargs)
+
+    def pad_before(self, duration: float, rate: int) -> "Track":
+        """Prepend `duration` seconds of black frames"""
+        return self.filter("pad_before", duration, rate)
+
+    def pad_after(self, duration: float, rate: int) -> "Track":
+        """Append `duration` seconds of black frames"""
+        return self.filter("pad_after", duration, rate)
+
+    def optimized_steps(self) -> List[Step]:
+        """Return the steps that need to be applied to get the same result"""
+        result = []
+        for name in GEOMETRY_STEPS:
+            steps = [step for step in self.steps if step.name == name]
+            result += steps[-1:]
+        return result + [step for step in self.steps if step.name not in GEOMETRY_STEPS]
+
+    def build(self) -> FilterableStream:
+        """Return the stream with the optimized chain of filters applied"""
+        stream, width, height = self.stream, self.width, self.height
+        for step in self.optimized_steps():
+            if step.name == "scale":
+                width, height = step.args
+                stream = stream.filter(
+                    "scale",
+                    size=f"{width}:{height}",
+                    force_original_aspect_ratio="decrease",
+                )
+                # Rounding makes scale adjust the sample aspect ratio:
+                # reset it, or concatenating padding would fail
+                stream = stream.filter("setsar", 1)
+                width, height = fit(self.width, self.height, width, height)
+            elif step.name == "pad":
+                width, height = step.args
+                stream = stream.filter("pad", width, height, "(ow-iw)/2", "(oh-ih)/2")
+            elif step.name in ("pad_before", "pad_after"):
+                duration, rate = step.args
+                padding = black(width, height, duration, rate)
+                if step.name == "pad_before":
+                    stream = ffmpeg.concat(padding, stream)
+                else:
+                    stream = ffmpeg.concat(stream, padding)
+            else:
+                stream = stream.filter(step.name, *step.args, **step.kwargs)
+        return stream
+
+
+def black(width: int, height: int, duration: float, rate: int) -> FilterableStream:
+    """A stream of black frames, generated without reading any input"""
+    return ffmpeg.source(
+        "color",
+        color="black",
+        size=f"{width}x{height}",
+        rate=rate,
+        duration=f"{duration:f}",
+    )
+
+
+def fit(width: int, height: int, box_width: int, box_height: int) -> Tuple[int, int]:
+    """Return the size ffmpeg scales a `width`x`height` frame to, to make it fit
+    in the given box keeping its aspect ratio. ffmpeg might round it differently:
+    the pad that follows fixes that.
+    """
+    if width * box_height == height * box_width:
+        return box_width, box_height
+    scaled_width = min(box_width, round(box_height * width / height))
+    scaled_height = min(box_height, round(box_width * height / width))
+    return scaled_width, scaled_height
@@ -0,0 +1,82 @@
+"""Named sets of video encoder settings, trading rendering time for quality.
+Specs choose one with their `encoder_profile` key.
+"""
+from typing import Dict
+from typing import NamedTuple
+
+import os
+
+
+class EncoderProfile(NamedTuple):
+    #: The ffmpeg video encoder
+    codec: str
+    #: libvpx quality deadline: `realtime`, `good` or `best`
+    deadline: str
+    #: libvpx speed preset: higher is faster and looks worse
+    cpu_used: int
+    #: Constant quality level: lower looks better and makes bigger files
+    crf: int
+    #: If True rows are encoded in parallel (VP9 only)
+    row_mt: bool
+    #: Base 2 logarithm of the number of tile columns frames are split into,
+    #: encoded in parallel (VP9 only)
+    tile_columns: int
+
+    @property
+    def codec_name(self) -> str:
+        """Name ffprobe gives to the streams this profile encodes"""
+        return CODEC_NAMES[self.codec]
+
+    def output_options(self, threads: int) -> Dict:
+        """Options of the ffmpeg output encoding with this profile using `threads` threads"""
+        options = {
+            "vcodec": self.codec,
+            "deadline": self.deadline,
+            "cpu-used": self.cpu_used,
+            "crf": self.crf,
+            "b:v": 0,  # Use constant quality instead of a target bitrate
+            "threads": threads,
+        }
+        if self.codec == "libvpx-vp9":
+            options["row-mt"] = int(self.row_mt)
+            options["tile-columns"] = self.tile_columns
+        return options
+
+
+#: Names ffprobe gives to the streams of each encoder
+CODEC_NAMES = {"libvpx": "vp8", "libvpx-vp9": "vp9"}
+PROFILES = {
+    "draft": EncoderProfile(
+        codec="libvpx-vp9",
+        deadline="realtime",
+        cpu_used=8,
+        crf=40,
+        row_mt=True,
+        tile_columns=2,
+    ),
+    "balanced": EncoderProfile(
+        codec="libvpx-vp9",
+        deadline="good",
+        cpu_used=4,
+        crf=32,
+        row_mt=True,
+        tile_columns=1,
+    ),
+    "archive": EncoderProfile(
+        codec="libvpx-vp9",
+        deadline="good",
+        cpu_used=1,
+        crf=24,
+        row_mt=True,
+        tile_columns=0,
+    ),
+}
+#: Profile used by specs that don't choose one
+ENCODER_PROFILE = os.environ.get("PROBOSTITCHER_ENCODER_PROFILE", "balanced")
+
+
+def thread_budget(processes: int) -> int:
+    """Number of threads each of `processes` ffmpeg processes running at
+    the same time can use without oversubscribing the available cores
+    """
+    return max(1, len(os.sched_getaffinity(0)) // processes)
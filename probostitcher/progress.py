@@ -0,0 +1,387 @@
+"""Live progress of the ffmpeg processes of every job running in this process.
+ffmpeg is started with `-progress` writing to a pipe, which is parsed as it's written.
+"""
+from collections import deque
+from collections import OrderedDict
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import os
+import probostitcher.executor
+import subprocess
+import sys
+import threading
+import time
+
+
+#: Finished jobs are forgotten once there are more than this many
+MAX_TRACKED_JOBS = 100
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+#: Number of lines of ffmpeg standard error kept to report errors
+STDERR_TAIL_LINES = 20
+
+
+class TaskProgress:
+    """Progress of a single ffmpeg process, as reported by ffmpeg itself"""
+
+    #: Name of the task, like `chunk-3` or `audio`
+    name: str
+    #: Seconds of output the process is expected to write
+    duration: float
+    #: Seconds of output written so far
+    out_time: float
+    #: Frames written so far
+    frame: int
+    #: Frames encoded per second
+    fps: float
+    #: Seconds of output written per second of wall time
+    speed: float
+    #: CPU time in seconds used by the process (user + system)
+    cpu_time: float
+    #: Memory in bytes used by the process: the last sample while it runs,
+    #: its peak once it's done
+    rss: int
+    #: Last lines the process wrote to its standard error
+    stderr_tail: Deque[str]
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+    def __init__(self, name: str, duration: float):
+        self.name = name
+        self.duration = duration
+        self.out_time = 0.0
+        self.frame = 0
+        self.fps = 0.0
+        self.speed = 0.0
+        self.cpu_time = 0.0
+        self.rss = 0
+        self.stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        self._reader: Optional[threading.Thread] = None
+        self._stderr_reader: Optional[threading.Thread] = None
+
+    @property
+    def done(self) -> float:
+        """Seconds of output written so far, capped at the expected duration"""
+        if self.finished is not None:
+            return self.duration
+        return min(self.out_time, self.duration)
+
+    def update(self, fields: Dict[str, str], pid: Optional[int] = None):
+        """Update the progress from a block of ffmpeg `-progress` output"""
+        out_time_us = fields.get("out_time_us", "N/A")
+        if out_time_us.lstrip("-").isdigit():
+            self.out_time = max(0, int(out_time_us)) / 1000 ** 2
+        self.frame = int(fields.get("frame", self.frame))
+        self.fps = _float(fields.get("fps"), self.fps)
+        self.speed = _float(fields.get("speed", "").rstrip("x"), self.speed)
+        if pid is not None:
+            self.cpu_time = process_cpu_time(pid) or self.cpu_time
+            self.rss = process_rss(pid) or self.rss
+
+    def follow(self, fd: int, pid: int):
+        """Read ffmpeg `-progress` output from `fd` until ffmpeg closes it"""
+        fields: Dict[str, str] = {}
+        with open(fd) as fh:
+            for line in fh:
+                key, _, value = line.strip().partition("=")
+                fields[key] = value
+                if key == "progress":
+                    self.update(fields, pid)
+                    fields = {}
+
+    def follow_stderr(self, fh):
+        """Read ffmpeg standard error from `fh`, keeping the last lines and
+        passing everything on to our own standard error
+        """
+        with fh:
+            for line in iter(fh.readline, b""):
+                text = line.decode("utf-8", errors="replace")
+                self.stderr_tail.append(text.rstrip())
+                sys.stderr.write(text)
+
+    def finish(self, cpu_time: Optional[float] = None, rss: Optional[int] = None):
+        if cpu_time is not None:
+            self.cpu_time = cpu_time
+        if rss is not None:
+            self.rss = rss
+        self.finished = time.time()
+
+    @property
+    def cores(self) -> float:
+        """Average number of cores the process kept busy while it ran"""
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.started
+        return self.cpu_time / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "duration": self.duration,
+            "done": self.done,
+            "fps": self.fps,
+            "speed": self.speed,
+            "cpu_time": self.cpu_time,
+            "rss": self.rss,
+            "finished": self.finished is not None,
+        }
+
+
+class FfmpegError(subprocess.CalledProcessError):
+    """An ffmpeg process failed. The message ends with the last lines it wrote
+    to its standard error.
+    """
+
+    def __init__(self, task: TaskProgress, returncode: int, cmd, output=None):
+        super().__init__(returncode, cmd, output, "\n".join(task.stderr_tail))
+        self.task = task.name
+
+    def __str__(self) -> str:
+        if self.returncode < 0:
+            status = f"was killed by signal {-self.returncode}"
+        else:
+            status = f"exited with status {self.returncode}"
+        return f"ffmpeg {status} ({self.task})\n{self.stderr}".rstrip()
+
+
+class JobProgress:
+    """Aggregated progress of all ffmpeg processes of a job"""
+
+    #: The job identifier (see `Specs.job_id`)
+    job_id: str
+    #: Functions called with the job whenever its state changes
+    listeners: List[Callable[["JobProgress"], None]]
+    #: Tasks of the job, by name
+    tasks: Dict[str, TaskProgress]
+    #: Error message if the job failed
+    error: Optional[str] = None
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.listeners = []
+        self._state = "queued"
+        self.tasks = OrderedDict()
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """One of `queued`, `preparing`, `rendering`, `uploading`, `done`, `failed`"""
+        return self._state
+
+    @state.setter
+    def state(self, state: str):
+        changed, self._state = state != self._state, state
+        if changed:
+            for listener in list(self.listeners):
+                listener(self)
+
+    def task(self, name: str, duration: float) -> TaskProgress:
+        """Register a new task and return its progress"""
+        task = TaskProgress(name, duration)
+        with self._lock:
+            self.tasks[name] = task
+        return task
+
+    def _tasks(self) -> List[TaskProgress]:
+        with self._lock:
+            return list(self.tasks.values())
+
+    @property
+    def ratio(self) -> float:
+        """Fraction of the expected output written so far, between 0 and 1"""
+        tasks = self._tasks()
+        total = sum(task.duration for task in tasks)
+        if not total:
+            return 1.0 if self.state == "done" else 0.0
+        return sum(task.done for task in tasks) / total
+
+    @property
+    def cpu_time(self) -> float:
+        return sum(task.cpu_time for task in self._tasks())
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Estimated seconds left, assuming the job keeps going at the same pace"""
+        ratio, elapsed = self.ratio, time.time() - self.started
+        if self.state == "done":
+            return 0.0
+        if not ratio:
+            return None
+        return elapsed * (1 - ratio) / ratio
+
+    def as_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "state": self.state,
+            "error": self.error,
+            "progress": self.ratio,
+            "eta": self.eta,
+            "cpu_time": self.cpu_time,
+            "elapsed": time.time() - self.started,
+            "tasks": [task.as_dict() for task in self._tasks()],
+        }
+
+
+JOBS: "OrderedDict[str, JobProgress]" = OrderedDict()
+_JOBS_LOCK = threading.Lock()
+
+
+def track_job(job_id: str) -> JobProgress:
+    """Return the progress of the given job, registering it if it's new"""
+    with _JOBS_LOCK:
+        if job_id not in JOBS:
+            JOBS[job_id] = JobProgress(job_id)
+            finished = [job for job in JOBS.values() if job.state in ("done", "failed")]
+            for job in finished[: max(0, len(JOBS) - MAX_TRACKED_JOBS)]:
+                del JOBS[job.job_id]
+        return JOBS[job_id]
+
+
+def forget_job(job_id: str):
+    """Stop tracking a job: the next `track_job` call starts afresh"""
+    with _JOBS_LOCK:
+        JOBS.pop(job_id, None)
+
+
+def get_job(job_id: str) -> Optional[JobProgress]:
+    with _JOBS_LOCK:
+        return JOBS.get(job_id)
+
+
+def all_jobs() -> List[JobProgress]:
+    with _JOBS_LOCK:
+        return list(JOBS.values())
+
+
+def popen(args: List[str], task: TaskProgress, **kwargs) -> subprocess.Popen:
+    """Start an ffmpeg process reporting its progress to `task`.
+    Wait for it with `wait`, so that its CPU time is recorded.
+    Unless redirected, its standard error is kept in `task.stderr_tail`.
+    If started by a task of a batch the process is killed if the batch fails
+    (see `executor.Batch`).
+    """
+    read_fd, write_fd = os.pipe()
+    options = ["-hide_banner", "-progress", f"pipe:{write_fd}", "-nostats"]
+    args = [args[0]] + options + list(args[1:])
+    pass_fds = list(kwargs.pop("pass_fds", ())) + [write_fd]
+    kwargs.setdefault("stderr", subprocess.PIPE)
+    try:
+        process = subprocess.Popen(args, pass_fds=pass_fds, **kwargs)
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    probostitcher.executor.watch(process)
+    task.started = time.time()
+    task._reader = threading.Thread(
+        target=task.follow, args=(read_fd, process.pid), daemon=True
+    )
+    task._reader.start()
+    if process.stderr is not None:
+        task._stderr_reader = threading.Thread(
+            target=task.follow_stderr, args=(process.stderr,), daemon=True
+        )
+        task._stderr_reader.start()
+    return process
+
+
+def wait(process: subprocess.Popen, task: TaskProgress) -> int:
+    """Wait for a process started with `popen` and return its exit code"""
+    _, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    probostitcher.executor.unwatch(process)
+    for reader in (task._reader, task._stderr_reader):
+        if reader is not None:
+            reader.join()
+    # Linux reports the peak resident set size in kilobytes
+    task.finish(rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss * 1024)
+    return process.returncode
+
+
+def run(args: List[str], task: TaskProgress) -> bytes:
+    """Run ffmpeg reporting progress to `task`, and return what it wrote to
+    its standard output. Raises FfmpegError if ffmpeg fails.
+    """
+    process = popen(args, task, stdout=subprocess.PIPE)
+    output = process.stdout.read()
+    process.stdout.close()
+    if wait(process, task):
+        raise FfmpegError(task, process.returncode, args, output)
+    return output
+
+
+def process_cpu_time(pid: int) -> Optional[float]:
+    """CPU time in seconds used so far by a running process, read from /proc"""
+    try:
+        with open(f"/proc/{pid}/stat") as fh:
+            stat = fh.read()
+    except OSError:
+        return None
+    # The command name can contain spaces: skip it
+    fields = stat.rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def process_rss(pid: int) -> Optional[int]:
+    """Memory in bytes used by a running process, read from /proc"""
+    try:
+        with open(f"/proc/{pid}/statm") as fh:
+            return int(fh.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def prometheus_metrics() -> str:
+    """Return the progress of all tracked jobs in Prometheus text format"""
+    lines = []
+    job_metrics = [
+        ("job_progress_ratio", "gauge", "Fraction of the job done", "ratio"),
+        ("job_eta_seconds", "gauge", "Estimated seconds until the job is done", "eta"),
+        ("job_cpu_seconds_total", "counter", "CPU time used by ffmpeg", "cpu_time"),
+    ]
+    task_metrics = [
+        ("task_progress_ratio", "gauge", "Fraction of the task done", None),
+        ("task_speed_ratio", "gauge", "Output seconds encoded per second", "speed"),
+        ("task_fps", "gauge", "Frames encoded per second", "fps"),
+        ("task_cpu_seconds_total", "counter", "CPU time used by ffmpeg", "cpu_time"),
+        ("task_rss_bytes", "gauge", "Memory used by ffmpeg", "rss"),
+    ]
+    jobs = all_jobs()
+    for name, kind, description, attribute in job_metrics:
+        lines.append(f"# HELP probostitcher_{name} {description}")
+        lines.append(f"# TYPE probostitcher_{name} {kind}")
+        for job in jobs:
+            value = getattr(job, attribute)
+            if value is not None:
+                lines.append(
+                    f'probostitcher_{name}{{job="{job.job_id}",state="{job.state}"}} {value}'
+                )
+    for name, kind, description, attribute in task_metrics:
+        lines.append(f"# HELP probostitcher_{name} {description}")
+        lines.append(f"# TYPE probostitcher_{name} {kind}")
+        for job in jobs:
+            for task in job._tasks():
+                if attribute is None:
+                    value = task.done / task.duration if task.duration else 1.0
+                else:
+                    value = getattr(task, attribute)
+                lines.append(
+                    f'probostitcher_{name}{{job="{job.job_id}",task="{task.name}"}} {value}'
+                )
+    return "\n".join(lines) + "\n"
+
+
+def _float(value: Optional[str], default: float) -> float:
+    try:
+        return float(value)  # type: ignore
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,306 @@
+"""Queues jobs are submitted to and workers take them from.
+SQS by default, or an SQLite database for deployments running the server and
+the workers on the same machine (or in the same process).
+"""
+from abc import ABC
+from abc import abstractmethod
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+import boto3
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+#: Exceptions raised by queue backends when they can't be reached
+QUEUE_ERRORS = (ClientError, sqlite3.Error)
+#: SQS receives, sends and deletes at most this many messages per request
+SQS_BATCH_SIZE = 10
+#: Messages of the SQLite queue received this many times without being deleted
+#: are moved to its `dead_letters` table. Zero means no limit.
+MAX_RECEIVES = int(os.environ.get("PROBOSTITCHER_QUEUE_MAX_RECEIVES", 5))
+
+
+class Queue(ABC):
+    """Messages are hidden from other receivers for a while once received,
+    and received again unless deleted in the meantime.
+    Received messages have a `body` attribute.
+    """
+
+    @abstractmethod
+    def send(self, bodies: List[str], delays: Optional[List[int]] = None):
+        """Queue messages. `delays` are the seconds each one stays hidden"""
+
+    @abstractmethod
+    def receive(self, max_messages: int, wait: int) -> List:
+        """Wait up to `wait` seconds for messages, and return at most `max_messages`"""
+
+    @abstractmethod
+    def receive_count(self, message) -> int:
+        """How many times a received message was received, this time included"""
+
+    @abstractmethod
+    def change_visibility(self, message, timeout: int):
+        """Hide a received message from other receivers for `timeout` seconds from now"""
+
+    def postpone(self, message, delay: int):
+        """Hide a received message for `delay` seconds, because it could not be
+        processed yet. Where possible this receive is not counted.
+        """
+        self.change_visibility(message, delay)
+
+    @abstractmethod
+    def delete(self, messages: List):
+        """Delete received messages, so that they're not received again"""
+
+
+class SqsQueue(Queue):
+    def __init__(self, name: str, region: str, max_connections: int = 10):
+        self.name = name
+        self.region = region
+        sqs = boto3.resource(
+            "sqs",
+            region_name=region,
+            config=Config(max_pool_connections=max_connections),
+        )
+        self._queue = sqs.get_queue_by_name(QueueName=name)
+
+    @property
+    def fifo(self) -> bool:
+        return self.name.endswith(".fifo")
+
+    def send(self, bodies: List[str], delays: Optional[List[int]] = None):
+        entries = []
+        for i, body in enumerate(bodies):
+            entry = {"Id": str(i), "MessageBody": body}
+            if self.fifo:
+                # A group per message, so that workers don't wait for each other.
+                # The specs hash would make a better deduplication id, but then
+                # the very same job could not be submitted twice.
+                entry["MessageGroupId"] = uuid.uuid4().hex
+                entry["MessageDeduplicationId"] = uuid.uuid4().hex
+            elif delays:
+                # FIFO queues don't support delaying single messages
+                entry["DelaySeconds"] = delays[i]
+            entries.append(entry)
+        while entries:
+            batch, entries = entries[:SQS_BATCH_SIZE], entries[SQS_BATCH_SIZE:]
+            response = self._queue.send_messages(Entries=batch)
+            if response.get("Failed"):
+                raise RuntimeError(f"Could not queue messages: {response['Failed']}")
+
+    def receive(self, max_messages: int, wait: int) -> List:
+        return self._queue.receive_messages(
+            WaitTimeSeconds=wait,
+            MaxNumberOfMessages=max_messages,
+            AttributeNames=["ApproximateReceiveCount"],
+        )
+
+    def receive_count(self, message) -> int:
+        return int(message.attributes.get("ApproximateReceiveCount", 1))
+
+    def change_visibility(self, message, timeout: int):
+        message.change_visibility(VisibilityTimeout=timeout)
+
+    def delete(self, messages: List):
+        while messages:
+            batch, messages = messages[:SQS_BATCH_SIZE], messages[SQS_BATCH_SIZE:]
+            response = self._queue.delete_messages(
+                Entries=[
+                    {"Id": str(i), "ReceiptHandle": message.receipt_handle}
+                    for i, message in enumerate(batch)
+                ]
+            )
+            for failure in response.get("Failed", []):
+                print(f"Could not delete message: {failure.get('Message')}")
+
+    def __str__(self) -> str:
+        return f"queue {self.name} in region {self.region}"
+
+
+class LocalMessage(NamedTuple):
+    id: int
+    #: Changes every time the message is received: only the last receiver
+    #: can change its visibility or delete it
+    receipt: str
+    body: str
+    #: Times the message was received, this time included
+    receive_count: int
+
+
+class SqliteQueue(Queue):
+    """A queue in an SQLite database, which several processes can share.
+    With the `:memory:` path the queue only lives in this process.
+    Messages received `max_receives` times without being deleted are moved
+    to the `dead_letters` table instead of being received again, like SQS
+    does with a redrive policy.
+    """
+
+    #: Seconds received messages stay hidden, unless changed
+    visibility_timeout: int
+    #: Times a message can be received. Zero means no limit.
+    max_receives: int
+    #: Seconds between checks for new messages while waiting
+    poll_interval = 0.2
+
+    def __init__(
+        self, path: str, visibility_timeout: int = 30, max_receives: int = MAX_RECEIVES
+    ):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_receives = max_receives
+        self._db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL, "
+                "visible_at REAL NOT NULL, receipt TEXT, "
+                "receive_count INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [
+                row[1] for row in self._db.execute("PRAGMA table_info(messages)")
+            ]
+            if "receive_count" not in columns:
+                # Created before receives were counted
+                self._db.execute(
+                    "ALTER TABLE messages "
+                    "ADD COLUMN receive_count INTEGER NOT NULL DEFAULT 0"
+                )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS dead_letters ("
+                "id INTEGER PRIMARY KEY, body TEXT NOT NULL, "
+                "receive_count INTEGER NOT NULL, died_at REAL NOT NULL)"
+            )
+
+    def send(self, bodies: List[str], delays: Optional[List[int]] = None):
+        now = time.time()
+        delays = delays or [0] * len(bodies)
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO messages (body, visible_at) VALUES (?, ?)",
+                [(body, now + delay) for body, delay in zip(bodies, delays)],
+            )
+
+    def receive(self, max_messages: int, wait: int) -> List:
+        deadline = time.monotonic() + wait
+        while True:
+            messages = self._receive(max_messages)
+            if messages or time.monotonic() >= deadline:
+                return messages
+            time.sleep(self.poll_interval)
+
+    def _receive(self, max_messages: int) -> List[LocalMessage]:
+        now = time.time()
+        with self._lock:
+            # Take the write lock right away: other processes can't receive
+            # the same messages
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if self.max_receives:
+                    self._bury(now)
+                rows = self._db.execute(
+                    "SELECT id, body, receive_count FROM messages "
+                    "WHERE visible_at <= ? ORDER BY id LIMIT ?",
+                    (now, max_messages),
+                ).fetchall()
+                messages = [
+                    LocalMessage(rowid, uuid.uuid4().hex, body, receive_count + 1)
+                    for rowid, body, receive_count in rows
+                ]
+                self._db.executemany(
+                    "UPDATE messages SET visible_at = ?, receipt = ?, "
+                    "receive_count = ? WHERE id = ?",
+                    [
+                        (
+                            now + self.visibility_timeout,
+                            message.receipt,
+                            message.receive_count,
+                            message.id,
+                        )
+                        for message in messages
+                    ],
+                )
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        return messages
+
+    def _bury(self, now: float):
+        """Move the visible messages received too many times to `dead_letters`"""
+        condition = "visible_at <= ? AND receive_count >= ?"
+        self._db.execute(
+            "INSERT INTO dead_letters (id, body, receive_count, died_at) "
+            f"SELECT id, body, receive_count, ? FROM messages WHERE {condition}",
+            (now, now, self.max_receives),
+        )
+        self._db.execute(
+            f"DELETE FROM messages WHERE {condition}", (now, self.max_receives)
+        )
+
+    def receive_count(self, message: LocalMessage) -> int:
+        return message.receive_count
+
+    def change_visibility(self, message: LocalMessage, timeout: int):
+        with self._lock:
+            self._db.execute(
+                "UPDATE messages SET visible_at = ? WHERE id = ? AND receipt = ?",
+                (time.time() + timeout, message.id, message.receipt),
+            )
+
+    def postpone(self, message: LocalMessage, delay: int):
+        with self._lock:
+            self._db.execute(
+                "UPDATE messages SET visible_at = ?, receive_count = ? "
+                "WHERE id = ? AND receipt = ?",
+                (
+                    time.time() + delay,
+                    message.receive_count - 1,
+                    message.id,
+                    message.receipt,
+                ),
+            )
+
+    def delete(self, messages: List[LocalMessage]):
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM messages WHERE id = ? AND receipt = ?",
+                [(message.id, message.receipt) for message in messages],
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def dead_letters(self) -> List[str]:
+        """Bodies of the messages received too many times, oldest first"""
+        with self._lock:
+            rows = self._db.execute("SELECT body FROM dead_letters ORDER BY id")
+            return [body for body, in rows]
+
+    def __str__(self) -> str:
+        return f"SQLite queue {self.path}"
+
+
+def open_queue(max_connections: int = 10) -> Queue:
+    """Return the queue configured in the environment: an SQLite queue at
+    `PROBOSTITCHER_QUEUE_PATH` if set, the SQS queue `PROBOSTITCHER_QUEUE_NAME`
+    otherwise. SQS clients keep up to `max_connections` connections open.
+    """
+    path = os.environ.get("PROBOSTITCHER_QUEUE_PATH")
+    if path:
+        return SqliteQueue(path)
+    return SqsQueue(
+        os.environ["PROBOSTITCHER_QUEUE_NAME"],
+        os.environ["PROBOSTITCHER_QUEUE_REGION"],
+        max_connections=max_connections,
+    )
@@ -1,22 +1,61 @@
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from typing import Optional
 from urllib.parse import urlparse
 
 import boto3
+import json
 import logging
 import os
+import threading
+import time
 
 
-REGION = os.environ["PROBOSTITCHER_REGION"]
-OUTPUT_BUCKET = os.environ["PROBOSTITCHER_OUTPUT_BUCKET"]
+#: Only needed when storing outputs on S3 (see `storage.get_storage`) or reading inputs from it
+REGION = os.environ.get("PROBOSTITCHER_REGION")
+OUTPUT_BUCKET = os.environ.get("PROBOSTITCHER_OUTPUT_BUCKET")
+#: Size in bytes of the parts of multipart uploads (S3 requires at least 5MiB)
+UPLOAD_PART_SIZE = max(
+    int(os.environ.get("PROBOSTITCHER_UPLOAD_PART_SIZE", 16 * 1024 ** 2)),
+    5 * 1024 ** 2,
+)
+#: Number of parts uploaded at the same time
+UPLOAD_CONCURRENCY = int(os.environ.get("PROBOSTITCHER_UPLOAD_CONCURRENCY", 8))
+#: Seconds to wait for a growing file to grow (see `upload_growing_file`)
+UPLOAD_POLL_INTERVAL = 0.5
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=UPLOAD_PART_SIZE,
+    multipart_chunksize=UPLOAD_PART_SIZE,
+    max_concurrency=UPLOAD_CONCURRENCY,
+)
+#: Maximum number of HTTP connections kept open by the shared S3 client
+MAX_POOL_CONNECTIONS = int(os.environ.get("PROBOSTITCHER_MAX_POOL_CONNECTIONS", 50))
+# Creating clients from the default boto3 session is not thread safe
+_CLIENT_LOCK = threading.Lock()
+_CLIENT = None
 
 
 def get_boto_client():
-    return boto3.client(
-        "s3",
-        endpoint_url=f"https://s3.{REGION}.amazonaws.com",
-        config=Config(signature_version="s3v4", region_name=REGION),
-    )
+    """Return the S3 client shared by all threads of the process.
+    Clients are thread safe once created, and reuse their connections.
+    """
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = boto3.client(
+                "s3",
+                endpoint_url=f"https://s3.{REGION}.amazonaws.com",
+                config=Config(
+                    signature_version="s3v4",
+                    region_name=REGION,
+                    max_pool_connections=MAX_POOL_CONNECTIONS,
+                ),
+            )
+        return _CLIENT
 
 
 def create_presigned_url(url: str, expiration: int = 3600) -> str:
@@ -38,9 +77,152 @@ def create_presigned_url(url: str, expiration: int = 3600) -> str:
     return response
 
 
+def get_etag(url: str) -> str:
+    """Return the ETag of the object at the given s3:// URL"""
+    parsed_url = urlparse(url)
+    response = get_boto_client().head_object(
+        Bucket=parsed_url.netloc, Key=parsed_url.path[1:]
+    )
+    return response["ETag"]
+
+
+def download_url(url: str, destination: str):
+    """Download the object at the given s3:// URL"""
+    parsed_url = urlparse(url)
+    get_boto_client().download_file(parsed_url.netloc, parsed_url.path[1:], destination)
+
+
+def download(object_key: str, destination: str) -> bool:
+    """Download an object from the output bucket. Returns False if it does not exist."""
+    try:
+        get_boto_client().download_file(OUTPUT_BUCKET, object_key, destination)
+    except ClientError:
+        return False
+    return True
+
+
+def upload(filename: str, object_key: str):
+    """Upload a file to the output bucket, in parallel parts if it's big enough"""
+    start = time.monotonic()
+    try:
+        get_boto_client().upload_file(
+            filename, OUTPUT_BUCKET, object_key, Config=TRANSFER_CONFIG
+        )
+    except ClientError as e:
+        logging.error(e)
+        raise
+    report_upload(object_key, os.path.getsize(filename), start)
+
+
+def upload_growing_file(
+    filename: str,
+    object_key: str,
+    writer: Future,
+    part_size: int = UPLOAD_PART_SIZE,
+    concurrency: int = UPLOAD_CONCURRENCY,
+):
+    """Upload a file to the output bucket while it's being written.
+    The file must only be appended to until `writer` is done. Parts are uploaded
+    as soon as they're complete, the rest once `writer` is done.
+    If `writer` fails the upload is aborted and its exception raised.
+    """
+    client = get_boto_client()
+    upload_id = client.create_multipart_upload(Bucket=OUTPUT_BUCKET, Key=object_key)[
+        "UploadId"
+    ]
+
+    def upload_part(number: int, offset: int, size: int) -> Dict:
+        with open(filename, "rb") as fh:
+            fh.seek(offset)
+            data = fh.read(size)
+        response = client.upload_part(
+            Bucket=OUTPUT_BUCKET,
+            Key=object_key,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=data,
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    start = time.monotonic()
+    offset = 0
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            futures = []
+            while True:
+                # Check before looking at the size, so that we don't miss the last bytes
+                finished = writer.done()
+                try:
+                    size = os.path.getsize(filename)
+                except FileNotFoundError:
+                    size = 0
+                if finished or size - offset >= part_size:
+                    # The last part is the only one allowed to be smaller
+                    while size - offset >= part_size or (
+                        finished and (offset < size or not futures)
+                    ):
+                        length = min(part_size, size - offset)
+                        futures.append(
+                            executor.submit(
+                                upload_part, len(futures) + 1, offset, length
+                            )
+                        )
+                        offset += length
+                if finished:
+                    break
+                time.sleep(UPLOAD_POLL_INTERVAL)
+            writer.result()
+            parts = [future.result() for future in futures]
+        client.complete_multipart_upload(
+            Bucket=OUTPUT_BUCKET,
+            Key=object_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except BaseException:
+        client.abort_multipart_upload(
+            Bucket=OUTPUT_BUCKET, Key=object_key, UploadId=upload_id
+        )
+        raise
+    report_upload(object_key, offset, start)
+
+
+def report_upload(object_key: str, size: int, start: float):
+    elapsed = time.monotonic() - start
+    megabytes = size / 1024 ** 2
+    print(
+        f"Uploaded {object_key}: {megabytes:.1f}MiB in {elapsed:.1f}s "
+        f"({megabytes / max(elapsed, 0.001):.1f}MiB/s)"
+    )
+
+
+def put_json(object_key: str, value: Dict):
+    """Store `value` as a JSON object in the output bucket"""
+    get_boto_client().put_object(
+        Bucket=OUTPUT_BUCKET,
+        Key=object_key,
+        Body=json.dumps(value).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def get_json(object_key: str) -> Optional[Dict]:
+    """Return the JSON object stored in the output bucket, or None if it does not exist"""
+    try:
+        response = get_boto_client().get_object(Bucket=OUTPUT_BUCKET, Key=object_key)
+    except ClientError:
+        return None
+    return json.loads(response["Body"].read())
+
+
 def exists(object_key: str) -> bool:
     try:
         get_boto_client().head_object(Bucket=OUTPUT_BUCKET, Key=object_key)
     except ClientError:
         return False
     return True
+
+
+def delete(object_key: str):
+    """Delete an object from the output bucket. Deleting a missing object is not an error"""
+    get_boto_client().delete_object(Bucket=OUTPUT_BUCKET, Key=object_key)
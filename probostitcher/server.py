@@ -2,21 +2,45 @@
 """
 from pathlib import Path
 from probostitcher import Specs
-from probostitcher.s3 import create_presigned_url
-from probostitcher.s3 import OUTPUT_BUCKET
-from probostitcher.validation import validate_specs_schema
+from probostitcher.profiles import ENCODER_PROFILE
+from probostitcher.progress import get_job
+from probostitcher.progress import JobProgress
+from probostitcher.progress import prometheus_metrics
+from probostitcher.storage import get_storage
+from probostitcher.storage import LocalStorage
+from probostitcher.storage import STORAGE_ERRORS
+from probostitcher.validation import validate_specs
 from probostitcher.worker import get_queue
-from probostitcher.worker import QUEUE_NAME
-from probostitcher.worker import QUEUE_REGION
+from probostitcher.worker import main as run_worker
+from probostitcher.worker import STATUS_INTERVAL
+from socketserver import ThreadingMixIn
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from wsgiref.simple_server import make_server
+from wsgiref.simple_server import WSGIRequestHandler
+from wsgiref.simple_server import WSGIServer
 
 import bottle
 import json
 import os
 import probostitcher
-import uuid
+import threading
+import time
 
 
 PORT = os.environ.get("PROBOSTITCHER_SERVER_PORT", 8000)
+#: Seconds after which an event stream is closed, even if the job is still running.
+#: Browsers reconnect automatically.
+EVENTS_TIMEOUT = 600
+#: Job states after which the status does not change any more
+FINAL_STATES = ("done", "failed")
+#: Job states in which submitting the job again leaves its status as is
+ACTIVE_STATES = ("queued", "rendering")
+#: If set, the server also processes jobs, as a worker would
+EMBEDDED_WORKER = bool(os.environ.get("PROBOSTITCHER_EMBEDDED_WORKER"))
 bottle.TEMPLATE_PATH.append(str(Path(__file__).parent / "templates"))
 TEST_FILES_DIR = Path(probostitcher.__file__).parent / "test-files"
 STATIC_FILES_ROOT = Path(probostitcher.__file__).parent / "static"
@@ -26,15 +50,13 @@ STATIC_FILES_ROOT = Path(probostitcher.__file__).parent / "static"
 @bottle.view("server")
 def index():
     specs_json = bottle.request.forms.get("specs")
-    errors = []
-    video_url = ""
+    errors: List[str] = []
+    video_url = events_url = ""
     if specs_json:
-        errors, specs = validate_specs(specs_json)
-        if not errors:
-            submit_job(specs)
-            video_url = create_presigned_url(
-                f"s3://{OUTPUT_BUCKET}/output/{specs.output_filename}", expiration=86400
-            )
+        errors, specs = create_job(specs_json)
+        if specs is not None:
+            video_url = output_url(specs)
+            events_url = f"/jobs/{specs.job_id}/events"
             message = "Job has been sumbitted. Results will be available "
             message += f'<a href="{video_url}">here</a>'
         else:
@@ -47,51 +69,209 @@ def index():
         "message": message,
         "errors": errors,
         "video_url": video_url,
+        "events_url": events_url,
         "json": json,
     }
 
 
+@bottle.route("/metrics")
+def metrics():
+    """Progress of the jobs running in this process, in Prometheus text format"""
+    bottle.response.content_type = "text/plain; version=0.0.4"
+    return prometheus_metrics()
+
+
+@bottle.route("/jobs", method="POST")
+def post_job():
+    """Submit the JSON specs in the request body. Responds right away with the
+    job id and the URLs where its progress and its output can be found.
+    """
+    errors, specs = create_job(bottle.request.body.read().decode("utf-8"))
+    if specs is None:
+        bottle.response.status = 400
+        return {"errors": errors}
+    bottle.response.status = 202
+    return {
+        "job_id": specs.job_id,
+        "status_url": f"/jobs/{specs.job_id}",
+        "events_url": f"/jobs/{specs.job_id}/events",
+        "video_url": output_url(specs),
+    }
+
+
+@bottle.route("/jobs/<job_id>")
+def job_status(job_id):
+    """Progress of a job: from this process if it's running here,
+    otherwise the last status the worker running it published.
+    """
+    status = get_status(job_id)
+    if status is None:
+        raise bottle.HTTPError(404, f"Unknown job {job_id}")
+    return status
+
+
+@bottle.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    """Stream the status of a job as server-sent events, one every time it changes,
+    until the job is done or has failed.
+    """
+    bottle.response.content_type = "text/event-stream"
+    bottle.response.set_header("Cache-Control", "no-cache")
+    return status_events(job_id)
+
+
+def status_events(
+    job_id: str, interval: float = STATUS_INTERVAL, timeout: float = EVENTS_TIMEOUT
+) -> Iterator[str]:
+    deadline, last = time.monotonic() + timeout, None
+    # Tell browsers how long to wait before reconnecting
+    yield f"retry: {int(interval * 1000)}\n\n"
+    while time.monotonic() < deadline:
+        status = get_status(job_id)
+        if status != last:
+            yield f"data: {json.dumps(status)}\n\n"
+            last = status
+        else:
+            # Comments keep the connection open, and tell us if the client left
+            yield ": waiting\n\n"
+        if status is not None and status["state"] in FINAL_STATES:
+            return
+        time.sleep(interval)
+
+
+class StatusCache:
+    """Statuses published by workers, fetched at most once every `max_age` seconds
+    per job however many clients are following it.
+    """
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self._statuses: Dict[str, Tuple[float, Optional[Dict]]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            lock = self._locks.setdefault(job_id, threading.Lock())
+        # Clients following the same job wait for a single request
+        with lock:
+            fetched, status = self._statuses.get(job_id, (0.0, None))
+            now = time.monotonic()
+            if now - fetched > self.max_age:
+                status = get_storage().get_json(f"status/{job_id}.json")
+                with self._lock:
+                    self._statuses[job_id] = now, status
+                    self._forget_older_than(now - 100 * self.max_age)
+            return status
+
+    def _forget_older_than(self, moment: float):
+        for job_id, (fetched, _) in list(self._statuses.items()):
+            if fetched < moment:
+                del self._statuses[job_id]
+                self._locks.pop(job_id, None)
+
+
+STATUS_CACHE = StatusCache(STATUS_INTERVAL)
+
+
+def get_status(job_id: str) -> Optional[Dict]:
+    job = get_job(job_id)
+    if job is not None:
+        return job.as_dict()
+    return STATUS_CACHE.get(job_id)
+
+
+def serve_metrics(host: str, port: int):
+    """Serve only the metrics and job status routes (used by workers)"""
+    app = bottle.Bottle()
+    app.route("/metrics")(metrics)
+    app.route("/jobs/<job_id>")(job_status)
+    bottle.run(app, host=host, port=port, quiet=True, server=ThreadingServer)
+
+
 @bottle.route("/static/<filename>")
 def server_static(filename):
     return bottle.static_file(filename, root=STATIC_FILES_ROOT)
 
 
-def validate_specs(specs_json):
-    errors, specs = validate_specs_schema(specs_json), None
+@bottle.route("/storage/<key:path>")
+def stored_object(key):
+    """Serve outputs stored in a local directory (see `storage.LocalStorage`)"""
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        return bottle.HTTPError(404)
+    return bottle.static_file(key, root=str(storage.directory))
+
+
+def create_job(specs_json: str) -> Tuple[List[str], Optional[Specs]]:
+    """Validate the specs and submit them to the queue, unless their video
+    was rendered already. The status of a job that's already queued or rendering
+    is left as is. Returns the validation errors (or storage errors), and
+    the specs if they were valid.
+    """
+    errors = validate_specs(specs_json)
     if errors:
-        return errors, specs
+        return errors, None
+    # Workers may default to another encoder profile: submit the one we'd use,
+    # so that the job is identified by the video it renders
+    config = json.loads(specs_json)
+    config.setdefault("encoder_profile", ENCODER_PROFILE)
+    # Inputs are probed by the worker: this doesn't touch them
+    specs = Specs(filecontents=json.dumps(config))
+    storage, job = get_storage(), JobProgress(specs.job_id)
+    status_key = f"status/{specs.job_id}.json"
     try:
-        specs = Specs(filecontents=specs_json)
-    except Exception as e:
-        errors.append(str(e))
-        return errors, specs
-    for chunk in specs:
-        try:
-            chunk.output("test").compile()
-        except Exception as e:
-            errors.append(str(e))
+        if storage.exists(f"output/{specs.output_filename}"):
+            # Rendered already: don't queue it again, nor report it as queued
+            job.state = "done"
+            storage.put_json(status_key, job.as_dict())
+            return errors, specs
+        status = storage.get_json(status_key)
+        # Workers skip duplicate messages, but clients following the job
+        # must not see its progress reset
+        if status is None or status["state"] not in ACTIVE_STATES:
+            storage.put_json(status_key, job.as_dict())
+    except STORAGE_ERRORS as e:
+        return [f"Could not store the job status: {e}"], None
+    submit_job(specs)
     return errors, specs
 
 
+def output_url(specs: Specs) -> str:
+    return get_storage().url(f"output/{specs.output_filename}", expiration=86400)
+
+
 def submit_job(specs: Specs):
     queue = get_queue()
-    queue.send_message(
-        MessageBody=specs.filecontents,
-        MessageGroupId=uuid.uuid4().hex,
-        # MessageGroupId=specs.output_filename,
-        # Maybe we should reconsider this: we use the hash of the specs to prevent message
-        # duplication; it means we won't be able to resubmit the very same job twice.
-        # We comment it out for now, to be able to repeatedly test the same specs
-        # MessageDeduplicationId=specs.output_filename,
-        # But we need to provide a value, since without it we get the error:
-        # The queue should either have ContentBasedDeduplication enabled or MessageDeduplicationId provided explicitly
-        MessageDeduplicationId=uuid.uuid4().hex,
-    )
-    print(f"Submitted job to queue {QUEUE_NAME} in {QUEUE_REGION}")
+    queue.send([specs.filecontents])
+    print(f"Submitted job to {queue}")
+
+
+class ThreadingServer(bottle.ServerAdapter):
+    """Like bottle's default server, but handling every request in its own thread,
+    so that slow requests and event streams don't hold up other clients.
+    """
+
+    def run(self, app):
+        class Server(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        class Handler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                if not self.server.quiet:
+                    super().log_request(*args, **kwargs)
+
+        server = make_server(
+            self.host, self.port, app, server_class=Server, handler_class=Handler
+        )
+        server.quiet = self.quiet
+        server.serve_forever()
 
 
 def main():
-    bottle.run(host="localhost", port=PORT)
+    if EMBEDDED_WORKER:
+        threading.Thread(target=run_worker, name="worker", daemon=True).start()
+    bottle.run(host="localhost", port=PORT, server=ThreadingServer)
 
 
 if __name__ == "__main__":
@@ -1,34 +1,168 @@
-from botocore.exceptions import ClientError
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from ffmpeg.nodes import FilterableStream
+from functools import lru_cache
+from hashlib import sha256
 from hashlib import sha512
-from multiprocessing import Pool
 from pathlib import Path
 from pendulum import DateTime
 from pendulum import Period
+from probostitcher.admission import BASE_MEMORY
+from probostitcher.admission import Cost
+from probostitcher.admission import default_cost
+from probostitcher.admission import MEASUREMENTS
+from probostitcher.cache import CHUNK_CACHE
+from probostitcher.cache import INPUT_CACHE
+from probostitcher.cache import link_or_copy
+from probostitcher.cache import PROBE_CACHE
+from probostitcher.coverage import Coverage
+from probostitcher.executor import Batch
+from probostitcher.executor import FfmpegPool
+from probostitcher.executor import get_pool
+from probostitcher.graph import black
+from probostitcher.graph import Track
+from probostitcher.profiles import ENCODER_PROFILE
+from probostitcher.profiles import EncoderProfile
+from probostitcher.profiles import PROFILES
+from probostitcher.profiles import thread_budget
+from probostitcher.progress import FfmpegError
+from probostitcher.progress import JobProgress
+from probostitcher.progress import TaskProgress
+from probostitcher.progress import track_job
 from probostitcher.s3 import create_presigned_url
-from probostitcher.s3 import get_boto_client
-from probostitcher.s3 import OUTPUT_BUCKET
+from probostitcher.s3 import download_url
+from probostitcher.s3 import get_etag
+from probostitcher.storage import get_storage
+from typing import Callable
 from typing import Dict
+from typing import Iterable
 from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Tuple
 
 import ffmpeg
 import json
-import logging
+import math
 import os
+import probostitcher.executor
+import probostitcher.graph
+import probostitcher.profiles
+import probostitcher.progress
+import queue
 import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import urllib.request
 
 
 FFPROBE_TIMEOUT = 10
+#: How many times probing a remote input is retried
+FFPROBE_RETRIES = 2
+#: Seconds to wait before the first retry; doubles at every attempt
+FFPROBE_BACKOFF = 1
+#: Maximum number of inputs probed at the same time
+PROBE_CONCURRENCY = int(os.environ.get("PROBOSTITCHER_PROBE_CONCURRENCY", 8))
+#: Milestones longer than this many seconds are split into several chunks.
+#: Zero disables splitting.
+SEGMENT_DURATION = int(os.environ.get("PROBOSTITCHER_SEGMENT_DURATION", 30))
+#: If set, the final video is rendered without intermediate files
+STREAMING = bool(os.environ.get("PROBOSTITCHER_STREAMING"))
+IVF_HEADER_SIZE = 32
+#: Time base of the IVF streams chunks are piped as, the one of WebM files
+IVF_TIME_BASE = "1/1000"
+STREAM_BUFFER_SIZE = 64 * 1024
+#: If set, rendered chunks are also stored in the output bucket, under `chunks/`.
+#: The worker always does this, so that retried jobs can resume.
+CHUNK_CACHE_S3 = bool(os.environ.get("PROBOSTITCHER_CHUNK_CACHE_S3"))
+#: If set, remote inputs are downloaded once before rendering (see `Specs.prefetch_inputs`)
+PREFETCH_INPUTS = bool(os.environ.get("PROBOSTITCHER_PREFETCH_INPUTS"))
+DOWNLOAD_TIMEOUT = 30
+#: If set, the final video is uploaded while it's being written (see `Specs.upload`)
+UPLOAD_WHILE_RENDERING = bool(os.environ.get("PROBOSTITCHER_UPLOAD_WHILE_RENDERING"))
+#: Maximum number of pieces of a distributed job downloaded at the same time
+FETCH_CONCURRENCY = 8
+#: Unless set, milestones showing a single input which is already encoded like the
+#: output are mostly stream copied instead of encoded again (see `Specs._splice`)
+STREAM_COPY = not os.environ.get("PROBOSTITCHER_DISABLE_STREAM_COPY")
+#: Stream copy only spans between keyframes at least this many seconds apart
+STREAM_COPY_MIN_DURATION = 4
+#: Rendering a chunk is given up after this many seconds per second of video
+#: in it, and at least CHUNK_TIMEOUT_MIN. Zero disables timeouts.
+CHUNK_TIMEOUT_RATIO = float(os.environ.get("PROBOSTITCHER_CHUNK_TIMEOUT_RATIO", 30))
+CHUNK_TIMEOUT_MIN = 300
+#: Source files whose changes alter the output: their hash is part of output filenames
+RENDERING_MODULES = (
+    __file__,
+    probostitcher.graph.__file__,
+    probostitcher.profiles.__file__,
+)
+
+
+class Chunk:
+    """A time slice of the output video, rendered by a single ffmpeg process"""
+
+    #: Index of the milestone this chunk belongs to
+    milestone: int
+    #: Start of the chunk in seconds since the output start
+    start: float
+    #: End of the chunk in seconds since the output start
+    end: float
+    #: Number of videos composed in this chunk
+    videos: int
+    #: The stream producing the video of this chunk
+    stream: FilterableStream
+    #: If True `stream` is an input stream, copied instead of encoded
+    copy: bool
+    #: If set, the chunk is rendered as these consecutive chunks joined together,
+    #: instead of from `stream` (see `Specs._splice`)
+    pieces: Optional[List["Chunk"]]
+
+    def __init__(
+        self,
+        milestone: int,
+        start: float,
+        end: float,
+        videos: int,
+        stream: FilterableStream,
+        copy: bool = False,
+        pieces: Optional[List["Chunk"]] = None,
+    ):
+        self.milestone = milestone
+        self.start = start
+        self.end = end
+        self.videos = videos
+        self.stream = stream
+        self.copy = copy
+        self.pieces = pieces
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    @property
+    def cost(self) -> float:
+        """A rough estimate of how expensive rendering this chunk is"""
+        if self.copy:
+            # Copying packets costs next to nothing
+            return 0.0
+        if self.pieces is not None:
+            return sum(piece.cost for piece in self.pieces)
+        return self.duration * self.videos
+
+    def __repr__(self) -> str:
+        return f"<Chunk {self.start}-{self.end} milestone={self.milestone}>"
 
 
 class Specs:
     """Represents a JSON file and accompanying video/audio files.
     Instantiate passing the JSON file path as the only argument to `__init__`.
+    Inputs are probed, and the ffmpeg graphs built, only when first needed.
     """
 
     #: The string representing the JSON specs
@@ -37,29 +171,67 @@ class Specs:
     config: Dict
     #: A dictionary containing info about input track files, extracted from self.config["inputs"]
     inputs: Dict[str, Dict[str, str]]
-    #: A dictionary containing ffmpeg analysis of the given input
-    inputs_infos: Dict[str, Dict]
     #: Pendulum Period indicating the time span the output should show
     output_period: Period
-    #: Chunks that will make up the final video
-    video_chunks: List[FilterableStream]
-    #: The audio track of the output
-    audio_track: FilterableStream
     #: If True debug infos will be printed out during conversion
     debug: bool
+    #: Settings video chunks are encoded with (see `profiles.PROFILES`)
+    encoder_profile: EncoderProfile
     #: Path to the directory where temporary files are stored
     tmp_dir: Path
-    #: Number of ffmpeg processes to run in parallel
-    parallelism: int
+    #: Number of ffmpeg processes to run in parallel.
+    #: If None the process-wide pool with FFMPEG_SLOTS slots is used
+    parallelism: Optional[int]
+    #: Number of ffprobe processes to run in parallel
+    probe_concurrency: int
+    #: If True inputs are trimmed by seeking the demuxer instead of using the `trim` filter
+    seek_inputs: bool
+    #: Maximum length in seconds of a chunk. Zero means one chunk per milestone
+    segment_duration: int
+    #: If True rendered chunks are stored in (and reused from) CHUNK_CACHE
+    use_chunk_cache: bool
+    #: If True ffprobe results are stored in (and reused from) PROBE_CACHE
+    use_probe_cache: bool
+    #: If True the final video is rendered without intermediate files (see `render_streaming`)
+    streaming: bool
+    #: If True every chunk is uploaded to the output bucket as soon as it's rendered,
+    #: and chunks found there are not rendered again
+    checkpoint_chunks: bool
+    #: If True remote inputs are downloaded before being probed, and ffmpeg reads
+    #: the local copies. Copies of S3 objects are kept in INPUT_CACHE
+    prefetch_inputs: bool
+    #: If True `upload` starts uploading the final video while it's being rendered
+    upload_while_rendering: bool
+    #: If True chunks showing a single input already encoded like the output
+    #: copy it between keyframes, and only encode the edges (see `_splice`)
+    stream_copy: bool
+    #: Wall clock seconds spent in each phase: probe, graph, chunks, concat, mux
+    #: (or stream, when streaming)
+    timings: Dict[str, float]
 
     _output_filename: Optional[str] = None
+    _input_infos: Optional[Dict[str, Dict]] = None
+    _input_identities: Dict[str, Optional[str]]
+    _coverage: Optional[Coverage] = None
+    _chunks: Optional[List[Chunk]] = None
+    _audio_track: Optional[FilterableStream] = None
 
     def __init__(
         self,
         filepath: Optional[str] = None,
         filecontents: Optional[str] = None,
         cleanup: bool = True,
-        parallelism: int = len(os.sched_getaffinity(0)),
+        parallelism: Optional[int] = None,
+        probe_concurrency: int = PROBE_CONCURRENCY,
+        seek_inputs: bool = True,
+        segment_duration: int = SEGMENT_DURATION,
+        use_chunk_cache: bool = True,
+        use_probe_cache: bool = True,
+        streaming: bool = STREAMING,
+        checkpoint_chunks: bool = CHUNK_CACHE_S3,
+        prefetch_inputs: bool = PREFETCH_INPUTS,
+        upload_while_rendering: bool = UPLOAD_WHILE_RENDERING,
+        stream_copy: bool = STREAM_COPY,
     ):
         if filepath is not None:
             self.filepath = Path(filepath)
@@ -71,51 +243,228 @@ class Specs:
             self.filecontents = filecontents
         self.config = json.loads(self.filecontents)
         self.debug = self.config.get("debug", False)
+        self.encoder_profile = PROFILES[
+            self.config.get("encoder_profile", ENCODER_PROFILE)
+        ]
         self.parallelism = parallelism
+        self.probe_concurrency = probe_concurrency
+        self.seek_inputs = seek_inputs
+        self.segment_duration = segment_duration
+        self.use_chunk_cache = use_chunk_cache
+        self.use_probe_cache = use_probe_cache
+        self.streaming = streaming
+        self.timings = {}
+        self._phases = threading.local()
+        self.checkpoint_chunks = checkpoint_chunks
+        self.prefetch_inputs = prefetch_inputs
+        self.upload_while_rendering = upload_while_rendering
+        self.stream_copy = stream_copy
+        if cleanup:
+            self.__tmp_dir = tempfile.TemporaryDirectory(prefix="probostitcher-")
+            self._tmp_dir = Path(self.__tmp_dir.name)
+        else:
+            self._tmp_dir = Path(tempfile.mkdtemp(prefix="probostitcher-"))
         output_start = parse_ts(int(self.config["output_start"]))
         output_end = output_start.add(seconds=self.config["output_duration"])
-        self._presign_s3_urls()
         self.width, self.height = (
             self.config["output_size"]["width"],
             self.config["output_size"]["height"],
         )
         self.inputs = {el["streamname"]: el for el in self.config["inputs"]}
         self.output_period = output_end - output_start
-        self._analyze_files()
-        self._prepare_chunks()
-        self._prepare_audio_track()
-        if cleanup:
-            self.__tmp_dir = tempfile.TemporaryDirectory(prefix="probostitcher-")
-            self._tmp_dir = Path(self.__tmp_dir.name)
-        else:
-            self._tmp_dir = Path(tempfile.mkdtemp(prefix="probostitcher-"))
+        # Inputs are probed, and graphs built, the first time they're needed
+
+    @property
+    def input_infos(self) -> Dict[str, Dict]:
+        """ffprobe analysis of every input, by streamname"""
+        self._analyze_files_once()
+        return self._input_infos  # type: ignore
+
+    @property
+    def input_identities(self) -> Dict[str, Optional[str]]:
+        """Strings identifying the contents of each input (see `input_identity`)"""
+        self._analyze_files_once()
+        return self._input_identities
+
+    @property
+    def coverage(self) -> Coverage:
+        """Spans of time covered by every input, by streamname"""
+        if self._coverage is None:
+            self._coverage = Coverage(
+                {
+                    streamname: timestamps(get_input_period(input_info))
+                    for streamname, input_info in self.input_infos.items()
+                }
+            )
+        return self._coverage
+
+    @property
+    def chunks(self) -> List[Chunk]:
+        """Chunks that will make up the final video"""
+        if self._chunks is None:
+            with self.timed("graph"):
+                self._prepare_chunks()
+        return self._chunks  # type: ignore
+
+    @property
+    def audio_track(self) -> FilterableStream:
+        """The audio track of the output"""
+        if self._audio_track is None:
+            with self.timed("graph"):
+                self._prepare_audio_track()
+        return self._audio_track
 
     @property
     def output_filename(self):
-        """The output filename is hashed from this file contents and specs contents.
-        This way we can make sure to not compile the same video twice.
+        """The output filename is hashed from the rendering code and the canonical specs
+        (see `canonical_specs`). This way we can make sure to not compile the same video twice.
         """
         if self._output_filename is None:
-            specs_file_hash = self._output_filename = sha512(
-                self.filecontents.encode("utf-8")
-            ).hexdigest()
-            this_file_contents = open(__file__).read().encode("utf-8")
-            this_file_hash = self._output_filename = sha512(
-                this_file_contents
-            ).hexdigest()
-            self._output_filename = f"{this_file_hash[:4]}-{specs_file_hash[:12]}.webm"
+            specs_hash = sha512(self.canonical_specs.encode("utf-8")).hexdigest()
+            self._output_filename = f"{code_hash()[:4]}-{specs_hash[:12]}.webm"
         return self._output_filename
 
+    @property
+    def canonical_specs(self) -> str:
+        """The specs as originally given, with relative paths resolved, in canonical form.
+        S3 inputs appear with their `s3://` URL, even after they've been presigned.
+        """
+        config = json.loads(self.filecontents)
+        for input_specs in config["inputs"]:
+            input_specs["filename"] = self.absolute_path(input_specs["filename"])
+        return canonical_specs(config)
+
+    @property
+    def job_id(self) -> str:
+        """Identifies the job rendering these specs: the output filename without extension"""
+        return self.output_filename.rsplit(".", 1)[0]
+
+    @property
+    def progress(self) -> JobProgress:
+        """Live progress of the ffmpeg processes rendering these specs"""
+        return track_job(self.job_id)
+
     def _prepare_chunks(self):
+        """Prepare the chunks making up the output video (see `chunk_periods`)"""
+        chunks = []
+        for i, start, end in self.chunk_periods():
+            milestone = self.config["milestones"][i]
+            chunks.append(
+                Chunk(
+                    milestone=i,
+                    start=start,
+                    end=end,
+                    videos=len(milestone["videos"]),
+                    stream=self._prepare_chunk(milestone, start, end),
+                    pieces=self._splice(i, start, end),
+                )
+            )
+        self._chunks = chunks
+
+    def _splice(self, index: int, start: float, end: float) -> Optional[List[Chunk]]:
+        """Return the pieces of the chunk between `start` and `end` of milestone
+        number `index`, if it can be mostly stream copied: the packets between
+        the first and the last keyframes in the chunk are copied, and only the
+        edges before and after them are encoded.
+        This is possible when the milestone shows a single input at the output
+        size, already encoded with the output codec, size and frame rate,
+        covering the whole chunk. Returns None otherwise.
+        """
+        milestone = self.config["milestones"][index]
+        if not self.stream_copy or self.streaming or self.debug:
+            return None
+        if len(milestone["videos"]) != 1:
+            return None
+        video_specs = milestone["videos"][0]
+        streamname = video_specs["streamname"]
+        placement = (
+            video_specs.get("x", 0),
+            video_specs.get("y", 0),
+            video_specs.get("width", self.width),
+            video_specs.get("height", self.height),
+        )
+        if placement != (0, 0, self.width, self.height):
+            return None
+        if not self.is_encoded_like_output(streamname):
+            return None
+        input_start, input_end = self.coverage.spans[streamname]
+        period_start, period_end = timestamps(
+            Period(start=self.ts(start), end=self.ts(end))
+        )
+        if input_start > period_start or input_end < period_end:
+            return None
+        keyframes = [
+            keyframe
+            for keyframe in self.keyframes(
+                streamname, period_start - input_start, period_end - input_start
+            )
+            if period_start <= input_start + keyframe <= period_end
+        ]
+        if not keyframes or keyframes[-1] - keyframes[0] < STREAM_COPY_MIN_DURATION:
+            return None
+        # Chunk times of the copied span: the output starts at `self.ts(0)`
+        output_start = self.ts(0).timestamp()
+        copy_start = input_start + keyframes[0] - output_start
+        copy_end = input_start + keyframes[-1] - output_start
+        # Seek exactly to the keyframe ffprobe reported, so that no earlier one is used
+        copy_stream = ffmpeg.input(
+            self.absolute_path(self.inputs[streamname]["filename"]),
+            ss=f"{keyframes[0]:f}",
+            t=f"{keyframes[-1] - keyframes[0]:f}",
+        ).video
+        pieces = []
+        if copy_start > start:
+            stream = self._prepare_chunk(milestone, start, copy_start)
+            pieces.append(Chunk(index, start, copy_start, 1, stream))
+        pieces.append(Chunk(index, copy_start, copy_end, 1, copy_stream, copy=True))
+        if copy_end < end:
+            stream = self._prepare_chunk(milestone, copy_end, end)
+            pieces.append(Chunk(index, copy_end, end, 1, stream))
+        return pieces
+
+    def is_encoded_like_output(self, streamname: str) -> bool:
+        """True if the video of the input can be copied to the output as it is:
+        same codec, size, frame rate and pixel format. Every profile encodes VP9,
+        so VP8 recordings (like the ones Janus makes) are never copied.
+        """
+        stream = self.input_infos[streamname]["streams"][0]
+        fps = self.config.get("output_framerate", 25)
+        return (
+            stream.get("codec_name") == self.encoder_profile.codec_name
+            and (stream.get("width"), stream.get("height")) == (self.width, self.height)
+            and stream.get("r_frame_rate") == f"{fps}/1"
+            and stream.get("pix_fmt") == "yuv420p"
+        )
+
+    def keyframes(self, streamname: str, start: float, end: float) -> List[float]:
+        """Times of the keyframes of the input from `start` to `end` (excluded),
+        in seconds from its start. Only that part of the input is read. The one
+        before `start` may be included. Cached like the ffprobe analysis.
+        """
+        identity = self.input_identities[streamname]
+        use_cache = identity is not None and self.use_probe_cache
+        key = f"{identity}-keyframes-{start:f}-{end:f}"
+        result = PROBE_CACHE.get_json(key) if use_cache else None
+        if result is None:
+            filename = self.absolute_path(self.inputs[streamname]["filename"])
+            offset = float(self.input_infos[streamname]["format"].get("start_time", 0))
+            keyframes = probe_keyframes(
+                filename, offset + start, offset + end, log=self.print
+            )
+            result = {"keyframes": [keyframe - offset for keyframe in keyframes]}
+            if use_cache:
+                PROBE_CACHE.put_json(key, result)
+        return result["keyframes"]
+
+    def chunk_periods(self) -> List[Tuple[int, float, float]]:
+        """Return milestone index, start and end of every chunk: one per milestone,
+        or more if the milestone is longer than `self.segment_duration`.
+        Inputs are not needed to compute them.
+        """
         assert self.config["milestones"][0]["timestamp"] == 0
-        self.video_chunks = []
+        result = []
         howmany = len(self.config["milestones"])
-        default_width, default_height = (
-            self.config["output_size"]["width"],
-            self.config["output_size"]["height"],
-        )
         for i in range(howmany):
-            # Prepare chunk i
             milestone = self.config["milestones"][i]
             is_last = i == howmany - 1
             if is_last:  # This is the last milestone
@@ -123,67 +472,118 @@ class Specs:
             else:
                 end = self.config["milestones"][i + 1]["timestamp"]
             start = milestone["timestamp"]
-            chunk = None
-            for video_specs in milestone["videos"]:
-                # Trim/resize the videos of this chunk
-                period = Period(start=self.ts(start), end=self.ts(end))
-                track = self.trim_to_period(video_specs["streamname"], period)
-                # Resize the video
-                width, height = (
-                    video_specs.get("width", default_width),
-                    video_specs.get("height", default_height),
-                )
-                track = scale_to(track, width, height)
-                # Overlay it over what we have so far
-                if chunk is None:
-                    chunk = track
-                else:
-                    x, y = video_specs.get("x", 0), video_specs.get("y", 0)
-                    track = track.filter("setpts", "PTS-STARTPTS")
-                    chunk = chunk.overlay(track, x=x, y=y)
-            if self.debug:
-                video_begin = self.config["output_start"] / 1000 ** 2
-                video_begin += milestone["timestamp"]
-                chunk = chunk.filter(
-                    "drawtext",
-                    fontfile="FreeSans.ttf",
-                    fontcolor="white",
-                    shadowcolor="black",
-                    shadowx="1",
-                    shadowy="2",
-                    text="%{pts:gmtime:" + str(video_begin) + "}",
-                    fontsize="20",
-                    x="0",
-                    y="h-th",
-                )
-            self.video_chunks.append(chunk)
+            for segment_start, segment_end in split_segments(
+                start, end, self.segment_duration
+            ):
+                result.append((i, segment_start, segment_end))
+        return result
+
+    def _prepare_chunk(
+        self, milestone: Dict, start: float, end: float
+    ) -> FilterableStream:
+        """Return a stream with the videos of `milestone` laid out
+        between `start` and `end` (in seconds from the output start).
+        Videos not covering any part of the chunk are replaced by black frames,
+        without reading their input.
+        """
+        default_width, default_height = (
+            self.config["output_size"]["width"],
+            self.config["output_size"]["height"],
+        )
+        period = Period(start=self.ts(start), end=self.ts(end))
+        covered = set(self.coverage.overlapping(*timestamps(period)))
+        fps = self.config.get("output_framerate", 25)
+        chunk = None
+        for video_specs in milestone["videos"]:
+            # Trim/resize the videos of this chunk
+            width, height = (
+                video_specs.get("width", default_width),
+                video_specs.get("height", default_height),
+            )
+            if video_specs["streamname"] in covered:
+                track = self.track(
+                    video_specs["streamname"], period, width, height
+                ).build()
+            else:
+                track = black(width, height, end - start, fps)
+            # Overlay it over what we have so far
+            if chunk is None:
+                chunk = track
+            else:
+                x, y = video_specs.get("x", 0), video_specs.get("y", 0)
+                track = track.filter("setpts", "PTS-STARTPTS")
+                chunk = chunk.overlay(track, x=x, y=y)
+        if self.debug:
+            video_begin = self.config["output_start"] / 1000 ** 2
+            video_begin += start
+            chunk = chunk.filter(
+                "drawtext",
+                fontfile="FreeSans.ttf",
+                fontcolor="white",
+                shadowcolor="black",
+                shadowx="1",
+                shadowy="2",
+                text="%{pts:gmtime:" + str(video_begin) + "}",
+                fontsize="20",
+                x="0",
+                y="h-th",
+            )
+        return chunk
 
     def trim_to_period(self, streamname: str, period: Period) -> FilterableStream:
         """Trim the given streamname to match the given Period.
         Black screen will be introduced if the given period is not fully covered by the given input.
         """
+        return self.track(streamname, period).build()
+
+    def track(
+        self,
+        streamname: str,
+        period: Period,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+    ) -> Track:
+        """Return a Track with the given streamname trimmed to match the given Period,
+        and scaled to fit `width`x`height` if given.
+        Black screen will be introduced if the given period is not fully covered by the given input.
+        Unless `self.seek_inputs` is False the input is trimmed by the demuxer,
+        so that only the frames in the period are decoded.
+        """
         filename = self.absolute_path(self.inputs[streamname]["filename"])
-        input = ffmpeg.input(filename)
         input_info = self.input_infos[streamname]
         input_period = get_input_period(input_info)
+        input_options = {}
+        seek = 0.0
+        if self.seek_inputs:
+            if input_period.start < period.start:
+                seek = duration(period.start - input_period.start)
+                input_options["ss"] = f"{seek:f}"
+                input_options["accurate_seek"] = None
+            if input_period.end > period.end:
+                read_duration = duration(
+                    period.end - max(period.start, input_period.start)
+                )
+                input_options["t"] = f"{read_duration:f}"
+        input = ffmpeg.input(filename, **input_options)
 
-        width = input_info["streams"][0]["width"]
-        height = input_info["streams"][0]["height"]
-        size = f"{width}x{height}"
+        track = Track(
+            input,
+            width=input_info["streams"][0]["width"],
+            height=input_info["streams"][0]["height"],
+        )
         # XXX This will possibly unnecessarily downscale a video
         # It's necessary because the size ffprobe reports is the one detected at the start of the video
         # Ideally we should check all frame sizes and use the biggest one here
         # That we instead of losing precious information (image detail) we would be wasting some CPU cycles
-        input = input.filter(
-            "scale",
-            size=f"{width}:{height}",
-            force_original_aspect_ratio="decrease",
-        )
+        # When a size is requested the Track replaces this with a single scale to that size
+        track.scale(track.width, track.height)
+        if width is not None and height is not None:
+            track.scale(width, height).pad(width, height)
 
         if self.debug:
             # Add timestamp at the top
-            video_begin = input_period.start.timestamp()
-            input = input.filter(
+            video_begin = input_period.start.timestamp() + seek
+            track.filter(
                 "drawtext",
                 fontfile="FreeSerif.ttf",
                 fontcolor="white",
@@ -194,83 +594,190 @@ class Specs:
                 fontsize="20",
             )
 
+        fps = self.config.get("output_framerate", 25)
         if input_period.start < period.start:
             # We need to trim our input: it starts earlier than needed
-            input = input.trim(
-                start=duration(period.start - input_period.start)
-            ).filter("setpts", "PTS-STARTPTS")
+            if not self.seek_inputs:
+                track.trim(start=duration(period.start - input_period.start))
+            track.filter("setpts", "PTS-STARTPTS")
         elif input_period.start > period.start:
             # We need to add black to the beginning
-            padding_duration = input_period.start - period.start
-            padding_duration = duration(padding_duration)
-            padding = ffmpeg.source(
-                "testsrc", size=size, duration=f"{padding_duration:f}"
-            ).filter("reverse")
-            input = ffmpeg.concat(padding, input)
+            track.pad_before(duration(input_period.start - period.start), fps)
 
         if input_period.end > period.end:
             # We need to trim the input: it ends past our desired point in time
-            input = input.trim(end=duration(period))
+            if not self.seek_inputs:
+                track.trim(end=duration(period))
         elif input_period.end < period.end:
-            # TODO: We need to append padding to the end of the video
-            # otherwise the last frame will be repeated
-            after_padding_period = period.end - input_period.end
-            after_padding_duration = (
-                after_padding_period.in_seconds()
-                + after_padding_period.microseconds / 1000 ** 2
-            )
-            after_padding = ffmpeg.source(
-                "color", color="black", size=size, duration=after_padding_duration
-            )
-            input = input.concat(after_padding)
-        fps = self.config.get("output_framerate", 25)
-        return input.filter("fps", fps)
+            # Append black at the end, otherwise the last frame would be repeated
+            track.pad_after(duration(period.end - input_period.end), fps)
+        return track.filter("fps", fps)
+
+    @contextmanager
+    def timed(self, phase: str):
+        """Add the time spent in the block to `self.timings[phase]`, except the
+        time spent in phases timed inside it by the same thread: probing lazily
+        while building graphs is timed as probing, not as building graphs.
+        """
+        nested = self._phases.__dict__.setdefault("nested", [])
+        nested.append(0.0)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.timings[phase] = self.timings.get(phase, 0) + elapsed - nested.pop()
+            if nested:
+                nested[-1] += elapsed
 
     def print(self, message: str):
         if self.debug:
             print(message, file=sys.stderr)
 
+    def print_graphs(self, file=None):
+        """Print the filter graph of every chunk, one filter per line,
+        to `file` (standard error by default)
+        """
+        file = file or sys.stderr
+        for i, chunk in enumerate(self.chunks):
+            command = self.chunk_command(chunk, self.chunk_path(i))
+            print(f"# Chunk {i}: {chunk.start}s-{chunk.end}s", file=file)
+            if "-filter_complex" in command:
+                graph = command[command.index("-filter_complex") + 1]
+                print(graph.replace(";", ";\n"), file=file)
+
+    def _analyze_files_once(self):
+        if self._input_infos is None:
+            with self.timed("probe"):
+                self._analyze_files()
+
     def _analyze_files(self):
-        """Run ffprobe on all inputs and store the information in self.infos"""
-        self.input_infos = {}
+        """Run ffprobe on all inputs and store the information in self.input_infos.
+        Inputs are probed concurrently, using at most `self.probe_concurrency` threads.
+        Results are cached on disk, so the same recording is only probed once.
+        """
+        self._presign_s3_urls()
         for input_info in self.config["inputs"]:
             # Convert file paths to absolute in case they're relative
             # TODO we can support HTTP URLs by prepending async:cache
             # see https://ffmpeg.org/ffmpeg-protocols.html#async
             input_info["filename"] = self.absolute_path(input_info["filename"])
-            self.print(f"Analyzing {input_info['filename']}")
-            # Use ffprobe to get more info about streams
+        with ThreadPoolExecutor(self.probe_concurrency) as executor:
+            futures = [
+                executor.submit(self._analyze_file, input_info)
+                for input_info in self.config["inputs"]
+            ]
+        input_infos, input_identities, errors = {}, {}, []
+        for input_info, future in zip(self.config["inputs"], futures):
+            streamname = input_info["streamname"]
             try:
-                options = {}
-                if input_info["filename"].startswith("http"):
-                    options = dict(timeout=FFPROBE_TIMEOUT)
-                input_file_info = ffmpeg.probe(input_info["filename"], **options)
-            except subprocess.TimeoutExpired:
-                # Try again in case of timeout
-                self.print(
-                    f"Timeout {FFPROBE_TIMEOUT} expired while ananlyzing {input_info['filename']} retrying"
-                )
-                try:
-                    input_file_info = ffmpeg.probe(
-                        input_info["filename"], timeout=FFPROBE_TIMEOUT
-                    )
-                except Exception as e:
-                    raise ValueError(f"{e}\nstderr:\n{e.stderr.decode('utf-8')}")
+                input_identities[streamname], input_infos[streamname] = future.result()
             except Exception as e:
-                raise ValueError(f"{e}\nstderr:\n{e.stderr.decode('utf-8')}")
-            self.input_infos[input_info["streamname"]] = input_file_info
+                errors.append(f"{input_info['streamname']}: {e}")
+        if errors:
+            raise ValueError("\n".join(errors))
+        self._input_infos, self._input_identities = input_infos, input_identities
+
+    def _analyze_file(self, input_info: Dict) -> Tuple[Optional[str], Dict]:
+        """Return the identity and ffprobe information of a single input.
+        The information comes from the cache if possible.
+        Remote inputs are downloaded first if `self.prefetch_inputs` is True.
+        """
+        identity = input_identity(input_info)
+        if self.prefetch_inputs and input_info["filename"].startswith("http"):
+            input_info["filename"] = self._prefetch_input(input_info, identity)
+        use_cache = identity is not None and self.use_probe_cache
+        if use_cache:
+            input_file_info = PROBE_CACHE.get_json(identity)
+            if input_file_info is not None:
+                self.print(f"Using cached analysis of {identity}")
+                return identity, input_file_info
+        self.print(f"Analyzing {input_info['filename']}")
+        input_file_info = probe(input_info["filename"], log=self.print)
+        if use_cache:
+            PROBE_CACHE.put_json(identity, input_file_info)
+        return identity, input_file_info
+
+    def _prefetch_input(self, input_info: Dict, identity: Optional[str]) -> str:
+        """Download a remote input and return the path of the local copy.
+        Inputs with an identity go through INPUT_CACHE, so they're downloaded only
+        once even when several jobs use them. The cached file is linked in the
+        temporary directory, so evicting it doesn't break this job.
+        """
+        url = input_info.get("s3_url", input_info["filename"])
+        digest = sha256(url.encode("utf-8")).hexdigest()[:16]
+        local_path = str(self._tmp_dir / f"input-{digest}")
+
+        def download(destination: str):
+            self.print(f"Downloading {url}")
+            download_input(input_info, destination)
+
+        if identity is None:
+            download(local_path)
+        else:
+            link_or_copy(str(INPUT_CACHE.fetch(identity, download)), local_path)
+        return local_path
+
+    def prefetch(self, streamnames: Iterable[str]):
+        """Download the given remote inputs, and read the local copies from now on.
+        For specs rendering only some of the chunks: the inputs of the others
+        are not downloaded. Graphs built before this read the remote inputs.
+        """
+        remote = [
+            self.inputs[streamname]
+            for streamname in streamnames
+            if self.inputs[streamname]["filename"].startswith("http")
+        ]
+        with ThreadPoolExecutor(self.probe_concurrency) as executor:
+            local_paths = list(
+                executor.map(
+                    lambda input_info: self._prefetch_input(
+                        input_info, self.input_identities[input_info["streamname"]]
+                    ),
+                    remote,
+                )
+            )
+        for input_info, local_path in zip(remote, local_paths):
+            input_info["filename"] = local_path
+
+    def chunk_inputs(self, index: int) -> List[str]:
+        """Streamnames of the inputs read by chunk number `index`"""
+        milestone, start, end = self.chunk_periods()[index]
+        shown = {
+            video_specs["streamname"]
+            for video_specs in self.config["milestones"][milestone]["videos"]
+        }
+        period = Period(start=self.ts(start), end=self.ts(end))
+        return [
+            streamname
+            for streamname in self.coverage.overlapping(*timestamps(period))
+            if streamname in shown
+        ]
+
+    def audio_inputs(self) -> List[str]:
+        """Streamnames of the inputs mixed into the audio track"""
+        audible = set(self.coverage.overlapping(*timestamps(self.output_period)))
+        return [
+            input_specs["streamname"]
+            for input_specs in self.config["inputs"]
+            if input_specs["streamname"] in audible
+            and has_audio(self.input_infos[input_specs["streamname"]]["streams"])
+        ]
 
     def _prepare_audio_track(self):
         audio_streams = []
+        audio_inputs = set(self.audio_inputs())
         for input_specs in self.config["inputs"]:
-            input_info = self.input_infos[input_specs["streamname"]]
-            input_period = get_input_period(input_info)
-            if overlaps(self.output_period, input_period):
-                if has_audio(input_info["streams"]):
-                    audio_streams.append(
-                        adjust_audio_track(input_specs, input_info, self.output_period)
+            if input_specs["streamname"] in audio_inputs:
+                audio_streams.append(
+                    adjust_audio_track(
+                        input_specs,
+                        self.input_infos[input_specs["streamname"]],
+                        self.output_period,
+                        seek=self.seek_inputs,
                     )
-        self.audio_track = ffmpeg.filter(
+                )
+        self._audio_track = ffmpeg.filter(
             audio_streams, "amix", inputs=len(audio_streams)
         )
 
@@ -286,87 +793,459 @@ class Specs:
             return filename
         return str(self.filepath.parent / filename)
 
-    def render(self, destination: Optional[str] = None):
+    def render(self, destination: Optional[str] = None, live: bool = False):
         """Render the final video in the file specified by `destination`.
         If omitted, renders in the temporary directory.
-        First renders all chunks. Then concatenates the chunks and mixes in audio.
+        First renders all chunks and the audio track in parallel.
+        Then concatenates the chunks and muxes in the audio, without re-encoding.
+        If `live` is True the final video is only ever appended to, at the cost
+        of leaving out the seeking index and duration.
         """
         if destination is None:
             destination = str(self._tmp_dir / self.output_filename)
         if os.path.isfile(destination):
             self.print("Not rendering {destination}: file exists")
             return
+        self.progress.state = "rendering"
+        if self.debug:
+            self.print_graphs()
+        if self.streaming:
+            with self.timed("stream"):
+                return self.render_streaming(destination, live=live)
+        with self.timed("chunks"):
+            self.render_videos(
+                str(self._tmp_dir / "final.webm"), audio_destination=self.audio_path
+            )
+        self.assemble(destination, live=live)
+
+    def assemble(self, destination: Optional[str] = None, live: bool = False):
+        """Concatenate the rendered chunks and mux in the rendered audio track,
+        writing the final video to `destination` (by default in the temporary directory).
+        """
+        if destination is None:
+            destination = str(self._tmp_dir / self.output_filename)
         final_video_path = str(self._tmp_dir / "final.webm")
-        self.render_videos(final_video_path)
         txt_filename = str(self._tmp_dir / "chunk-list.txt")
-        with open(txt_filename, "w") as fh:
-            for i in range(len(self.video_chunks)):
-                fh.write(f"file {self._tmp_dir}/chunk-'{i}.webm'\n")
-        command = [
-            "ffmpeg",
-            "-safe",
-            "0",
-            "-f",
-            "concat",
-            "-i",
-            txt_filename,
-            "-c",
-            "copy",
-            final_video_path,
-        ]
-        self.print(subprocess.check_output(command).decode("utf-8"))
+        # The number of chunks is known without building their graphs
+        chunk_paths = map(self.chunk_path, range(len(self.chunk_periods())))
+        write_concat_list(txt_filename, chunk_paths)
+        command = concat_command(txt_filename, final_video_path)
+        total = duration(self.output_period)
+        with self.timed("concat"):
+            self.print(
+                run_ffmpeg(command, self.progress.task("concat", total)).decode("utf-8")
+            )
         os.system("stty sane")
-        video = ffmpeg.input(final_video_path)
-        final = self.audio_track.output(
-            video, destination, t=self.output_period.in_seconds(), vcodec="copy"
+        video = ffmpeg.input(final_video_path).video
+        audio = ffmpeg.input(self.audio_path).audio
+        final = ffmpeg.output(video, audio, destination, **self.mux_options(live))
+        with self.timed("mux"):
+            run_ffmpeg(final.compile(), self.progress.task("mux", total))
+
+    def mux_options(self, live: bool = False) -> Dict:
+        """Options of the ffmpeg output writing the final video"""
+        options = dict(t=self.output_period.in_seconds(), c="copy")
+        if live:
+            options["live"] = 1
+        return options
+
+    def render_streaming(self, destination: str, live: bool = False):
+        """Render the final video without writing intermediate files.
+        Chunks are encoded as IVF streams and piped, in order, into the ffmpeg
+        process muxing the final video, which reads the audio track through another pipe.
+        Encoders running ahead of the muxer keep their output in memory.
+        Cached chunks are remuxed instead of encoded; encoded chunks are not cached.
+        """
+        audio_read, audio_write = os.pipe()
+        mux_command = ffmpeg.output(
+            ffmpeg.input("pipe:0", f="ivf").video,
+            ffmpeg.input(f"pipe:{audio_read}").audio,
+            destination,
+            **self.mux_options(live),
+        ).compile()
+        total = duration(self.output_period)
+        mux_task = self.progress.task("mux", total)
+        mux = probostitcher.progress.popen(
+            mux_command, mux_task, stdin=subprocess.PIPE, pass_fds=[audio_read]
         )
-        final.run()
+        os.close(audio_read)
+        audio_task = self.progress.task("audio", total)
+        audio = probostitcher.progress.popen(
+            self.audio_command("pipe:1", f="webm"), audio_task, stdout=audio_write
+        )
+        os.close(audio_write)
+        outputs: List[queue.Queue] = [queue.Queue() for _ in self.chunks]
+        # The pool starts our jobs in order: the chunk the muxer is waiting for
+        # is always being rendered
+        batch = self.batch()
+        for i, (chunk, output) in enumerate(zip(self.chunks, outputs)):
+            task = self.progress.task(f"chunk-{i}", chunk.duration)
+            args = (self.chunk_stream_command(chunk), output, task)
+            # Chunks may be remuxed from the cache: don't measure them
+            future = self._submit(
+                batch, stream_ffmpeg, args, *self.chunk_cost(chunk), measure=False
+            )
+            # Chunks cancelled, or failing before ffmpeg starts, never end their
+            # output: end it whenever they're done. Another end is harmless.
+            future.add_done_callback(lambda _, output=output: output.put(None))
+        try:
+            for i, output in enumerate(outputs):
+                # Chunks after the first one are appended without their IVF header
+                to_skip = IVF_HEADER_SIZE if i else 0
+                for data in iter(output.get, None):
+                    if to_skip:
+                        data, to_skip = data[to_skip:], max(0, to_skip - len(data))
+                    mux.stdin.write(data)
+            mux.stdin.close()
+        except BrokenPipeError:
+            self.print("The muxer exited before receiving all chunks")
+            batch.fail(RuntimeError("The muxer exited before receiving all chunks"))
+        try:
+            batch.wait()
+        except BaseException:
+            # Don't leave the muxer waiting for the rest of the video
+            for process in (audio, mux):
+                probostitcher.executor.kill(process)
+            raise
+        finally:
+            for process, task in ((audio, audio_task), (mux, mux_task)):
+                probostitcher.progress.wait(process, task)
+        for process, task in ((audio, audio_task), (mux, mux_task)):
+            if process.returncode:
+                raise FfmpegError(task, process.returncode, process.args)
 
-    def render_videos(self, destination: str):
-        """Render the video chunks as specced, saving it to temporary files and returning them."""
-        base_filename = self._tmp_dir / "chunk-"
-        pool = Pool(self.parallelism)
+    def chunk_stream_command(self, chunk: Chunk) -> List[str]:
+        """Return the ffmpeg command line that writes `chunk` to its standard output
+        as an IVF stream, with timestamps starting at the chunk start.
+        """
+        # The IVF header of the first chunk sets the time base of them all:
+        # encoders use 1/fps, while chunks remuxed from WebM files use 1/1000
+        options = {
+            "f": "ivf",
+            "output_ts_offset": chunk.start,
+            "bsf:v": f"setts=time_base={IVF_TIME_BASE}",
+        }
+        key = self.chunk_key(chunk) if self.use_chunk_cache else None
+        cached = CHUNK_CACHE.get(key) if key is not None else None
+        if cached is not None:
+            return (
+                ffmpeg.input(str(cached))
+                .output("pipe:1", c="copy", **options)
+                .compile()
+            )
+        return self.chunk_command(chunk, "pipe:1", **options)
 
-        commands = []
-        for i, chunk in enumerate(self.video_chunks):
-            filename = str(base_filename) + f"{i}.webm"
-            todo = chunk.output(
+    def render_videos(self, destination: str, audio_destination: Optional[str] = None):
+        """Render the video chunks as specced, saving it to temporary files and returning them.
+        Chunks found in the chunk cache are not rendered again.
+        If `audio_destination` is given the audio track is rendered there,
+        alongside the video chunks. As soon as one of them fails the others
+        are stopped, and its error raised.
+        """
+        batch = self.batch()
+        if audio_destination is not None:
+            # The audio track is usually the longest job: start it first
+            task = self.progress.task("audio", duration(self.output_period))
+            args = (self.audio_command(audio_destination), task)
+            self._submit(batch, run_ffmpeg, args, *self.audio_cost())
+        # Start the most expensive chunks first, so that the short ones
+        # can fill the gaps when the long ones are still running
+        by_cost = sorted(
+            enumerate(self.chunks), key=lambda el: el[1].cost, reverse=True
+        )
+        for i, chunk in by_cost:
+            filename = self.chunk_path(i)
+            key = self.chunk_key(chunk) if self.use_chunk_cache else None
+            task = self.progress.task(f"chunk-{i}", chunk.duration)
+            if key is not None and fetch_cached_chunk(
+                key, filename, remote=self.checkpoint_chunks
+            ):
+                self.print(f"Reusing cached chunk {i} ({key[:12]})")
+                task.finish()
+                continue
+            args = (
+                self.chunk_commands(chunk, filename),
+                key,
                 filename,
-                vsync="cfr",  # Frames will be duplicated and dropped to achieve exactly the requested constant frame rate
-                copytb=1,  # Use the demuxer timebase.
+                self.checkpoint_chunks,
+                task,
             )
-            commands.append(todo.compile())
-        result = pool.map(run_ffmpeg, commands)
-        os.system("stty sane")
-        # TODO: check if any process errored out and collect error message
-        self.print(repr(result))
-        os.system("stty sane")
+            # Only the last process of spliced chunks reports to `task`
+            measure = chunk.pieces is None
+            self._submit(
+                batch, render_chunk, args, *self.chunk_cost(chunk), measure=measure
+            )
+        try:
+            batch.wait()
+        finally:
+            os.system("stty sane")
+
+    @property
+    def pool(self) -> FfmpegPool:
+        """The long-lived pool ffmpeg processes are run in.
+        Unless `self.parallelism` is set it's shared with all other jobs.
+        """
+        return get_pool(self.parallelism)
+
+    def batch(self) -> Batch:
+        """A new batch of tasks of this job in the pool: if one fails the others
+        are cancelled, and their ffmpeg processes killed
+        """
+        return Batch(self.pool, self)
+
+    def _submit(
+        self,
+        batch: Batch,
+        function: Callable,
+        args: Tuple,
+        kind: str,
+        default: Cost,
+        measure: bool = True,
+    ) -> Future:
+        """Submit `function(*args)` to `batch`. Its last argument is the task
+        it reports progress to, rendering `task.duration` seconds of video:
+        it's given a timeout in proportion, and it's admitted with the cost
+        measured for processes of the same `kind` (`default` if none was).
+        Unless `measure` is False, what it cost is recorded once it succeeds.
+        """
+        task = args[-1]
+        future = batch.submit(
+            function,
+            *args,
+            timeout=chunk_timeout(task.duration),
+            cost=MEASUREMENTS.estimate(kind, default),
+        )
+        if measure:
+            future.add_done_callback(lambda future: record_cost(future, kind, task))
+        return future
+
+    def chunk_cost(self, chunk: Chunk) -> Tuple[str, Cost]:
+        """Return what determines the cost of rendering `chunk` (encoder settings,
+        output size and sizes of the inputs shown), and a guess of that cost
+        """
+        period = Period(start=self.ts(chunk.start), end=self.ts(chunk.end))
+        covered = set(self.coverage.overlapping(*timestamps(period)))
+        sizes = []
+        for video_specs in self.config["milestones"][chunk.milestone]["videos"]:
+            if video_specs["streamname"] in covered:
+                stream = self.input_infos[video_specs["streamname"]]["streams"][0]
+                sizes.append((stream["width"], stream["height"]))
+        profile = self.config.get("encoder_profile", ENCODER_PROFILE)
+        fps = self.config.get("output_framerate", 25)
+        inputs = "+".join(f"{width}x{height}" for width, height in sorted(sizes))
+        kind = (
+            f"chunk {profile} {self.width}x{self.height}@{fps} "
+            f"threads={self.threads} inputs={inputs}"
+        )
+        pixels = self.width * self.height + sum(w * h for w, h in sizes)
+        return kind, default_cost(self.threads, pixels)
+
+    def audio_cost(self) -> Tuple[str, Cost]:
+        """Return what determines the cost of rendering the audio track
+        (the number of inputs mixed), and a guess of that cost
+        """
+        inputs = sum(has_audio(info["streams"]) for info in self.input_infos.values())
+        return f"audio inputs={inputs}", Cost(1.0, BASE_MEMORY)
+
+    def chunk_path(self, index: int) -> str:
+        """Path of the temporary file where chunk number `index` is rendered"""
+        return str(self._tmp_dir / f"chunk-{index}.webm")
+
+    @property
+    def audio_path(self) -> str:
+        """Path of the temporary file where the audio track is rendered"""
+        return str(self._tmp_dir / "audio.webm")
+
+    def stored_chunk_key(self, index: int) -> str:
+        """Key of chunk number `index` in the chunk cache and under `chunks/` in
+        the output bucket, used by distributed jobs
+        """
+        return self.chunk_key(self.chunks[index]) or f"{self.job_id}-chunk-{index}"
+
+    @property
+    def stored_audio_key(self) -> str:
+        """Key of the audio track in the chunk cache and under `chunks/` in
+        the output bucket, used by distributed jobs
+        """
+        return f"{self.job_id}-audio"
+
+    def render_stored_chunk(self, index: int):
+        """Render chunk number `index` and store it under `chunks/` in the output
+        bucket, for the reduce task of a distributed job to find.
+        Does nothing if it's already there.
+        """
+        key = self.stored_chunk_key(index)
+        chunk, filename = self.chunks[index], self.chunk_path(index)
+        task = self.progress.task(f"chunk-{index}", chunk.duration)
+        commands = self.chunk_commands(chunk, filename)
+        self._render_stored(key, filename, commands, task, self.chunk_cost(chunk))
+
+    def render_stored_audio(self):
+        """Render the audio track and store it under `chunks/` in the output bucket,
+        for the reduce task of a distributed job to find.
+        Does nothing if it's already there.
+        """
+        task = self.progress.task("audio", duration(self.output_period))
+        commands = [self.audio_command(self.audio_path)]
+        self._render_stored(
+            self.stored_audio_key, self.audio_path, commands, task, self.audio_cost()
+        )
+
+    def _render_stored(
+        self,
+        key: str,
+        filename: str,
+        commands: List[List[str]],
+        task: TaskProgress,
+        cost: Tuple[str, Cost],
+    ):
+        cached = CHUNK_CACHE.get(key) if self.use_chunk_cache else None
+        if get_storage().exists(f"chunks/{key}.webm"):
+            self.print(f"{key[:12]} already stored")
+        elif cached is not None:
+            get_storage().upload(str(cached), f"chunks/{key}.webm")
+        else:
+            batch = self.batch()
+            args = (commands, key, filename, True, task)
+            self._submit(batch, render_chunk, args, *cost, measure=len(commands) == 1)
+            batch.wait()
+            return
+        task.finish()
+
+    def stored_piece_keys(self) -> List[str]:
+        """Keys of the chunks, then of the audio track, stored by the tasks of
+        a distributed job (see `stored_chunk_key` and `stored_audio_key`)
+        """
+        keys = [self.stored_chunk_key(i) for i in range(len(self.chunks))]
+        return keys + [self.stored_audio_key]
+
+    def fetch_stored_pieces(self, keys: Optional[List[str]] = None) -> List[str]:
+        """Copy the chunks and audio track stored by the tasks of a distributed job
+        to the temporary directory. Returns the keys of those not stored yet.
+        Unless `keys` are given (see `stored_piece_keys`) inputs are probed to
+        compute them.
+        """
+        if keys is None:
+            keys = self.stored_piece_keys()
+        *chunk_keys, audio_key = keys
+        pieces = [(key, self.chunk_path(i)) for i, key in enumerate(chunk_keys)]
+        pieces.append((audio_key, self.audio_path))
+        with ThreadPoolExecutor(FETCH_CONCURRENCY) as executor:
+            found = executor.map(
+                lambda piece: fetch_cached_chunk(*piece, remote=True), pieces
+            )
+        return [key for (key, _), present in zip(pieces, found) if not present]
+
+    def chunk_command(self, chunk: Chunk, filename: str, **options) -> List[str]:
+        """Return the ffmpeg command line that renders `chunk` into `filename`.
+        Keyword arguments are passed to ffmpeg as additional output options.
+        """
+        if chunk.copy:
+            return chunk.stream.output(filename, c="copy", **options).compile()
+        return chunk.stream.output(
+            filename,
+            vsync="cfr",  # Frames will be duplicated and dropped to achieve exactly the requested constant frame rate
+            copytb=1,  # Use the demuxer timebase.
+            **self.encoder_profile.output_options(self.threads),
+            **options,
+        ).compile()
+
+    def chunk_commands(self, chunk: Chunk, filename: str) -> List[List[str]]:
+        """Return the ffmpeg command lines that render `chunk` into `filename`,
+        to be run in order (see `render_chunk`). Chunks made of pieces have them
+        rendered next to `filename` (see `piece_paths`), then joined by the last
+        command, which reads their list from `<filename>.txt`.
+        """
+        if chunk.pieces is None:
+            return [self.chunk_command(chunk, filename)]
+        commands = [
+            self.chunk_command(piece, path)
+            for piece, path in zip(
+                chunk.pieces, piece_paths(filename, len(chunk.pieces))
+            )
+        ]
+        commands.append(concat_command(f"{filename}.txt", filename))
+        return commands
+
+    @property
+    def threads(self) -> int:
+        """Threads used by each ffmpeg process encoding a chunk: the cores are
+        shared among the processes the pool runs at the same time
+        """
+        return thread_budget(self.pool.slots)
+
+    def audio_command(self, filename: str, **options) -> List[str]:
+        """Return the ffmpeg command line that renders the audio track into `filename`.
+        Keyword arguments are passed to ffmpeg as additional output options.
+        """
+        return self.audio_track.output(
+            filename, t=self.output_period.in_seconds(), acodec="libopus", **options
+        ).compile()
+
+    def chunk_key(self, chunk: Chunk) -> Optional[str]:
+        """Return a string identifying the contents of the rendered chunk.
+        It's a hash of the ffmpeg command rendering it, with input filenames
+        replaced by the identity of their contents.
+        Returns None if some of the chunk inputs can't be identified.
+        """
+        identities = {
+            self.inputs[streamname]["filename"]: identity
+            for streamname, identity in self.input_identities.items()
+        }
+        key_parts = [chunk.start, chunk.end]
+        commands = self.chunk_commands(chunk, "chunk.webm")
+        args = iter([arg for command in commands for arg in command])
+        for arg in args:
+            if arg == "-threads":
+                # It depends on the machine, not on what the chunk looks like
+                next(args)
+                continue
+            if arg in identities:
+                if identities[arg] is None:
+                    return None
+                arg = identities[arg]
+            key_parts.append(arg)
+        return sha256(json.dumps(key_parts).encode("utf-8")).hexdigest()
 
     def upload(self, rendered_video_path: Optional[str] = None):
-        """Upload the final video to S3. If the file does not exist the video
-        will be rendered first.
+        """Upload the final video to the storage (the output bucket, unless configured
+        otherwise: see `storage.get_storage`). If the file does not exist the video
+        will be rendered first: if `self.upload_while_rendering` is True parts of it
+        are uploaded while it's being written.
         """
         if rendered_video_path is None:
             rendered_video_path = str(self._tmp_dir / self.output_filename)
-        if not os.path.exists(rendered_video_path):
+        object_key = f"output/{self.output_filename}"
+        if os.path.exists(rendered_video_path):
+            self.progress.state = "uploading"
+            get_storage().upload(rendered_video_path, object_key)
+        elif self.upload_while_rendering:
+            with ThreadPoolExecutor(1) as executor:
+                rendering = executor.submit(self.render, rendered_video_path, live=True)
+                get_storage().upload_growing_file(
+                    rendered_video_path, object_key, rendering
+                )
+        else:
             self.render(rendered_video_path)
-
-        try:
-            get_boto_client().upload_file(
-                rendered_video_path, OUTPUT_BUCKET, f"output/{self.output_filename}"
-            )
-        except ClientError as e:
-            logging.error(e)
-            raise
+            self.progress.state = "uploading"
+            get_storage().upload(rendered_video_path, object_key)
+        self.progress.state = "done"
 
     def _presign_s3_urls(self):
         for input in self.config["inputs"]:
             if input["filename"].startswith("s3://"):
+                # Keep the original URL around: it identifies the object
+                input["s3_url"] = input["filename"]
                 input["filename"] = create_presigned_url(input["filename"])
 
+    @property
+    def video_chunks(self) -> List[FilterableStream]:
+        """The streams of the chunks that will make up the final video"""
+        return [chunk.stream for chunk in self.chunks]
+
     def __len__(self) -> int:
         """Returns the number of chunks for this specs"""
-        return len(self.video_chunks)
+        return len(self.chunks)
 
     def __iter__(self) -> Iterator:
         return iter(self.video_chunks)
@@ -384,11 +1263,261 @@ class Specs:
         )
 
 
-def run_ffmpeg(args: List[str]):
-    """Function to be invoked in a subprocess to in turn invoke ffmpeg."""
-    print("Running: ")
-    print(" ".join(map(shlex.quote, args)))
-    return subprocess.check_output(args)
+def canonical_specs(config: Dict) -> str:
+    """Return `config` as JSON with sorted keys, no whitespace and defaults filled in,
+    so that specs rendering the same video are represented by the same string.
+    """
+    config = json.loads(json.dumps(config))
+    config.setdefault("debug", False)
+    config.setdefault("encoder_profile", ENCODER_PROFILE)
+    config.setdefault("output_framerate", 25)
+    for milestone in config["milestones"]:
+        for video_specs in milestone["videos"]:
+            video_specs.setdefault("x", 0)
+            video_specs.setdefault("y", 0)
+            video_specs.setdefault("width", config["output_size"]["width"])
+            video_specs.setdefault("height", config["output_size"]["height"])
+    return json.dumps(config, sort_keys=True, separators=(",", ":"))
+
+
+@lru_cache(maxsize=None)
+def code_hash() -> str:
+    """Hash of the code deciding what rendered videos look like, read only once"""
+    digest = sha512()
+    for module in RENDERING_MODULES:
+        digest.update(Path(module).read_bytes())
+    return digest.hexdigest()
+
+
+def fetch_cached_chunk(key: str, destination: str, remote: bool = False) -> bool:
+    """Copy the chunk identified by `key` to `destination`, from the local cache
+    or, if `remote` is True, from the output bucket.
+    Returns False if the chunk is not cached.
+    """
+    cached = CHUNK_CACHE.get(key)
+    if cached is not None:
+        link_or_copy(str(cached), destination)
+        return True
+    if remote and get_storage().download(f"chunks/{key}.webm", destination):
+        CHUNK_CACHE.put_file(key, destination)
+        return True
+    return False
+
+
+def store_cached_chunk(key: str, filename: str, remote: bool = False):
+    """Store the rendered chunk in `filename` in the chunk cache.
+    If `remote` is True it's also uploaded to the output bucket.
+    """
+    CHUNK_CACHE.put_file(key, filename)
+    if remote:
+        get_storage().upload(filename, f"chunks/{key}.webm")
+
+
+def chunk_timeout(seconds: float) -> Optional[float]:
+    """Seconds rendering `seconds` of video may take, or None for no limit"""
+    if not CHUNK_TIMEOUT_RATIO:
+        return None
+    return max(CHUNK_TIMEOUT_MIN, seconds * CHUNK_TIMEOUT_RATIO)
+
+
+def record_cost(future: Future, kind: str, task: TaskProgress):
+    """Record what the ffmpeg process reporting to `task` cost, if it succeeded"""
+    if future.cancelled() or future.exception() is not None or task.started is None:
+        return
+    MEASUREMENTS.record(kind, Cost(task.cores, task.rss))
+
+
+def render_chunk(
+    commands: List[List[str]],
+    key: Optional[str],
+    filename: str,
+    checkpoint: bool = False,
+    task: Optional[TaskProgress] = None,
+):
+    """Run the ffmpeg commands rendering a chunk to `filename` (see `Specs.chunk_commands`),
+    then store the chunk in the cache as soon as it's done (unless `key` is None).
+    If `checkpoint` is True it's uploaded too, so a retried job can reuse it.
+    Only the last command reports its progress to `task`.
+    """
+    *pieces, last = commands
+    if pieces:
+        write_concat_list(f"{filename}.txt", piece_paths(filename, len(pieces)))
+    for args in pieces:
+        run_ffmpeg(args)
+    result = run_ffmpeg(last, task)
+    if key is not None:
+        store_cached_chunk(key, filename, remote=checkpoint)
+    return result
+
+
+def piece_paths(filename: str, count: int) -> List[str]:
+    """Paths the `count` pieces of a chunk rendered to `filename` are rendered to"""
+    stem = filename.rsplit(".", 1)[0]
+    return [f"{stem}-piece-{i}.webm" for i in range(count)]
+
+
+def write_concat_list(list_filename: str, filenames: Iterable[str]):
+    """Write the list of files read by `concat_command`"""
+    with open(list_filename, "w") as fh:
+        for filename in filenames:
+            fh.write(f"file '{filename}'\n")
+
+
+def concat_command(list_filename: str, filename: str) -> List[str]:
+    """The ffmpeg command line joining the files listed in `list_filename`
+    (see `write_concat_list`) into `filename`, without encoding them again
+    """
+    return [
+        "ffmpeg",
+        "-safe",
+        "0",
+        "-f",
+        "concat",
+        "-i",
+        list_filename,
+        "-c",
+        "copy",
+        filename,
+    ]
+
+
+def stream_ffmpeg(args: List[str], output: queue.Queue, task: TaskProgress):
+    """Run ffmpeg and put the data it writes to its standard output in `output`,
+    followed by None. Raises CalledProcessError if ffmpeg fails.
+    """
+    # Not on standard output: it may be where results go (see `benchmark.main`)
+    print("Running: ", file=sys.stderr)
+    print(" ".join(map(shlex.quote, args)), file=sys.stderr)
+    try:
+        process = probostitcher.progress.popen(args, task, stdout=subprocess.PIPE)
+        for data in iter(lambda: process.stdout.read(STREAM_BUFFER_SIZE), b""):
+            output.put(data)
+    finally:
+        output.put(None)
+    process.stdout.close()
+    if probostitcher.progress.wait(process, task):
+        raise FfmpegError(task, process.returncode, args)
+
+
+def download_input(input_specs: Dict, destination: str):
+    """Download a remote input: S3 objects through the S3 API, anything else with
+    a plain HTTP request.
+    """
+    if "s3_url" in input_specs:
+        download_url(input_specs["s3_url"], destination)
+        return
+    with urllib.request.urlopen(
+        input_specs["filename"], timeout=DOWNLOAD_TIMEOUT
+    ) as response, open(destination, "wb") as fh:
+        shutil.copyfileobj(response, fh)
+
+
+def run_ffmpeg(args: List[str], task: Optional[TaskProgress] = None) -> bytes:
+    """Run ffmpeg and return what it writes to its standard output.
+    If `task` is given ffmpeg reports its progress there.
+    Raises FfmpegError, with the end of what ffmpeg logged, if it fails.
+    """
+    # Not on standard output: it may be where results go (see `benchmark.main`)
+    print("Running: ", file=sys.stderr)
+    print(" ".join(map(shlex.quote, args)), file=sys.stderr)
+    if task is None:
+        task = TaskProgress(Path(args[-1]).name, 0)
+    return probostitcher.progress.run(args, task)
+
+
+def probe(
+    filename: str,
+    retries: int = FFPROBE_RETRIES,
+    backoff: float = FFPROBE_BACKOFF,
+    log: Callable[[str], None] = print,
+    **options,
+) -> Dict:
+    """Run ffprobe on the given file or URL and return its output.
+    Keyword arguments are passed to ffprobe as additional options.
+    Remote inputs are retried up to `retries` times in case of timeouts or errors,
+    waiting `backoff` seconds before the first retry and doubling it every time.
+    """
+    is_remote = filename.startswith("http")
+    if is_remote:
+        options["timeout"] = FFPROBE_TIMEOUT
+    attempt = 0
+    while True:
+        is_last = attempt == retries or not is_remote
+        try:
+            return ffmpeg.probe(filename, **options)
+        except subprocess.TimeoutExpired:
+            if is_last:
+                raise ValueError(
+                    f"Timeout {FFPROBE_TIMEOUT} expired analyzing {filename}"
+                )
+            log(
+                f"Timeout {FFPROBE_TIMEOUT} expired while analyzing {filename}: retrying"
+            )
+        except Exception as e:
+            stderr = getattr(e, "stderr", None) or b""
+            if is_last:
+                raise ValueError(f"{e}\nstderr:\n{stderr.decode('utf-8')}")
+            log(f"Error analyzing {filename}: retrying")
+        time.sleep(backoff * 2 ** attempt)
+        attempt += 1
+
+
+def probe_keyframes(filename: str, start: float, end: float, **kwargs) -> List[float]:
+    """Return the timestamps, in seconds, of the keyframes of the first video
+    stream of the given file from `start` to `end` (excluded). ffprobe seeks to
+    the keyframe before `start`, and reads packets without decoding them until `end`.
+    Keyword arguments are passed to `probe`, which retries remote files.
+    """
+    info = probe(
+        filename,
+        select_streams="v:0",
+        show_entries="packet=pts_time,flags",
+        read_intervals=f"{start:f}%{end:f}",
+        **kwargs,
+    )
+    return sorted(
+        float(packet["pts_time"])
+        for packet in info.get("packets", [])
+        if "K" in packet.get("flags", "") and "pts_time" in packet
+    )
+
+
+def input_identity(input_specs: Dict) -> Optional[str]:
+    """Return a string that changes whenever the contents of the given input change.
+    S3 objects are identified by bucket, key and ETag, local files by path, size
+    and modification time. Returns None for inputs we can't identify (plain HTTP URLs).
+    """
+    if "s3_url" in input_specs:
+        return f"{input_specs['s3_url']}#{get_etag(input_specs['s3_url'])}"
+    filename = input_specs["filename"]
+    if filename.startswith("http"):
+        return None
+    try:
+        stat = os.stat(filename)
+    except OSError:  # Let ffprobe report the problem
+        return None
+    return f"file://{os.path.abspath(filename)}#{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def split_segments(
+    start: float, end: float, segment_duration: int
+) -> List[Tuple[float, float]]:
+    """Split the interval between `start` and `end` in (start, end) tuples
+    no longer than `segment_duration`. Cut points are multiples of `segment_duration`,
+    so they don't move when a neighbouring milestone changes.
+    Segments shorter than a quarter of `segment_duration` are merged with their neighbour.
+    """
+    if not segment_duration or end - start <= segment_duration:
+        return [(start, end)]
+    first_cut = (start // segment_duration + 1) * segment_duration
+    cuts = list(range(int(first_cut), int(math.ceil(end)), segment_duration))
+    min_duration = segment_duration / 4
+    if cuts and cuts[0] - start < min_duration:
+        cuts.pop(0)
+    if cuts and end - cuts[-1] < min_duration:
+        cuts.pop()
+    points = [start] + cuts + [end]
+    return list(zip(points[:-1], points[1:]))
 
 
 def duration(period: Period) -> float:
@@ -425,28 +1554,32 @@ def get_input_period(input_file_info: Dict) -> Period:
     return Period(start=start, end=end)
 
 
-def scale_to(input, width, height):
-    """Scale the given video and add black bands to make it exactly the desired size"""
-    return input.filter(
-        "scale",
-        size=f"{width}:{height}",
-        force_original_aspect_ratio="decrease",
-    ).filter("pad", width, height, "(ow-iw)/2", "(oh-ih)/2")
+def timestamps(period: Period) -> Tuple[float, float]:
+    """Start and end of the period, in seconds since Epoch"""
+    return period.start.timestamp(), period.end.timestamp()
 
 
 def adjust_audio_track(
-    input_specs: Dict, input_info: Dict, output_period: Period
+    input_specs: Dict, input_info: Dict, output_period: Period, seek: bool = True
 ) -> FilterableStream:
-    """Adjust an audio track to match desired output times"""
+    """Adjust an audio track to match desired output times.
+    If `seek` is True the beginning of the input is skipped by the demuxer.
+    """
     stream_delay = (
         output_period.start.timestamp() - get_input_start(input_info) / 1000 ** 2
     )
-    audio = ffmpeg.input(input_specs["filename"]).audio
     if stream_delay > 0:
-        return audio.filter("atrim", start=stream_delay).filter(
-            "asetpts", "PTS-STARTPTS"
-        )
+        if seek:
+            audio = ffmpeg.input(
+                input_specs["filename"], ss=f"{stream_delay:f}", accurate_seek=None
+            ).audio
+        else:
+            audio = ffmpeg.input(input_specs["filename"]).audio.filter(
+                "atrim", start=stream_delay
+            )
+        return audio.filter("asetpts", "PTS-STARTPTS")
     else:
+        audio = ffmpeg.input(input_specs["filename"]).audio
         intro = ffmpeg.source("anullsrc").filter("atrim", duration=abs(stream_delay))
         return ffmpeg.concat(intro, audio, v=0, a=1).filter("asetpts", "PTS-STARTPTS")
 
@@ -456,16 +1589,6 @@ def parse_ts(ts: int) -> DateTime:
     return DateTime.fromtimestamp(ts / 1000 ** 2)
 
 
-def overlaps(p1: Period, p2: Period) -> Optional[Period]:
-    """Return the overlapping period of the given ones.
-    If there is no overlap return None"""
-    start = max(p1.start, p2.start)
-    end = min(p1.end, p2.end)
-    if end < start:
-        return None
-    return Period(start=start, end=end)
-
-
 def has_audio(input):
     return any(el.get("channels") for el in input)
 
@@ -1,19 +1,33 @@
-function schedule_check_video() {
-  check_video();
+function follow_job() {
+  var events = new EventSource(EVENTS_URL);
+  events.onmessage = function (event) {
+    var status = JSON.parse(event.data);
+    if (status === null) {
+      return;
+    }
+    show_status(status);
+    if (status.state === "done" || status.state === "failed") {
+      events.close();
+    }
+    if (status.state === "done") {
+      show_video();
+    }
+  };
 }
 
-function check_video() {
-  fetch(VIDEO_URL, { headers: { Range: "bytes=0-20" } })
-    .then(function (response) {
-      if (response.status !== 206) {
-        setTimeout(check_video, 2000);
-        return;
-      }
-      var video_element = document.getElementsByTagName("video")[0];
-      video_element.innerHTML =
-        '<source src="' + VIDEO_URL + '" type="video/webm"></source>';
-    })
-    .catch(function () {
-      console.error("Error trying to fetch video");
-    });
+function show_status(status) {
+  var text = status.state + ": " + Math.round(status.progress * 100) + "%";
+  if (status.eta !== null && status.state === "rendering") {
+    text += " (about " + Math.round(status.eta) + "s left)";
+  }
+  if (status.error) {
+    text += " " + status.error;
+  }
+  document.getElementById("progress").textContent = text;
+}
+
+function show_video() {
+  var video_element = document.getElementsByTagName("video")[0];
+  video_element.innerHTML =
+    '<source src="' + VIDEO_URL + '" type="video/webm"></source>';
 }
@@ -0,0 +1,165 @@
+"""Where outputs, checkpointed chunks, job statuses and markers are stored, by key.
+The output bucket on S3 by default, or a local directory for deployments
+running the server and the workers on the same machine.
+"""
+from abc import ABC
+from abc import abstractmethod
+from botocore.exceptions import ClientError
+from concurrent.futures import Future
+from functools import lru_cache
+from pathlib import Path
+from probostitcher import s3
+from probostitcher.cache import atomic_path
+from probostitcher.cache import link_or_copy
+from typing import Dict
+from typing import Optional
+
+import json
+import os
+import shutil
+import time
+
+
+#: Exceptions raised by storage backends when they can't be reached
+STORAGE_ERRORS = (ClientError, OSError)
+
+
+class Storage(ABC):
+    """Objects addressed by keys like `output/<job id>.webm`"""
+
+    @abstractmethod
+    def download(self, key: str, destination: str) -> bool:
+        """Copy an object to `destination`. Returns False if it does not exist."""
+
+    @abstractmethod
+    def upload(self, filename: str, key: str):
+        """Store a file"""
+
+    @abstractmethod
+    def upload_growing_file(self, filename: str, key: str, writer: Future):
+        """Store a file while it's being written: it must only be appended to
+        until `writer` is done. If `writer` fails its exception is raised.
+        """
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        """True if an object is stored under `key`"""
+
+    @abstractmethod
+    def put_json(self, key: str, value: Dict):
+        """Store `value` as a JSON object"""
+
+    @abstractmethod
+    def get_json(self, key: str) -> Optional[Dict]:
+        """Return a JSON object, or None if it does not exist"""
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Delete an object. Deleting a missing object is not an error"""
+
+    @abstractmethod
+    def url(self, key: str, expiration: int = 3600) -> str:
+        """A URL browsers can download the object from"""
+
+
+class S3Storage(Storage):
+    """The output bucket (see `s3.OUTPUT_BUCKET`)"""
+
+    def download(self, key: str, destination: str) -> bool:
+        return s3.download(key, destination)
+
+    def upload(self, filename: str, key: str):
+        s3.upload(filename, key)
+
+    def upload_growing_file(self, filename: str, key: str, writer: Future):
+        s3.upload_growing_file(filename, key, writer)
+
+    def exists(self, key: str) -> bool:
+        return s3.exists(key)
+
+    def put_json(self, key: str, value: Dict):
+        s3.put_json(key, value)
+
+    def get_json(self, key: str) -> Optional[Dict]:
+        return s3.get_json(key)
+
+    def delete(self, key: str):
+        s3.delete(key)
+
+    def url(self, key: str, expiration: int = 3600) -> str:
+        return s3.create_presigned_url(
+            f"s3://{s3.OUTPUT_BUCKET}/{key}", expiration=expiration
+        )
+
+    def __str__(self) -> str:
+        return f"bucket {s3.OUTPUT_BUCKET} in {s3.REGION}"
+
+
+class LocalStorage(Storage):
+    """A directory, with keys as relative paths. Writes are atomic."""
+
+    #: The directory objects are stored in
+    directory: Path
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+
+    def path(self, key: str) -> Path:
+        return self.directory / key
+
+    def download(self, key: str, destination: str) -> bool:
+        try:
+            link_or_copy(str(self.path(key)), destination)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def upload(self, filename: str, key: str):
+        start = time.monotonic()
+        self.path(key).parent.mkdir(parents=True, exist_ok=True)
+        with atomic_path(self.path(key)) as tmp:
+            shutil.copyfile(filename, tmp)
+        s3.report_upload(key, os.path.getsize(filename), start)
+
+    def upload_growing_file(self, filename: str, key: str, writer: Future):
+        # Copying is fast enough: wait for the whole file
+        writer.result()
+        self.upload(filename, key)
+
+    def exists(self, key: str) -> bool:
+        return self.path(key).exists()
+
+    def put_json(self, key: str, value: Dict):
+        self.path(key).parent.mkdir(parents=True, exist_ok=True)
+        with atomic_path(self.path(key)) as tmp:
+            Path(tmp).write_text(json.dumps(value))
+
+    def get_json(self, key: str) -> Optional[Dict]:
+        try:
+            return json.loads(self.path(key).read_text())
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str):
+        try:
+            self.path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def url(self, key: str, expiration: int = 3600) -> str:
+        # Served by the server (see `server.stored_object`)
+        return f"/storage/{key}"
+
+    def __str__(self) -> str:
+        return f"directory {self.directory}"
+
+
+@lru_cache(maxsize=None)
+def get_storage() -> Storage:
+    """Return the storage shared by the whole process: the directory in
+    `PROBOSTITCHER_STORAGE_DIR` if set, the output bucket otherwise.
+    """
+    directory = os.environ.get("PROBOSTITCHER_STORAGE_DIR")
+    if directory:
+        return LocalStorage(Path(directory))
+    return S3Storage()
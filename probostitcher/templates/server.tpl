@@ -6,7 +6,8 @@
     <script>
         %if video_url:
             VIDEO_URL = {{! json.dumps(video_url) }};
-            schedule_check_video()
+            EVENTS_URL = {{! json.dumps(events_url) }};
+            follow_job()
         %end
     </script>
     <title>Probostitcher</title>
@@ -21,6 +22,7 @@
     <h1>Probostitcher</h1>
     <h2>{{! message}}</h2>
     %if video_url:
+    <p id="progress"></p>
     <span>
         <video controls width="250">
             Sorry, your browser doesn't support embedded videos.
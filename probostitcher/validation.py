@@ -1,5 +1,7 @@
 from jsonschema import Draft7Validator
 from pathlib import Path
+from probostitcher.profiles import PROFILES
+from typing import Dict
 from typing import List
 
 import json
@@ -8,6 +10,8 @@ import json
 SPECS_SCHEMA_JSON = json.loads(
     (Path(__file__).parent / "specs_schema.json").read_text()
 )
+# Profiles are only defined in Python: the schema accepts any of them
+SPECS_SCHEMA_JSON["properties"]["encoder_profile"]["enum"] = list(PROFILES)
 VALIDATOR = Draft7Validator(SPECS_SCHEMA_JSON)
 
 
@@ -17,3 +21,53 @@ def validate_specs_schema(specs_text: str) -> List[str]:
         f"{'.'.join(map(str, error.path))}: {error.message}"
         for error in VALIDATOR.iter_errors(to_validate)
     ]
+
+
+def validate_specs(specs_text: str) -> List[str]:
+    """Check the specs without looking at the inputs: the schema first, then
+    the consistency of the specs. Returns a list of errors (empty if valid).
+    """
+    try:
+        errors = validate_specs_schema(specs_text)
+    except ValueError as e:
+        return [f"Invalid JSON: {e}"]
+    if errors:
+        return errors
+    return validate_specs_semantics(json.loads(specs_text))
+
+
+def validate_specs_semantics(specs: Dict) -> List[str]:
+    """Check that milestones reference existing inputs and are sorted in time,
+    starting at 0 and within the output duration.
+    """
+    errors = []
+    streamnames = [el["streamname"] for el in specs["inputs"]]
+    for streamname in sorted(set(streamnames)):
+        if streamnames.count(streamname) > 1:
+            errors.append(f"inputs: streamname {streamname!r} is used more than once")
+    milestones = specs.get("milestones", [])
+    if not milestones:
+        errors.append("milestones: at least one milestone is required")
+    elif milestones[0].get("timestamp") != 0:
+        errors.append("milestones.0.timestamp: the first milestone must start at 0")
+    previous = None
+    for i, milestone in enumerate(milestones):
+        timestamp = milestone.get("timestamp")
+        if timestamp is None:
+            errors.append(f"milestones.{i}: timestamp is required")
+        elif previous is not None and timestamp <= previous:
+            errors.append(
+                f"milestones.{i}.timestamp: milestones must be sorted by timestamp"
+            )
+        elif timestamp >= specs["output_duration"]:
+            errors.append(
+                f"milestones.{i}.timestamp: {timestamp} is past the output duration"
+            )
+        previous = timestamp if timestamp is not None else previous
+        for j, video in enumerate(milestone.get("videos", [])):
+            if video["streamname"] not in streamnames:
+                errors.append(
+                    f"milestones.{i}.videos.{j}.streamname: "
+                    f"unknown streamname {video['streamname']!r}"
+                )
+    return errors
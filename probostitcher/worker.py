@@ -1,41 +1,470 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from probostitcher import Specs
-from probostitcher.s3 import exists
+from probostitcher.cache import CACHE_DIR
+from probostitcher.executor import FFMPEG_SLOTS
+from probostitcher.progress import forget_job
+from probostitcher.progress import JobProgress
+from probostitcher.queues import open_queue
+from probostitcher.queues import Queue
+from probostitcher.queues import QUEUE_ERRORS
+from probostitcher.queues import SQS_BATCH_SIZE
+from probostitcher.specs import duration
+from probostitcher.storage import get_storage
+from probostitcher.storage import STORAGE_ERRORS
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
 
-import boto3
+import fcntl
+import json
 import os
+import socket
+import threading
+import time
 
 
-QUEUE_NAME = os.environ["PROBOSTITCHER_QUEUE_NAME"]
-QUEUE_REGION = os.environ["PROBOSTITCHER_QUEUE_REGION"]
+#: Maximum number of jobs processed at the same time.
+#: Their ffmpeg processes share the same FFMPEG_SLOTS slots.
+MAX_JOBS = int(os.environ.get("PROBOSTITCHER_MAX_JOBS", 1))
+#: While a job is being processed its message is kept invisible for this many
+#: seconds, renewed every third of it. If the worker dies the message becomes
+#: visible again and another worker resumes the job.
+VISIBILITY_TIMEOUT = int(os.environ.get("PROBOSTITCHER_VISIBILITY_TIMEOUT", 120))
+#: Seconds between updates of the status of running jobs in the output bucket
+STATUS_INTERVAL = int(os.environ.get("PROBOSTITCHER_STATUS_INTERVAL", 5))
+#: If set, the worker serves the progress of its jobs on this port (see `server.serve_metrics`)
+METRICS_PORT = os.environ.get("PROBOSTITCHER_METRICS_PORT")
+METRICS_HOST = os.environ.get("PROBOSTITCHER_METRICS_HOST", "0.0.0.0")
 
+#: While a job is rendered its marker `inflight/<job id>.json` is refreshed every
+#: third of this many seconds. Older markers are left by dead workers, and ignored.
+INFLIGHT_TIMEOUT = int(
+    os.environ.get("PROBOSTITCHER_INFLIGHT_TIMEOUT", VISIBILITY_TIMEOUT)
+)
+#: Seconds between checks of whether a job rendered by another worker is done
+INFLIGHT_POLL_INTERVAL = 10
+#: Lock files of the jobs rendered on this machine
+INFLIGHT_DIR = CACHE_DIR / "inflight"
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
 
-def get_queue():
-    sqs = boto3.resource("sqs", region_name=QUEUE_REGION)
-    return sqs.get_queue_by_name(QueueName=QUEUE_NAME)
+#: If set, jobs at least this many seconds long are split into tasks rendered
+#: by any worker: one per chunk, one for the audio track and a final reduce
+#: task putting them together (see `distribute_job`)
+DISTRIBUTE_MIN_DURATION = int(
+    os.environ.get("PROBOSTITCHER_DISTRIBUTE_MIN_DURATION", 0)
+)
+#: Seconds before a reduce task whose pieces are not all rendered is tried again
+TASK_RETRY_INTERVAL = 15
+#: A distributed job fails when one of its tasks failed this many times
+TASK_MAX_ATTEMPTS = int(os.environ.get("PROBOSTITCHER_TASK_MAX_ATTEMPTS", 3))
+#: A distributed job fails if its pieces are not all rendered this many
+#: seconds after it was distributed
+DISTRIBUTE_TIMEOUT = int(os.environ.get("PROBOSTITCHER_DISTRIBUTE_TIMEOUT", 3600))
+
+JOB_SLOTS = threading.BoundedSemaphore(MAX_JOBS)
+#: Messages of successful jobs, deleted in batches by `delete_messages`
+PENDING_DELETES: List = []
+_PENDING_DELETES_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_queue() -> Queue:
+    """Return the queue (see `queues.open_queue`), looked up only once"""
+    return open_queue(max_connections=max(10, 2 * MAX_JOBS))
 
 
 def main():
-    print(f"Processing messages from queue {QUEUE_NAME} in region {QUEUE_REGION}")
-    while True:
-        process_messages()
+    print(f"Processing messages from {get_queue()}")
+    print(f"Storing videos in {get_storage()}")
+    print(f"Running up to {MAX_JOBS} jobs sharing {FFMPEG_SLOTS} ffmpeg processes")
+    if METRICS_PORT:
+        # The server imports this module: import it only when needed
+        from probostitcher.server import serve_metrics
 
+        threading.Thread(
+            target=serve_metrics,
+            args=(METRICS_HOST, int(METRICS_PORT)),
+            name="metrics",
+            daemon=True,
+        ).start()
+    if MAX_JOBS == 1:
+        while True:
+            process_messages()
+    with ThreadPoolExecutor(MAX_JOBS, thread_name_prefix="job") as executor:
+        while True:
+            process_messages(executor)
 
-def process_messages():
-    queue = get_queue()
-    for message in queue.receive_messages(WaitTimeSeconds=10):
+
+def process_messages(executor: Optional[ThreadPoolExecutor] = None):
+    """Receive messages from the queue and process them.
+    If `executor` is given jobs run there, and we ask for as many messages as
+    there are free job slots. Otherwise a single job runs before this function returns.
+    """
+    slots = acquire_job_slots(SQS_BATCH_SIZE if executor is not None else 1)
+    messages = []
+    try:
+        delete_messages()
+        messages = get_queue().receive(slots, wait=10)
+    finally:
+        # Give back the slots no message will use, even if the queue failed
+        for _ in range(slots - len(messages)):
+            JOB_SLOTS.release()
+    for message in messages:
         print("Received message")
-        message.delete()
+        if executor is None:
+            try:
+                process_message(message)
+            finally:
+                JOB_SLOTS.release()
+        else:
+            future = executor.submit(process_message, message)
+            future.add_done_callback(lambda _: JOB_SLOTS.release())
+
+
+class NotReady(Exception):
+    """Raised by tasks that can't run yet: their message is retried soon"""
+
+
+def process_message(message):
+    """Process the job or task in `message`, and schedule its deletion once it's done.
+    If the job fails the message is left on the queue, to be retried.
+    """
+    retry = False
+    with visibility_heartbeat(message):
+        try:
+            done = process_body(message.body, get_queue().receive_count(message))
+        except NotReady as e:
+            print(e)
+            done, retry = False, True
+    if retry:
+        try:
+            get_queue().postpone(message, TASK_RETRY_INTERVAL)
+        except QUEUE_ERRORS as e:
+            print(f"Could not reset message visibility: {e}")
+    if done:
+        with _PENDING_DELETES_LOCK:
+            PENDING_DELETES.append(message)
+
+
+def acquire_job_slots(maximum: int) -> int:
+    """Wait for a free job slot, then take up to `maximum` free ones.
+    Returns the number of slots taken.
+    """
+    JOB_SLOTS.acquire()
+    slots = 1
+    while slots < maximum and JOB_SLOTS.acquire(blocking=False):
+        slots += 1
+    return slots
+
+
+def delete_messages():
+    """Delete the messages of finished jobs, in batches.
+    If the worker dies before doing so the jobs are received again, and
+    skipped because their output already exists.
+    """
+    with _PENDING_DELETES_LOCK:
+        messages = PENDING_DELETES[:]
+        del PENDING_DELETES[:]
+    if messages:
+        get_queue().delete(messages)
+
+
+def process_body(body: str, attempt: int = 1) -> bool:
+    """Process a message: either a job (a specs file) or a task of a distributed job.
+    `attempt` is the number of times the message was received.
+    """
+    try:
+        task = json.loads(body)
+    except ValueError:
+        task = None  # Let `process_job` report the problem
+    if isinstance(task, dict) and "task" in task:
+        return process_task(task, attempt)
+    return process_job(body)
+
+
+def process_job(specs_json: str) -> bool:
+    """Render and upload the video specified in `specs_json`.
+    Chunks are checkpointed to the output bucket, so that if the job is retried
+    only the missing ones are rendered. The job progress is published to
+    `status/<job id>.json` whenever its state changes, and periodically while
+    it runs. If the same video is already being rendered, by this worker or
+    another one, waits for it instead (see `single_flight`).
+    Returns False if the job failed.
+    """
+    specs = None
+    try:
+        specs = Specs(
+            filecontents=specs_json, checkpoint_chunks=True, prefetch_inputs=True
+        )
+        print(f"Created specs object for {specs.output_filename}")
+        storage, output_key = get_storage(), f"output/{specs.output_filename}"
+        if storage.exists(output_key):
+            print(f"{specs.output_filename} already present: skipping")
+            skip_job(specs.progress)
+            return True
+        with single_flight(specs.job_id, lambda: storage.exists(output_key)) as render:
+            if not render:
+                print(f"{specs.output_filename} rendered by another job: skipping")
+                skip_job(specs.progress)
+                return True
+            # Start with fresh progress if the job was already run by this worker
+            forget_job(specs.job_id)
+            specs.progress.listeners.append(publish_status)
+            if DISTRIBUTE_MIN_DURATION and (
+                duration(specs.output_period) >= DISTRIBUTE_MIN_DURATION
+            ):
+                # The inflight marker is gone once the tasks are queued
+                if is_distributed(specs.job_id):
+                    print(f"{specs.output_filename} already distributed: skipping")
+                else:
+                    distribute_job(specs)
+                return True
+            print(f"Rendering and uploading {specs.output_filename}")
+            specs.progress.state = "preparing"
+            with every(STATUS_INTERVAL, lambda: publish_status(specs.progress)):
+                specs.upload()
+            print(f"{specs.output_filename} uploaded")
+    except Exception as e:
+        print(e)
+        if specs is not None:
+            fail_job(specs.progress, str(e))
+        return False
+    return True
+
+
+@contextmanager
+def single_flight(job_id: str, is_done: Callable[[], bool]) -> Iterator[bool]:
+    """Make sure only one job at a time renders `job_id`. Yields True if the
+    block should render it, False if `is_done()` became true while waiting.
+    Jobs on the same machine wait for a lock file in INFLIGHT_DIR; jobs on
+    other machines for the marker `inflight/<job id>.json` in the output bucket
+    to be removed or to expire. S3 can't create objects atomically, so two
+    workers starting the same job at the same moment might both render it.
+    """
+    storage = get_storage()
+    INFLIGHT_DIR.mkdir(parents=True, exist_ok=True)
+    marker = f"inflight/{job_id}.json"
+    # The lock is released when the file is closed, even if the process dies
+    with open(INFLIGHT_DIR / f"{job_id}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if is_done() or not wait_for_marker(marker, is_done):
+            yield False
+            return
+
+        def refresh():
+            try:
+                storage.put_json(
+                    marker, {"worker": WORKER_ID, "refreshed": time.time()}
+                )
+            except STORAGE_ERRORS as e:
+                print(f"Could not refresh {marker}: {e}")
+
+        # Other workers must see the marker before we start rendering
+        refresh()
         try:
-            specs = Specs(filecontents=message.body)
-            print(f"Created specs object for {specs.output_filename}")
-            if exists(f"output/{specs.output_filename}"):
-                print(f"{specs.output_filename} already present: skipping")
+            with every(INFLIGHT_TIMEOUT / 3, refresh, right_away=False):
+                yield True
+        finally:
+            try:
+                storage.delete(marker)
+            except STORAGE_ERRORS as e:
+                print(f"Could not delete {marker}: {e}")
+
+
+def wait_for_marker(marker: str, is_done: Callable[[], bool]) -> bool:
+    """Wait while another worker keeps `marker` fresh.
+    Returns False if `is_done()` became true in the meantime.
+    """
+    while True:
+        value = get_storage().get_json(marker)
+        if (
+            value is None
+            or value["worker"] == WORKER_ID
+            # Workers' clocks are assumed to be in sync within a few seconds
+            or time.time() - value["refreshed"] > INFLIGHT_TIMEOUT
+        ):
+            return True
+        print(f"{marker} held by {value['worker']}: waiting")
+        time.sleep(INFLIGHT_POLL_INTERVAL)
+        if is_done():
+            return False
+
+
+def distribute_job(specs: Specs):
+    """Queue the tasks rendering `specs` on any worker: one for every chunk and
+    one for the audio track, storing what they render under `chunks/` in the
+    output bucket, then a reduce task putting the pieces together.
+    Inputs are probed, but not downloaded, to tell the reduce task the keys of
+    the pieces: the other tasks only download the inputs they read.
+    """
+    specs.prefetch_inputs = False
+    common = {
+        # Every worker must see the same specs and split them the same way
+        "specs": specs.canonical_specs,
+        "segment_duration": specs.segment_duration,
+        "distributed_at": time.time(),
+    }
+    costs = {
+        i: (end - start) * len(specs.config["milestones"][milestone]["videos"])
+        for i, (milestone, start, end) in enumerate(specs.chunk_periods())
+    }
+    # The audio track and the most expensive chunks first, the reduce task last
+    by_cost = sorted(costs, key=costs.__getitem__, reverse=True)
+    tasks = [dict(common, task="audio")]
+    tasks += [dict(common, task="chunk", index=i) for i in by_cost]
+    tasks.append(dict(common, task="reduce", pieces=specs.stored_piece_keys()))
+    print(f"Distributing {specs.output_filename} in {len(tasks)} tasks")
+    get_storage().put_json(
+        f"distributed/{specs.job_id}.json",
+        {"worker": WORKER_ID, "distributed_at": common["distributed_at"]},
+    )
+    get_queue().send(
+        [json.dumps(task) for task in tasks],
+        delays=[0] * (len(tasks) - 1) + [TASK_RETRY_INTERVAL],
+    )
+    specs.progress.listeners.append(publish_status)
+    specs.progress.state = "rendering"
+
+
+def process_task(task: Dict, attempt: int = 1) -> bool:
+    """Run a task queued by `distribute_job`, for the `attempt`th time.
+    Returns False if it failed and should be retried. After TASK_MAX_ATTEMPTS
+    failed attempts, or if the pieces are still missing DISTRIBUTE_TIMEOUT
+    seconds after the job was distributed, the job fails. The tasks left of a
+    failed job are skipped.
+    Raises NotReady if it's a reduce task and some pieces are still missing.
+    """
+    specs = None
+    try:
+        specs = Specs(
+            filecontents=task["specs"],
+            segment_duration=task["segment_duration"],
+            checkpoint_chunks=True,
+        )
+        status = get_storage().get_json(f"status/{specs.job_id}.json")
+        if status is not None and status.get("state") == "failed":
+            print(f"{specs.output_filename} failed: skipping its {task['task']} task")
+        elif task["task"] == "chunk":
+            print(f"Rendering chunk {task['index']} of {specs.output_filename}")
+            specs.prefetch(specs.chunk_inputs(task["index"]))
+            specs.render_stored_chunk(task["index"])
+        elif task["task"] == "audio":
+            print(f"Rendering the audio track of {specs.output_filename}")
+            specs.prefetch(specs.audio_inputs())
+            specs.render_stored_audio()
+        elif get_storage().exists(f"output/{specs.output_filename}"):
+            print(f"{specs.output_filename} already present: skipping")
+        else:
+            # Without the keys of the pieces, it would probe every input
+            missing = specs.fetch_stored_pieces(task.get("pieces"))
+            waited = time.time() - task.get("distributed_at", time.time())
+            if missing and waited > DISTRIBUTE_TIMEOUT:
+                error = f"{len(missing)} pieces missing after {waited:.0f} seconds"
+                print(f"{specs.output_filename}: {error}")
+                fail_job(specs.progress, error)
+                end_distribution(specs.job_id)
+            elif missing:
+                raise NotReady(f"{specs.job_id}: {len(missing)} pieces missing")
             else:
-                print(f"Rendering and uploading {specs.output_filename}")
+                specs.progress.listeners.append(publish_status)
+                print(f"Putting {specs.output_filename} together and uploading it")
+                specs.assemble()
                 specs.upload()
                 print(f"{specs.output_filename} uploaded")
-        except Exception as e:
-            print(e)
+                end_distribution(specs.job_id)
+    except NotReady:
+        raise
+    except Exception as e:
+        print(e)
+        if specs is None or attempt < TASK_MAX_ATTEMPTS:
+            return False
+        fail_job(specs.progress, f"The {task['task']} task failed {attempt} times: {e}")
+        end_distribution(specs.job_id)
+    return True
+
+
+def is_distributed(job_id: str) -> bool:
+    """True if the tasks of the job were queued, and it's neither finished
+    nor timed out yet (see `DISTRIBUTE_TIMEOUT`)
+    """
+    marker = get_storage().get_json(f"distributed/{job_id}.json")
+    return (
+        marker is not None
+        and time.time() - marker["distributed_at"] < DISTRIBUTE_TIMEOUT
+    )
+
+
+def end_distribution(job_id: str):
+    """Let the job be distributed again, once it's uploaded or it failed"""
+    try:
+        get_storage().delete(f"distributed/{job_id}.json")
+    except STORAGE_ERRORS as e:
+        print(f"Could not remove the distribution marker of {job_id}: {e}")
+
+
+def fail_job(job: JobProgress, error: str):
+    """Mark a job as failed, publishing its status with the error"""
+    job.error = error
+    # The progress of a job is shared by its tasks in this process: it may
+    # have failed already, in which case listeners are not called again
+    changed = job.state != "failed"
+    job.state = "failed"
+    if not changed or publish_status not in job.listeners:
+        publish_status(job)
+
+
+def skip_job(job: JobProgress):
+    """Mark a job whose output already exists as done"""
+    job.state = "done"
+    publish_status(job)
+
+
+def publish_status(job: JobProgress):
+    """Store the progress of `job` in the output bucket, for the server to find"""
+    try:
+        get_storage().put_json(f"status/{job.job_id}.json", job.as_dict())
+    except STORAGE_ERRORS as e:
+        print(f"Could not publish the status of {job.job_id}: {e}")
+
+
+def visibility_heartbeat(message, timeout: int = VISIBILITY_TIMEOUT):
+    """Keep `message` invisible to other workers while the block runs"""
+
+    def beat():
+        try:
+            get_queue().change_visibility(message, timeout)
+        except QUEUE_ERRORS as e:
+            print(f"Could not extend message visibility: {e}")
+
+    return every(timeout / 3, beat)
+
+
+@contextmanager
+def every(interval: float, function: Callable[[], None], right_away: bool = True):
+    """Call `function` in a background thread right away (unless `right_away`
+    is False), then every `interval` seconds until the block exits.
+    """
+    stop = threading.Event()
+
+    def repeat():
+        if not right_away and stop.wait(interval):
+            return
+        while True:
+            function()
+            if stop.wait(interval):
+                return
+
+    thread = threading.Thread(target=repeat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
 
 
 if __name__ == "__main__":
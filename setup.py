@@ -26,6 +26,7 @@ setup(
         "console_scripts": [
             "probostitcher = probostitcher.server:main",
             "probostitcher-worker = probostitcher.worker:main",
+            "probostitcher-benchmark = probostitcher.benchmark:main",
         ],
     },
     packages=["probostitcher"],
@@ -0,0 +1,54 @@
+from probostitcher.admission import Measurements
+from probostitcher.benchmark import build_specs
+from probostitcher.benchmark import generate_inputs
+from probostitcher.cache import DiskCache
+
+import json
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    """Keep caches and measurements in a temporary directory, instead of
+    the user's cache directory
+    """
+    from probostitcher import admission
+    from probostitcher import cache
+    from probostitcher import specs
+    from probostitcher import worker
+
+    directory = tmp_path / "probostitcher-cache"
+    caches = {
+        "PROBE_CACHE": DiskCache(directory / "probe", 10 ** 8, suffix=".json"),
+        "CHUNK_CACHE": DiskCache(directory / "chunks", 10 ** 9, suffix=".webm"),
+        "INPUT_CACHE": DiskCache(directory / "inputs", 10 ** 9),
+    }
+    for name, value in caches.items():
+        monkeypatch.setattr(cache, name, value)
+        monkeypatch.setattr(specs, name, value)
+    measurements = Measurements(directory / "measurements.json")
+    monkeypatch.setattr(admission, "MEASUREMENTS", measurements)
+    monkeypatch.setattr(specs, "MEASUREMENTS", measurements)
+    monkeypatch.setattr(worker, "INFLIGHT_DIR", directory / "inflight")
+    return directory
+
+
+@pytest.fixture
+def specs_json(request, tmp_path):
+    """Specs of 2 generated participants, the second joining 2 seconds into
+    a 4 seconds call, switching between them at 2 milestones at 160x120 and 5 fps.
+    Tests can change any argument of `build_specs` (and `count` of
+    `generate_inputs`) with indirect parametrization.
+    """
+    shape = dict(duration=4, milestones=2, overlays=1, width=160, height=120, fps=5)
+    shape.update(getattr(request, "param", {}))
+    count = shape.pop("count", 2)
+    inputs = generate_inputs(
+        tmp_path / "inputs",
+        count,
+        shape["duration"],
+        shape["width"],
+        shape["height"],
+        shape["fps"],
+    )
+    return json.dumps(build_specs(inputs, **shape))
@@ -0,0 +1,58 @@
+from probostitcher.admission import Budget
+from probostitcher.admission import Cost
+from probostitcher.admission import Measurements
+from probostitcher.admission import MEMORY_HEADROOM
+from probostitcher.executor import FfmpegPool
+
+import threading
+
+
+def test_measurements(tmp_path):
+    path = tmp_path / "measurements.json"
+    default = Cost(2.0, 1000)
+    measurements = Measurements(path)
+    assert measurements.estimate("chunk", default) == default
+    measurements.record("chunk", Cost(1.0, 100))
+    measurements.record("chunk", Cost(2.0, 200))
+    # Later measurements move the average, and survive restarts
+    cores, memory = Measurements(path).estimate("chunk", default)
+    assert 1.0 < cores < 2.0
+    assert 100 * MEMORY_HEADROOM < memory < 200 * MEMORY_HEADROOM
+    assert Measurements(path).estimate("audio", default) == default
+
+
+def test_pool_admits_within_budget():
+    pool = FfmpegPool(2, budget=Cost(2.0, 1000))
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    # Too big for the budget, but nothing else is running
+    pool.submit("a", block, cost=Cost(1.0, 2000))
+    started.wait()
+    small = pool.submit("b", int, "1", cost=Cost(1.0, 0))
+    assert pool.pending() == 1
+    release.set()
+    assert small.result() == 1
+    assert pool.used == Cost(0.0, 0)
+
+
+def test_pools_share_budget():
+    budget = Budget(Cost(1.0, 1000))
+    first, second = FfmpegPool(1, budget), FfmpegPool(1, budget)
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    first.submit("a", block, cost=Cost(1.0, 0))
+    started.wait()
+    # The second pool has a free slot, but no room left in the budget
+    other = second.submit("b", int, "1", cost=Cost(1.0, 0))
+    assert second.pending() == 1
+    release.set()
+    assert other.result() == 1
+    assert budget.used == Cost(0.0, 0)
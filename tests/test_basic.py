@@ -1,11 +1,14 @@
 from pathlib import Path
 from probostitcher import Specs
+from probostitcher.profiles import ENCODER_PROFILE
 from probostitcher.specs import parse_ts
+from unittest.mock import Mock
 
 import json
 import os
 import probostitcher
 import pytest
+import time
 
 
 CREATE_VIDEO = os.environ.get("CREATE_VIDEO") is not None
@@ -90,3 +93,137 @@ def test_validation():
         "output_size: 'width' is a required property",
         ": 'output_duration' is a required property",
     ]
+
+    bad_one = json.loads(good_one_text)
+    bad_one["encoder_profile"] = "lossless"
+    [error] = validate_specs_schema(json.dumps(bad_one))
+    assert error.startswith("encoder_profile: 'lossless' is not one of")
+
+
+def test_semantic_validation():
+    from probostitcher.validation import validate_specs
+
+    good_one_text = (TEST_FILES_DIR / "example3.json").read_text()
+    assert validate_specs(good_one_text) == []
+    assert validate_specs("{") == [
+        "Invalid JSON: Expecting property name enclosed in double quotes: "
+        "line 1 column 2 (char 1)"
+    ]
+
+    bad_one = json.loads(good_one_text)
+    bad_one["milestones"][0]["timestamp"] = 1
+    bad_one["milestones"][2]["timestamp"] = bad_one["milestones"][1]["timestamp"]
+    bad_one["milestones"][1]["videos"][0]["streamname"] = "nobody"
+    assert validate_specs(json.dumps(bad_one)) == [
+        "milestones.0.timestamp: the first milestone must start at 0",
+        "milestones.1.videos.0.streamname: unknown streamname 'nobody'",
+        "milestones.2.timestamp: milestones must be sorted by timestamp",
+    ]
+
+
+def test_canonical_output_filename():
+    config = json.loads((TEST_FILES_DIR / "example3.json").read_text())
+    reference = Specs(filecontents=json.dumps(config))
+
+    reordered = dict(reversed(list(config.items())))
+    assert Specs(filecontents=json.dumps(reordered, indent=4)).output_filename == (
+        reference.output_filename
+    )
+    config["debug"] = False
+    config["milestones"][0]["videos"][0]["x"] = 0
+    assert Specs(filecontents=json.dumps(config)).output_filename == (
+        reference.output_filename
+    )
+    config["debug"] = True
+    assert Specs(filecontents=json.dumps(config)).output_filename != (
+        reference.output_filename
+    )
+
+    # Defaults are filled in
+    config = json.loads((TEST_FILES_DIR / "example3.json").read_text())
+    del config["output_framerate"]
+    reference = Specs(filecontents=json.dumps(config))
+    config["output_framerate"] = 25
+    config["encoder_profile"] = ENCODER_PROFILE
+    assert Specs(filecontents=json.dumps(config)).output_filename == (
+        reference.output_filename
+    )
+    config["encoder_profile"] = "archive" if ENCODER_PROFILE == "draft" else "draft"
+    assert Specs(filecontents=json.dumps(config)).output_filename != (
+        reference.output_filename
+    )
+
+
+def test_server_pins_encoder_profile(monkeypatch):
+    from probostitcher import server
+
+    submitted = []
+    monkeypatch.setattr(server, "submit_job", submitted.append)
+    storage = Mock()
+    storage.exists.return_value = False
+    storage.get_json.return_value = None
+    monkeypatch.setattr(server, "get_storage", lambda: storage)
+    specs_json = (TEST_FILES_DIR / "example3.json").read_text()
+    errors, specs = server.create_job(specs_json)
+    assert errors == []
+    assert submitted == [specs]
+    assert json.loads(specs.filecontents)["encoder_profile"] == ENCODER_PROFILE
+
+
+def test_phase_timings(monkeypatch):
+    def analyze_files(self):
+        time.sleep(0.2)
+        self._input_infos = {}
+
+    def prepare_chunks(self):
+        self.input_infos
+        self._chunks = []
+
+    monkeypatch.setattr(Specs, "_analyze_files", analyze_files)
+    monkeypatch.setattr(Specs, "_prepare_chunks", prepare_chunks)
+    specs = Specs(TEST_FILES_DIR / "example3.json")
+    with specs.timed("chunks"):
+        assert specs.chunks == []
+    # Probing lazily while building graphs is timed as probing
+    assert specs.timings["probe"] >= 0.2
+    assert specs.timings["graph"] < 0.1
+    assert specs.timings["chunks"] < 0.1
+
+
+def test_server_skips_rendered_jobs(monkeypatch):
+    from probostitcher import server
+
+    submitted = []
+    monkeypatch.setattr(server, "submit_job", submitted.append)
+    storage = Mock()
+    storage.exists.return_value = True
+    monkeypatch.setattr(server, "get_storage", lambda: storage)
+    specs_json = (TEST_FILES_DIR / "example3.json").read_text()
+    errors, specs = server.create_job(specs_json)
+    assert submitted == []
+    storage.exists.assert_called_once_with(f"output/{specs.output_filename}")
+    [(key, status)] = [call.args for call in storage.put_json.call_args_list]
+    assert key == f"status/{specs.job_id}.json"
+    assert status["state"] == "done"
+
+
+def test_server_keeps_active_status(monkeypatch):
+    from probostitcher import server
+
+    submitted = []
+    monkeypatch.setattr(server, "submit_job", submitted.append)
+    storage = Mock()
+    storage.exists.return_value = False
+    storage.get_json.return_value = {"state": "rendering", "progress": 0.5}
+    monkeypatch.setattr(server, "get_storage", lambda: storage)
+    specs_json = (TEST_FILES_DIR / "example3.json").read_text()
+    errors, specs = server.create_job(specs_json)
+    assert submitted == [specs]
+    storage.put_json.assert_not_called()
+
+    # Storage errors are reported like validation errors
+    storage.exists.side_effect = OSError("storage unreachable")
+    errors, specs = server.create_job(specs_json)
+    assert specs is None
+    assert "storage unreachable" in errors[0]
+    assert len(submitted) == 1
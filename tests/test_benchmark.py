@@ -0,0 +1,43 @@
+from probostitcher.benchmark import build_specs
+from probostitcher.benchmark import main
+from probostitcher.benchmark import summarize
+from probostitcher.validation import validate_specs_schema
+
+import json
+import pytest
+import shutil
+
+
+def test_build_specs():
+    inputs = [
+        {"filename": f"{name}.webm", "streamname": name}
+        for name in ("a", "a-audio", "b", "b-audio", "c", "c-audio")
+    ]
+    specs = build_specs(
+        inputs, duration=60, milestones=4, overlays=1, width=640, height=480, fps=15
+    )
+    assert validate_specs_schema(json.dumps(specs)) == []
+    assert [el["timestamp"] for el in specs["milestones"]] == [0, 15, 30, 45]
+    assert [
+        [video["streamname"] for video in el["videos"]] for el in specs["milestones"]
+    ] == [["a", "b"], ["b", "a"], ["c", "a"], ["a", "b"]]
+
+
+def test_summarize():
+    runs = [{"probe": 1.0, "total": 3.0}, {"probe": 2.0, "total": 5.0}]
+    assert summarize(runs)["probe"] == {"min": 1.0, "median": 1.5, "max": 2.0}
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_results_on_standard_output(capfd, tmp_path):
+    baseline = tmp_path / "baseline.json"
+    options = ["--participants", "2", "--duration", "2", "--fps", "5"]
+    options += ["--input-width", "160", "--input-height", "120"]
+    options += ["--width", "160", "--height", "120", "--milestones", "1"]
+    options += ["--overlays", "1", "--repeat", "1", "--workdir", str(tmp_path)]
+    main(options)
+    baseline.write_text(capfd.readouterr().out)
+    assert len(json.loads(baseline.read_text())["runs"]) == 1
+    # Comparing with the baseline doesn't mix the comparison in
+    main(options + ["--compare", str(baseline)])
+    assert len(json.loads(capfd.readouterr().out)["runs"]) == 1
@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+from probostitcher.cache import DiskCache
+
+import os
+import time
+
+
+def test_disk_cache_json(tmp_path):
+    cache = DiskCache(tmp_path, max_size=1024 ** 2, suffix=".json")
+    assert cache.get_json("foo") is None
+    cache.put_json("foo", {"bar": 1})
+    assert cache.get_json("foo") == {"bar": 1}
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(tmp_path / "cache", max_size=250)
+    for name in ("first", "second", "third"):
+        source = tmp_path / name
+        source.write_bytes(b"x" * 100)
+        cache.put_file(name, str(source))
+        # Make sure modification times differ
+        os.utime(cache.path(name), (0, {"first": 1, "second": 2, "third": 3}[name]))
+        cache.evict()
+    assert cache.get("first") is None
+    assert cache.get("second") is not None
+    assert cache.get("third") is not None
+    assert cache.size() == 200
+
+
+def test_disk_cache_fetch_downloads_once(tmp_path):
+    cache = DiskCache(tmp_path, max_size=1024 ** 2)
+    downloads = []
+
+    def download(filename):
+        downloads.append(filename)
+        time.sleep(0.1)
+        with open(filename, "w") as fh:
+            fh.write("contents")
+
+    with ThreadPoolExecutor(4) as executor:
+        paths = list(executor.map(lambda _: cache.fetch("foo", download), range(4)))
+    assert len(downloads) == 1
+    assert set(paths) == {cache.path("foo")}
+    assert cache.path("foo").read_text() == "contents"
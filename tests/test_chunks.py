@@ -0,0 +1,38 @@
+from probostitcher.specs import Specs
+from probostitcher.specs import split_segments
+
+import json
+import pytest
+import shutil
+
+
+@pytest.mark.parametrize(
+    "start,end,segment_duration,expected",
+    [
+        (0, 20, 30, [(0, 20)]),
+        (0, 20, 0, [(0, 20)]),
+        (0, 90, 30, [(0, 30), (30, 60), (60, 90)]),
+        (10, 100, 30, [(10, 30), (30, 60), (60, 90), (90, 100)]),
+        # Short segments at the edges are merged with their neighbours
+        (28, 95, 30, [(28, 60), (60, 95)]),
+    ],
+)
+def test_split_segments(start, end, segment_duration, expected):
+    assert split_segments(start, end, segment_duration) == expected
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_debug_prints_graphs(monkeypatch, tmp_path, capsys, specs_json):
+    config = dict(json.loads(specs_json), debug=True)
+    specs = Specs(filecontents=json.dumps(config), use_chunk_cache=False)
+    monkeypatch.setattr(Specs, "render_videos", lambda *args, **kwargs: None)
+    monkeypatch.setattr(Specs, "assemble", lambda *args, **kwargs: None)
+    specs.render(str(tmp_path / "output.webm"))
+    graphs = capsys.readouterr().err.split("# Chunk ")
+    # Only the first participant is in the first chunk, one filter per line
+    first = graphs[1].splitlines()
+    assert first[0] == "0: 0s-2s"
+    assert first[1].startswith("[0]scale=")
+    assert first[-1].startswith("[s7]drawtext=")
+    assert not any(line.startswith("[1]") for line in first)
+    assert graphs[2].splitlines()[0] == "1: 2s-4s"
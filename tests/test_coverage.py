@@ -0,0 +1,42 @@
+from probostitcher.coverage import Coverage
+from probostitcher.specs import Specs
+
+import pytest
+import shutil
+import subprocess
+
+
+def test_coverage():
+    coverage = Coverage({"a": (0, 10), "b": (5, 6), "c": (20, 30), "d": (8, 25)})
+    assert coverage.overlapping(0, 5) == ["a"]
+    assert coverage.overlapping(5, 9) == ["a", "b", "d"]
+    assert coverage.overlapping(10, 20) == ["d"]
+    assert coverage.overlapping(26, 40) == ["c"]
+    assert coverage.overlapping(30, 40) == []
+    assert Coverage({}).overlapping(0, 10) == []
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_uncovered_videos_are_not_read(tmp_path, specs_json):
+    # The second participant joins 2 seconds in, when the second milestone starts
+    specs = Specs(
+        filecontents=specs_json,
+        use_chunk_cache=False,
+        use_probe_cache=False,
+    )
+    assert specs.chunk_inputs(0) == ["participant-0"]
+    assert specs.chunk_inputs(1) == ["participant-0", "participant-1"]
+    first, second = specs.chunks[0], specs.chunks[-1]
+    for chunk, inputs_read in ((first, 1), (second, 2)):
+        filename = str(tmp_path / f"{chunk.start}.webm")
+        args = specs.chunk_command(chunk, filename)
+        assert args.count("-i") == inputs_read
+        subprocess.run(args, check=True, capture_output=True)
+        duration = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration"]
+            + ["-of", "csv=p=0", filename],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        assert float(duration) == pytest.approx(chunk.end - chunk.start, abs=0.3)
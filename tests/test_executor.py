@@ -0,0 +1,79 @@
+from probostitcher.executor import Batch
+from probostitcher.executor import FfmpegPool
+from probostitcher.executor import get_pool
+from probostitcher.executor import TaskTimeout
+from probostitcher.progress import FfmpegError
+from probostitcher.specs import run_ffmpeg
+
+import pytest
+import shutil
+import signal
+import threading
+import time
+
+
+def test_groups_interleave():
+    pool = FfmpegPool(1)
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    pool.submit("blocker", block)
+    started.wait()
+    order = []
+    futures = [
+        pool.submit(group, order.append, name)
+        for group, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")]
+    ]
+    assert pool.pending() == 4
+    release.set()
+    for future in futures:
+        future.result()
+    assert order == ["a1", "b1", "a2", "a3"]
+
+
+def test_exceptions_are_propagated():
+    pool = FfmpegPool(2)
+    future = pool.submit("job", int, "not a number")
+    assert isinstance(future.exception(), ValueError)
+    assert pool.map("job", int, ["1", "2"]) == [1, 2]
+
+
+def test_pools_are_reused():
+    assert get_pool(3) is get_pool(3)
+    assert get_pool(3).budget is get_pool(2).budget
+
+
+def test_batch_cancels_pending_tasks():
+    pool = FfmpegPool(1)
+    batch = Batch(pool, "job")
+    batch.submit(int, "not a number")
+    pending = batch.submit(int, "1")
+    with pytest.raises(ValueError):
+        batch.wait()
+    assert pending.cancelled()
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_batch_kills_running_processes(tmp_path):
+    batch = Batch(FfmpegPool(2), "job")
+    endless = ["ffmpeg", "-re", "-f", "lavfi", "-i", "testsrc", "-f", "null", "-"]
+    running = batch.submit(run_ffmpeg, endless)
+    batch.submit(time.sleep, 0.5)
+    batch.submit(run_ffmpeg, ["ffmpeg", "-i", str(tmp_path / "missing.webm"), "-"])
+    start = time.monotonic()
+    with pytest.raises(FfmpegError, match="missing.webm"):
+        batch.wait()
+    assert time.monotonic() - start < 5
+    assert running.exception().returncode == -signal.SIGKILL
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_batch_timeout():
+    batch = Batch(FfmpegPool(1), "job")
+    endless = ["ffmpeg", "-re", "-f", "lavfi", "-i", "testsrc", "-f", "null", "-"]
+    batch.submit(run_ffmpeg, endless, timeout=0.5)
+    with pytest.raises(TaskTimeout):
+        batch.wait()
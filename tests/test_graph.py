@@ -0,0 +1,31 @@
+from probostitcher.graph import Step
+from probostitcher.graph import Track
+
+
+def test_scales_are_merged():
+    track = Track(None, 640, 480).scale(640, 480).filter("fps", 5)
+    track.scale(320, 240).pad(320, 240)
+    assert track.optimized_steps() == [
+        Step("scale", (320, 240), {}),
+        Step("pad", (320, 240), {}),
+        Step("fps", (5,), {}),
+    ]
+
+
+def test_geometry_is_kept_when_size_fits():
+    # Later frames may have another size: they must still fit the box
+    track = Track(None, 640, 480).scale(640, 480).pad(640, 480)
+    track.pad_after(2.0, 5)
+    assert track.optimized_steps() == [
+        Step("scale", (640, 480), {}),
+        Step("pad", (640, 480), {}),
+        Step("pad_after", (2.0, 5), {}),
+    ]
+
+
+def test_pad_is_kept_when_aspect_ratio_changes():
+    track = Track(None, 640, 480).scale(200, 120).pad(200, 120)
+    assert track.optimized_steps() == [
+        Step("scale", (200, 120), {}),
+        Step("pad", (200, 120), {}),
+    ]
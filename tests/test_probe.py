@@ -0,0 +1,49 @@
+import pytest
+import subprocess
+
+
+def test_probe_retries_remote_inputs(monkeypatch):
+    from probostitcher import specs
+
+    calls = []
+
+    def fake_probe(filename, **options):
+        calls.append(filename)
+        if len(calls) < 3:
+            raise subprocess.TimeoutExpired("ffprobe", options["timeout"])
+        return {"streams": []}
+
+    monkeypatch.setattr(specs.ffmpeg, "probe", fake_probe)
+    result = specs.probe("https://example.com/a.webm", backoff=0, log=lambda _: None)
+    assert result == {"streams": []}
+    assert len(calls) == 3
+
+
+def test_probe_gives_up(monkeypatch):
+    from probostitcher import specs
+
+    def fake_probe(filename, **options):
+        raise subprocess.TimeoutExpired("ffprobe", options["timeout"])
+
+    monkeypatch.setattr(specs.ffmpeg, "probe", fake_probe)
+    with pytest.raises(ValueError):
+        specs.probe("https://example.com/a.webm", backoff=0, log=lambda _: None)
+
+
+def test_probe_keyframes_reads_window(monkeypatch):
+    from probostitcher import specs
+
+    calls = []
+
+    def fake_probe(filename, **options):
+        calls.append(options)
+        packets = [{"pts_time": "4.000000", "flags": "K__"}]
+        packets.append({"pts_time": "4.500000", "flags": "___"})
+        return {"streams": [], "packets": packets}
+
+    monkeypatch.setattr(specs.ffmpeg, "probe", fake_probe)
+    url = "https://example.com/a.webm"
+    assert specs.probe_keyframes(url, 5, 10, backoff=0) == [4.0]
+    [options] = calls
+    assert options["read_intervals"] == "5.000000%10.000000"
+    assert options["timeout"] == specs.FFPROBE_TIMEOUT
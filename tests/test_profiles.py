@@ -0,0 +1,22 @@
+from probostitcher.profiles import PROFILES
+from probostitcher.profiles import thread_budget
+
+import os
+
+
+def test_output_options():
+    options = PROFILES["draft"].output_options(threads=3)
+    assert options["vcodec"] == "libvpx-vp9"
+    assert options["deadline"] == "realtime"
+    assert options["threads"] == 3
+    assert options["row-mt"] == 1
+
+    vp8 = PROFILES["draft"]._replace(codec="libvpx").output_options(threads=3)
+    assert "row-mt" not in vp8 and "tile-columns" not in vp8
+
+
+def test_thread_budget():
+    cores = len(os.sched_getaffinity(0))
+    assert thread_budget(1) == cores
+    assert thread_budget(cores) == 1
+    assert thread_budget(cores * 4) == 1
@@ -0,0 +1,52 @@
+from probostitcher.progress import JobProgress
+from probostitcher.progress import prometheus_metrics
+from probostitcher.progress import track_job
+
+import io
+
+
+PROGRESS_OUTPUT = """frame=50
+fps=25.00
+out_time_us=2000000
+speed=2.5x
+progress=continue
+frame=100
+fps=25.00
+out_time_us=4000000
+speed=2.1x
+progress=end
+"""
+
+
+def test_task_progress_parses_ffmpeg_output(monkeypatch):
+    job = JobProgress("job")
+    task = job.task("chunk-0", 8)
+    monkeypatch.setattr("builtins.open", lambda fd: io.StringIO(PROGRESS_OUTPUT))
+    task.follow(0, None)
+    assert task.frame == 100
+    assert task.speed == 2.1
+    assert task.done == 4
+    assert job.ratio == 0.5
+    task.finish(cpu_time=3)
+    assert job.ratio == 1
+    assert job.cpu_time == 3
+
+
+def test_prometheus_metrics():
+    job = track_job("some-job")
+    job.task("audio", 10).finish(cpu_time=1.5)
+    text = prometheus_metrics()
+    assert 'probostitcher_job_progress_ratio{job="some-job",state="queued"} 1.0' in text
+    assert (
+        'probostitcher_task_cpu_seconds_total{job="some-job",task="audio"} 1.5' in text
+    )
+
+
+def test_job_progress_listeners():
+    job = JobProgress("job")
+    states = []
+    job.listeners.append(lambda job: states.append(job.state))
+    job.state = "rendering"
+    job.state = "rendering"
+    job.state = "done"
+    assert states == ["rendering", "done"]
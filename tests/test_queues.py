@@ -0,0 +1,35 @@
+from probostitcher.queues import SqliteQueue
+
+
+def test_sqlite_queue(tmp_path):
+    queue = SqliteQueue(str(tmp_path / "queue.db"), visibility_timeout=60)
+    queue.send(["first", "second", "later"], delays=[0, 0, 60])
+    first, second = queue.receive(10, wait=0)
+    assert (first.body, second.body) == ("first", "second")
+    # Received messages are hidden, also from other processes
+    assert SqliteQueue(queue.path).receive(10, wait=0) == []
+
+    queue.change_visibility(first, 0)
+    [again] = queue.receive(10, wait=0)
+    assert again.body == "first"
+    # Only the last receiver can delete a message
+    queue.delete([first, second])
+    assert len(queue) == 2
+    queue.delete([again])
+    assert len(queue) == 1
+
+
+def test_sqlite_queue_dead_letters(tmp_path):
+    queue = SqliteQueue(str(tmp_path / "queue.db"), max_receives=2)
+    queue.send(["poison", "not ready"])
+    for receive_count in (1, 2):
+        poison, not_ready = queue.receive(10, wait=0)
+        assert queue.receive_count(poison) == receive_count
+        queue.change_visibility(poison, 0)
+        # Postponed messages are not counted
+        queue.postpone(not_ready, 0)
+    [not_ready] = queue.receive(10, wait=0)
+    assert not_ready.body == "not ready"
+    assert queue.receive_count(not_ready) == 1
+    assert queue.dead_letters() == ["poison"]
+    assert len(queue) == 1
@@ -0,0 +1,81 @@
+from probostitcher.benchmark import START_TIMESTAMP
+from probostitcher.specs import Specs
+
+import json
+import pytest
+import shutil
+import subprocess
+
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="ffmpeg is not installed"
+)
+
+
+def encode(source: str, filename: str, *options: str):
+    comment = json.dumps({"u": START_TIMESTAMP})
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", source, *options]
+        + ["-metadata:s:0", f"COMMENT={comment}", "-y", filename],
+        check=True,
+    )
+
+
+@pytest.fixture
+def specs(tmp_path):
+    """Specs showing a single VP9 recording with a keyframe every second,
+    starting 1.3 seconds into it
+    """
+    video, audio = str(tmp_path / "video.webm"), str(tmp_path / "audio.opus")
+    encode(
+        "testsrc2=size=160x120:rate=5:duration=12",
+        video,
+        *("-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8"),
+        *("-g", "5", "-pix_fmt", "yuv420p"),
+    )
+    encode("sine=duration=12", audio, "-c:a", "libopus")
+    config = {
+        "inputs": [
+            {"filename": video, "streamname": "speaker"},
+            {"filename": audio, "streamname": "speaker-audio"},
+        ],
+        "output_start": START_TIMESTAMP + 1300000,
+        "output_duration": 9,
+        "output_framerate": 5,
+        "output_size": {"width": 160, "height": 120},
+        "milestones": [{"timestamp": 0, "videos": [{"streamname": "speaker"}]}],
+    }
+    return lambda **options: Specs(
+        filecontents=json.dumps(config),
+        use_chunk_cache=False,
+        use_probe_cache=False,
+        **options,
+    )
+
+
+def test_stream_copy(specs, tmp_path):
+    spliced = specs()
+    [chunk] = spliced.chunks
+    head, copy, tail = chunk.pieces
+    assert copy.copy
+    assert (head.start, tail.end) == (0, 9)
+    # The copied span goes from the keyframe at 2s to the one at 10s
+    assert copy.start == pytest.approx(0.7)
+    assert copy.end == pytest.approx(8.7)
+    assert chunk.cost == pytest.approx(1)
+
+    destination = str(tmp_path / "output.webm")
+    spliced.render(destination)
+    frames = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v", "-count_frames"]
+        + ["-show_entries", "stream=nb_read_frames", "-of", "csv=p=0", destination],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    assert int(frames) == 45
+
+
+def test_stream_copy_disabled(specs):
+    [chunk] = specs(stream_copy=False).chunks
+    assert chunk.pieces is None
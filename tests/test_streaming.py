@@ -0,0 +1,60 @@
+from probostitcher import specs
+from probostitcher.specs import Specs
+
+import pytest
+import shutil
+import subprocess
+import threading
+
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="ffmpeg is not installed"
+)
+
+
+def test_failing_chunk_stops_streaming(monkeypatch, tmp_path, specs_json):
+    stream_ffmpeg = specs.stream_ffmpeg
+
+    def failing_stream_ffmpeg(args, output, task):
+        if task.name == "chunk-1":
+            # Like a task failing before ffmpeg starts: nothing is put in `output`
+            raise RuntimeError("chunk-1 failed")
+        stream_ffmpeg(args, output, task)
+
+    monkeypatch.setattr(specs, "stream_ffmpeg", failing_stream_ffmpeg)
+    rendering = Specs(
+        filecontents=specs_json, streaming=True, use_chunk_cache=False, parallelism=2
+    )
+    errors = []
+
+    def render():
+        try:
+            rendering.render(str(tmp_path / "output.webm"))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=render, daemon=True)
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive()
+    assert [str(error) for error in errors] == ["chunk-1 failed"]
+
+
+def test_stream_cached_and_encoded_chunks(monkeypatch, tmp_path, specs_json):
+    cached = Specs(filecontents=specs_json)
+    cached.render_videos(str(tmp_path / "final.webm"))
+    # The first chunk is remuxed from the cache, the second one encoded
+    assert specs.CHUNK_CACHE.get(cached.chunk_key(cached.chunks[0])) is not None
+    specs.CHUNK_CACHE.get(cached.chunk_key(cached.chunks[1])).unlink()
+
+    output = str(tmp_path / "output.webm")
+    Specs(filecontents=specs_json, streaming=True).render(output)
+    timestamps = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v"]
+        + ["-show_entries", "packet=pts_time", "-of", "csv=p=0", output],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    # 4 seconds at 5 frames per second
+    assert [float(el) for el in timestamps] == pytest.approx([i / 5 for i in range(20)])
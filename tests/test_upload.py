@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import time
+
+
+class FakeClient:
+    def __init__(self):
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+
+    def create_multipart_upload(self, **kwargs):
+        return {"UploadId": "upload"}
+
+    def upload_part(self, PartNumber, Body, **kwargs):
+        self.parts[PartNumber] = Body
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, MultipartUpload, **kwargs):
+        self.completed = b"".join(
+            self.parts[part["PartNumber"]] for part in MultipartUpload["Parts"]
+        )
+
+    def abort_multipart_upload(self, **kwargs):
+        self.aborted = True
+
+
+def write_slowly(filename, fail=False):
+    with open(filename, "wb") as fh:
+        for i in range(5):
+            fh.write(bytes([i]) * 40)
+            fh.flush()
+            time.sleep(0.05)
+    if fail:
+        raise RuntimeError("ffmpeg failed")
+
+
+def test_upload_growing_file(monkeypatch, tmp_path):
+    from probostitcher import s3
+
+    client = FakeClient()
+    monkeypatch.setattr(s3, "get_boto_client", lambda: client)
+    monkeypatch.setattr(s3, "UPLOAD_POLL_INTERVAL", 0.01)
+    filename = str(tmp_path / "video.webm")
+    with ThreadPoolExecutor(1) as executor:
+        writer = executor.submit(write_slowly, filename)
+        s3.upload_growing_file(filename, "output/video.webm", writer, part_size=64)
+    with open(filename, "rb") as fh:
+        assert client.completed == fh.read()
+    assert [len(client.parts[i]) for i in sorted(client.parts)] == [64, 64, 64, 8]
+
+
+def test_upload_growing_file_aborts(monkeypatch, tmp_path):
+    from probostitcher import s3
+
+    client = FakeClient()
+    monkeypatch.setattr(s3, "get_boto_client", lambda: client)
+    monkeypatch.setattr(s3, "UPLOAD_POLL_INTERVAL", 0.01)
+    filename = str(tmp_path / "video.webm")
+    with ThreadPoolExecutor(1) as executor:
+        writer = executor.submit(write_slowly, filename, fail=True)
+        with pytest.raises(RuntimeError):
+            s3.upload_growing_file(filename, "output/video.webm", writer, part_size=64)
+    assert client.aborted
+    assert client.completed is None
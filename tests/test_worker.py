@@ -0,0 +1,228 @@
+from concurrent.futures import ThreadPoolExecutor
+from probostitcher.cache import DiskCache
+
+import json
+import pytest
+import shutil
+import threading
+import time
+
+
+@pytest.fixture
+def local_backends(monkeypatch, tmp_path):
+    """Store objects in a temporary directory and queue messages in memory"""
+    from probostitcher import storage
+    from probostitcher import worker
+
+    monkeypatch.setenv("PROBOSTITCHER_STORAGE_DIR", str(tmp_path / "storage"))
+    monkeypatch.setenv("PROBOSTITCHER_QUEUE_PATH", ":memory:")
+    storage.get_storage.cache_clear()
+    worker.get_queue.cache_clear()
+    yield storage.get_storage(), worker.get_queue()
+    storage.get_storage.cache_clear()
+    worker.get_queue.cache_clear()
+
+
+def test_single_flight(monkeypatch, local_backends):
+    from probostitcher import worker
+
+    storage, _ = local_backends
+    monkeypatch.setattr(worker, "INFLIGHT_POLL_INTERVAL", 0.01)
+    renders = []
+    done = threading.Event()
+
+    def job():
+        with worker.single_flight("job", done.is_set) as render:
+            if render:
+                assert storage.exists("inflight/job.json")
+                time.sleep(0.1)
+                renders.append(1)
+                done.set()
+        return render
+
+    with ThreadPoolExecutor(3) as executor:
+        results = list(executor.map(lambda _: job(), range(3)))
+    assert sorted(results) == [False, False, True]
+    assert renders == [1]
+    assert not storage.exists("inflight/job.json")
+
+    # Another worker is rendering the same job: wait until it's done
+    marker = "inflight/other.json"
+    storage.put_json(marker, {"worker": "elsewhere", "refreshed": time.time()})
+    threading.Timer(0.1, storage.delete, args=(marker,)).start()
+    with worker.single_flight("other", lambda: not storage.exists(marker)) as render:
+        assert not render
+
+    # A stale marker is ignored
+    storage.put_json(marker, {"worker": "elsewhere", "refreshed": 0})
+    with worker.single_flight("other", lambda: False) as render:
+        assert render
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_distributed_job(monkeypatch, tmp_path, local_backends, specs_json):
+    from probostitcher import specs
+    from probostitcher import worker
+
+    storage, queue = local_backends
+    monkeypatch.setattr(worker, "DISTRIBUTE_MIN_DURATION", 1)
+    monkeypatch.setattr(worker, "TASK_RETRY_INTERVAL", 0)
+
+    assert worker.process_job(specs_json)
+    messages = queue.receive(10, wait=0)
+    tasks = [json.loads(message.body)["task"] for message in messages]
+    assert tasks == ["audio", "chunk", "chunk", "reduce"]
+    job_id = specs.Specs(filecontents=specs_json).job_id
+    assert storage.get_json(f"status/{job_id}.json")["state"] == "rendering"
+
+    # The same job submitted again is not distributed twice
+    assert worker.process_job(specs_json)
+    assert queue.receive(10, wait=0) == []
+
+    # The reduce task is retried until all pieces are there
+    for message in messages[-1:] + messages[:-1]:
+        worker.process_message(message)
+    worker.delete_messages()
+    assert len(list((storage.directory / "chunks").glob("*.webm"))) == 3
+    [reduce] = queue.receive(10, wait=0)
+
+    # The reduce task runs on another machine, with an empty chunk cache.
+    # It's given the keys of the pieces: it doesn't probe inputs.
+    monkeypatch.setattr(specs, "CHUNK_CACHE", DiskCache(tmp_path / "other", 10 ** 9))
+
+    def analyze_files(self):
+        raise AssertionError("inputs probed")
+
+    monkeypatch.setattr(specs.Specs, "_analyze_files", analyze_files)
+    worker.process_message(reduce)
+    worker.delete_messages()
+    assert len(queue) == 0
+    assert storage.exists(f"output/{job_id}.webm")
+    assert storage.get_json(f"status/{job_id}.json")["state"] == "done"
+    assert not storage.exists(f"distributed/{job_id}.json")
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_distributed_job_fails(monkeypatch, local_backends, specs_json):
+    from probostitcher import specs
+    from probostitcher import worker
+
+    storage, queue = local_backends
+    monkeypatch.setattr(worker, "DISTRIBUTE_MIN_DURATION", 1)
+    monkeypatch.setattr(worker, "TASK_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(worker, "TASK_RETRY_INTERVAL", 0)
+
+    def fail(self, index):
+        raise RuntimeError(f"chunk {index} failed")
+
+    monkeypatch.setattr(specs.Specs, "render_stored_chunk", fail)
+    assert worker.process_job(specs_json)
+    bodies = [message.body for message in queue.receive(10, wait=0)]
+    assert [json.loads(body)["task"] for body in bodies][-1] == "reduce"
+    job_id = specs.Specs(filecontents=specs_json).job_id
+    status = f"status/{job_id}.json"
+
+    # A failed chunk is retried, until it failed TASK_MAX_ATTEMPTS times
+    assert not worker.process_body(bodies[1], 1)
+    assert storage.get_json(status)["state"] == "rendering"
+    assert worker.process_body(bodies[1], 2)
+    assert storage.get_json(status)["state"] == "failed"
+    assert "chunk 0 failed" in storage.get_json(status)["error"]
+    # A failed job can be submitted again
+    assert not storage.exists(f"distributed/{job_id}.json")
+
+    # The tasks left are skipped
+    assert worker.process_body(bodies[2], 1)
+    assert worker.process_body(bodies[-1], 1)
+    assert storage.get_json(status)["state"] == "failed"
+
+    # Without failures, the reduce gives up waiting for missing pieces
+    storage.delete(status)
+    with pytest.raises(worker.NotReady):
+        worker.process_body(bodies[-1], 1)
+    monkeypatch.setattr(worker, "DISTRIBUTE_TIMEOUT", 0)
+    assert worker.process_body(bodies[-1], 1)
+    assert "pieces missing" in storage.get_json(status)["error"]
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_message_lifecycle(monkeypatch, tmp_path, local_backends, specs_json):
+    from probostitcher import specs
+    from probostitcher import worker
+
+    storage, queue = local_backends
+    reference = specs.Specs(filecontents=specs_json)
+    chunk_keys = [
+        f"chunks/{reference.chunk_key(chunk)}.webm" for chunk in reference.chunks
+    ]
+
+    # The job fails after rendering its chunks: its message is left on the
+    # queue, and its chunks in the output bucket
+    def fail(self, *args, **kwargs):
+        raise RuntimeError("assembling failed")
+
+    assemble = specs.Specs.assemble
+    monkeypatch.setattr(specs.Specs, "assemble", fail)
+    queue.send([specs_json])
+    [message] = queue.receive(1, wait=0)
+    worker.process_message(message)
+    worker.delete_messages()
+    assert len(queue) == 1
+    assert storage.get_json(f"status/{reference.job_id}.json")["state"] == "failed"
+    assert all(storage.exists(key) for key in chunk_keys)
+
+    # It's retried by another worker, reusing the chunks. The message is only
+    # deleted once the video is uploaded.
+    monkeypatch.setattr(specs.Specs, "assemble", assemble)
+    monkeypatch.setattr(specs, "CHUNK_CACHE", DiskCache(tmp_path / "other", 10 ** 9))
+    rendered = []
+    monkeypatch.setattr(specs, "render_chunk", lambda *args: rendered.append(args))
+    queued_at_upload = []
+    upload = storage.upload
+
+    def upload_and_count(filename, key):
+        queued_at_upload.append(len(queue))
+        upload(filename, key)
+
+    monkeypatch.setattr(storage, "upload", upload_and_count)
+    queue.change_visibility(message, 0)
+    [message] = queue.receive(1, wait=0)
+    assert queue.receive_count(message) == 2
+    worker.process_message(message)
+    assert rendered == []
+    assert queued_at_upload == [1]
+    assert storage.exists(f"output/{reference.output_filename}")
+    worker.delete_messages()
+    assert len(queue) == 0
+
+
+def test_visibility_heartbeat(monkeypatch):
+    from probostitcher import worker
+    from probostitcher.queues import SqliteQueue
+
+    queue = SqliteQueue(":memory:", visibility_timeout=0.2)
+    monkeypatch.setattr(worker, "get_queue", lambda: queue)
+    queue.send(["job"])
+    [message] = queue.receive(1, wait=0)
+    with worker.visibility_heartbeat(message, timeout=0.3):
+        time.sleep(0.5)
+        # Without the heartbeat, the message would be visible again by now
+        assert queue.receive(1, wait=0) == []
+    time.sleep(0.4)
+    assert [message.body for message in queue.receive(1, wait=0)] == ["job"]
+
+
+def test_job_slots_released_on_queue_error(monkeypatch):
+    from probostitcher import worker
+
+    class BrokenQueue:
+        def receive(self, count, wait):
+            raise ConnectionError("queue unreachable")
+
+    monkeypatch.setattr(worker, "get_queue", lambda: BrokenQueue())
+    monkeypatch.setattr(worker, "JOB_SLOTS", threading.BoundedSemaphore(2))
+    with ThreadPoolExecutor(2) as executor:
+        with pytest.raises(ConnectionError):
+            worker.process_messages(executor)
+    # Both slots are free again
+    assert worker.acquire_job_slots(2) == 2